@@ -31,7 +31,6 @@ def main():
   paoflow.read_atomic_proj_QE()
   paoflow.projectability(pthr=0.95)
   paoflow.pao_hamiltonian(symmetrize=True,thresh=1.e-10,max_iter=64)
-  paoflow.z2_pack()
   paoflow.find_weyl_points(search_grid=[8,8,8])
   paoflow.finish_execution()
 
@@ -153,20 +153,17 @@ class PAOFLOW:
   def restart_dump ( self, fname_prefix='paoflow_dump' ):
     '''
       Saves the necessary information to restart a PAOFLOW run from any step in calculation.
+      Data is written to the directory 'fname_prefix'.ckpt, with one binary file per array.
 
       Arguments:
-          fname_prefix (str): Prefix of the filenames which will be written. Files are written to the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
+          fname_prefix (str): Prefix of the checkpoint directory which will be written. It is written to the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
 
       Returns:
           None
     '''
-    from pickle import dump,HIGHEST_PROTOCOL
+    from .defs.checkpoint import write_checkpoint
 
-    fname = fname_prefix + '_%d'%self.rank + '.json'
-
-    arry,attr = self.data_controller.data_dicts()
-    with open(fname, 'wb') as f:
-      dump([arry,attr], f, HIGHEST_PROTOCOL)
+    write_checkpoint(self.data_controller, fname_prefix+'.ckpt')
 
     self.report_module_time('Restart DUMP')
 
@@ -175,14 +172,23 @@ class PAOFLOW:
   def restart_load ( self, fname_prefix='paoflow_dump' ):
     '''
       Loads the previously dumped save files and populates the DataController with said data.
+      Checkpoints can be loaded with a different number of processes than the run which wrote them.
+      Per-process pickle files from earlier versions are still read, with the same number of processes.
 
       Arguments:
-          fname_prefix (str): Prefix of the filenames which will be written. Files are written to the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
+          fname_prefix (str): Prefix of the checkpoint directory (or files) which will be read. It is read from the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
 
       Returns:
           None
     '''
     from os.path import exists
+
+    if exists(fname_prefix+'.ckpt'):
+      from .defs.checkpoint import read_checkpoint
+      read_checkpoint(self.data_controller, fname_prefix+'.ckpt')
+      self.report_module_time('Restart LOAD')
+      return
+
     from pickle import load
 
     fname = fname_prefix + '_%d'%self.rank + '.json'
@@ -198,6 +204,11 @@ class PAOFLOW:
       print('Restarted runs must use the same number of cores as the original run.')
       raise ValueError('Number of processors does not match that of the previous run.')
 
+    # Older dumps hold the degeneracies as nested lists
+    if 'E_k' in arry:
+      from .defs.do_eigh import get_degeneracies
+      arry['degen'] = get_degeneracies(arry['E_k'], attr['bnd'])
+
     self.data_controller.data_arrays = arry
     self.data_controller.data_attributes = attr
 
@@ -260,18 +271,23 @@ class PAOFLOW:
 
 
 
-  def projections ( self, internal=False ):
+  def projections ( self, internal=False, distribute=False ):
     '''
     Calculate the projections on the atomic basis provided by the pseudopotential or 
     on the all-electron internal basis sets.
     Replaces projwfc.
     TODO  * add spin-orbit and non-collinear cases
+
+    Arguments:
+        internal (bool): If True use the all-electron internal basis sets
+        distribute (bool): If True, each rank only keeps the projections for its own block of k points
     '''
 
     from .defs.do_atwfc_proj import build_pswfc_basis_all
     from .defs.do_atwfc_proj import build_aewfc_basis
-    from .defs.do_atwfc_proj import calc_proj_k
-    from .defs.communication import load_balancing, gather_array
+    from mpi4py import MPI
+    from .defs.do_atwfc_proj import iter_proj_k
+    from .defs.communication import load_balancing, load_sizes
     
     arry,attr = self.data_controller.data_dicts()
     
@@ -288,13 +304,17 @@ class PAOFLOW:
     ini_ik,end_ik = load_balancing(self.size, self.rank,nkpnts)
     Unewaux = np.zeros((end_ik-ini_ik,nbnds,natwfc,nspin), dtype=complex)
     for ispin in range(nspin):
-      for ik in range(ini_ik,end_ik):
-        Unewaux[ik-ini_ik,:,:,ispin] = calc_proj_k(self.data_controller, basis, ik, ispin)
+      for ik,proj in iter_proj_k(self.data_controller, basis, range(ini_ik,end_ik), ispin):
+        Unewaux[ik-ini_ik,:,:,ispin] = proj
     
-    Unew = np.zeros((nkpnts,nbnds,natwfc,nspin), dtype=complex) if self.rank == 0 else None
-    gather_array(Unew,Unewaux)
-    if self.rank == 0: Unew = np.moveaxis(Unew,0,2)
-    Unew = self.comm.bcast(Unew, root=0)
+    if distribute:
+      Unew = np.moveaxis(Unewaux,0,2)
+    else:
+      Unew = np.empty((nkpnts,nbnds,natwfc,nspin), dtype=complex)
+      sizes = load_sizes(self.size, nkpnts, nbnds*natwfc*nspin)
+      self.comm.Allgatherv(Unewaux, [Unew,sizes[:,0],sizes[:,1],MPI.DOUBLE_COMPLEX])
+      Unew = np.moveaxis(Unew,0,2)
+    Unewaux = None
     
     arry['U'] = Unew
     arry['basis'] = basis
@@ -303,11 +323,14 @@ class PAOFLOW:
 
 
 
-  def read_atomic_proj_QE ( self ):
+  def read_atomic_proj_QE ( self, distribute=False ):
     '''
       Read the wavefunctions and overlaps from atomic-proj.xml, written by Quantum Espresso
       in the .save directory specified in PAOFLOW's constructos. They are saved to the 
       DataController's arrays dictionary with keys 'U' and 'Sks', respectively.
+
+      Arguments:
+          distribute (bool): If True, each rank only keeps the projections for its own block of k points
     '''
     from .defs.read_upf import UPF
     from os.path import exists,join
@@ -316,7 +339,7 @@ class PAOFLOW:
     fpath = attr['fpath']
     if exists(join(fpath,'atomic_proj.xml')):
       from .defs.read_QE_xml import parse_qe_atomic_proj
-      parse_qe_atomic_proj(self.data_controller, join(fpath,'atomic_proj.xml'))
+      parse_qe_atomic_proj(self.data_controller, join(fpath,'atomic_proj.xml'), distribute=distribute)
     else:
       raise Exception('atomic_proj.xml was not found.\n')
 
@@ -362,13 +385,15 @@ class PAOFLOW:
     
 
 
-  def pao_hamiltonian ( self, shift_type=1, insulator=False, write_binary=False, expand_wedge=True, symmetrize=False, thresh=1.e-6, max_iter=16 ):
+  def pao_hamiltonian ( self, shift_type=1, insulator=False, write_binary=False, expand_wedge=True, symmetrize=False, thresh=1.e-6, max_iter=16, tetrahedron=None ):
     '''
     Construct the Tight Binding Hamiltonian
     Populates DataController with 'HRs', 'Hks' and 'kq_wght'
+    (with expand_wedge, the k space Hamiltonian is kept distributed as 'Hksp')
 
     Arguments:
         shift_type (int): Shift type [ 0-(PRB 2016), 1-(PRB 2013), 2-No Shift ] 
+        tetrahedron (str): (optional) Locate the Fermi energy with the tetrahedron method ('linear' or 'blochl') instead of smearing
 
     Returns:
         None
@@ -377,6 +402,7 @@ class PAOFLOW:
     from .defs.get_K_grid_fft import get_K_grid_fft
     from .defs.do_build_pao_hamiltonian import do_build_pao_hamiltonian,do_Hks_to_HRs
     from .defs.do_Efermi import E_Fermi
+    from .defs.tetrahedron import check_tetrahedron
 
     # Data Attributes and Arrays
     arrays,attr = self.data_controller.data_dicts()
@@ -389,6 +415,8 @@ class PAOFLOW:
     attr['symmetrize'] = symmetrize
     attr['symm_max_iter'] = max_iter
     attr['expand_wedge'] = expand_wedge
+    check_tetrahedron(tetrahedron)
+    attr['tetrahedron'] = tetrahedron
 
     if attr['symmetrize'] and attr['acbn0']:
       if rank == 0:
@@ -827,9 +855,10 @@ mo    '''
       arrays['Hksp'] = gather_scatter(arrays['Hksp'], 1, attr['npool'])
 
       snktot = arrays['Hksp'].shape[1]
+      if 'tetrahedron' not in attr: attr['tetrahedron'] = None
       if reshift_Ef:
         Hksp = arrays['Hksp'].reshape((nawf,nawf,snktot,nspin))
-        Ef = E_Fermi(data_controller, Hksp, parallel=True)
+        Ef = E_Fermi(Hksp, self.data_controller, parallel=True, tetrahedron=attr['tetrahedron'])
         dinds = np.diag_indices(nawf)
         Hksp[dinds[0], dinds[1]] -= Ef
         arrays['Hksp'] = np.moveaxis(Hksp, 2, 0)
@@ -855,13 +884,21 @@ mo    '''
 
 
 
-  def pao_eigh ( self, bval=0 ):
+  def pao_eigh ( self, bval=0, backend='numpy', nthreads=1, kchunk=64, nbnd=None, emax=None ):
     '''
     Calculate the Eigen values and vectors of k-space Hamiltonian 'Hksp'
     Populates DataController with 'E_k' and 'v_k'
 
     Arguments:
         bval (int): Top valence band number (nelec/2) to correctly shift Eigenvalues
+        backend (str): Eigensolver backend ('numpy' for batched LAPACK calls over stacks of k-points, 'scipy' for one call per k-point)
+        nthreads (int): Number of threads per MPI rank diagonalizing chunks of k-points concurrently
+        kchunk (int): Number of k-points diagonalized together in each batched call
+        nbnd (int): (optional) Compute and store only the lowest nbnd eigenpairs
+        emax (float): (optional) Compute and store only the lowest bands needed to include every eigenvalue below emax (eV)
+          Partial spectra only save work with the 'scipy' backend, which solves for the subset; the 'numpy' backend computes the full spectrum and only stores the lowest bands.
+          Sums over intermediate states (e.g. band curvature, Berry curvature) are truncated to the stored bands.
+          With HubbardU, at least bval+1 bands are kept for the shift to the top of the valence band.
 
     Returns:
         None
@@ -888,7 +925,7 @@ mo    '''
         arrays['Hksp'] = scatter_full(arrays['Hks'], attr['npool'])
         del arrays['Hks']
 
-      do_pao_eigh(self.data_controller)
+      do_pao_eigh(self.data_controller, backend, nthreads, kchunk, nbnd, emax)
 
       ### PARALLELIZATION
       ## DEV: Sample RunTime Here
@@ -1002,10 +1039,11 @@ mo    '''
 
 
 
-  def dos ( self, do_dos=True, do_pdos=True, delta=0.01, emin=-10., emax=2., ne=1000 ):
+  def dos ( self, do_dos=True, do_pdos=True, delta=0.01, emin=-10., emax=2., ne=1000, tetrahedron=None ):
     '''
     Calculate the Density of States and Projected Density of States
       If Adaptive Smearing has been performed, the Adaptive DoS will be calculated
+      If 'tetrahedron' is set, the tetrahedron method is used in place of smearing
 
     Arguments:
         do_dos (bool): Perform Density of States calculation
@@ -1014,16 +1052,27 @@ mo    '''
         emin (float): The minimum energy in the range to be computed
         emax (float): The maximum energy in the range to be computed
         ne (int): The number of points to place in the range [emin,emax]
+        tetrahedron (str): (optional) Tetrahedron integration, 'linear' or 'blochl' (Blöchl corrected PDoS weights)
 
     Returns:
         None
     '''
+    from .defs.tetrahedron import check_tetrahedron
+
     arrays,attr = self.data_controller.data_dicts()
 
     if 'smearing' not in attr: attr['smearing'] = None
 
     try:
-      if attr['smearing'] is None:
+      check_tetrahedron(tetrahedron)
+      if tetrahedron is not None:
+        if do_dos:
+          from .defs.do_dos import do_dos_tetrahedron
+          do_dos_tetrahedron(self.data_controller, emin, emax, ne)
+        if do_pdos:
+          from .defs.do_pdos import do_pdos_tetrahedron
+          do_pdos_tetrahedron(self.data_controller, emin, emax, ne, tetrahedron=='blochl')
+      elif attr['smearing'] is None:
         if do_dos:
           from .defs.do_dos import do_dos
           do_dos(self.data_controller, emin, emax, ne, delta)
@@ -1048,7 +1097,10 @@ mo    '''
       if attr['abort_on_exception']:
         raise e
 
-    mname = 'DoS%s'%('' if attr['smearing'] is None else ' (Adaptive Smearing)')
+    if tetrahedron is not None:
+      mname = 'DoS (Tetrahedron)'
+    else:
+      mname = 'DoS%s'%('' if attr['smearing'] is None else ' (Adaptive Smearing)')
     self.report_module_time(mname)
 
 
@@ -1150,7 +1202,7 @@ mo    '''
 
 
 
-  def spin_Hall ( self, twoD=False, do_ac=False, emin=-1., emax=1., fermi_up=1., fermi_dw=-1., s_tensor=None ):
+  def spin_Hall ( self, twoD=False, do_ac=False, emin=-1., emax=1., fermi_up=1., fermi_dw=-1., s_tensor=None, kramerskronig=False ):
     '''
     Calculate the Spin Hall Conductivity
       Currently this module does not possess the "spin_orbit" capability of do_topology, because I(Frank) do not know what this modification entails.
@@ -1164,6 +1216,7 @@ mo    '''
         fermi_up (float): The upper limit of the occupied energy range
         fermi_dw (float): The lower limit of the occupied energy range
         s_tensor (list): List of tensor elements to calculate (e.g. To calculate xxx and zxy use [[0,0,0],[0,1,2]])
+        kramerskronig (bool): With do_ac, True to rebuild the real part of sigma_xy from its imaginary part by a Kramers-Kronig transform
 
     Returns:
         None
@@ -1182,7 +1235,7 @@ mo    '''
       self.spin_operator()
 
     try:
-      do_spin_Hall(self.data_controller, twoD, do_ac)
+      do_spin_Hall(self.data_controller, twoD, do_ac, kramerskronig)
     except Exception as e:
       self.report_exception('spin_Hall')
       if attr['abort_on_exception']:
@@ -1192,7 +1245,7 @@ mo    '''
 
 
 
-  def anomalous_Hall ( self, do_ac=False, emin=-1., emax=1., fermi_up=1., fermi_dw=-1., a_tensor=None ):
+  def anomalous_Hall ( self, do_ac=False, emin=-1., emax=1., fermi_up=1., fermi_dw=-1., a_tensor=None, kramerskronig=False ):
     '''
     Calculate the Anomalous Hall Conductivity
 
@@ -1203,6 +1256,7 @@ mo    '''
         fermi_up (float): The upper limit of the occupied energy range
         fermi_dw (float): The lower limit of the occupied energy range
         a_tensor (list): List of tensor elements to calculate (e.g. To calculate xx and yz use [[0,0],[1,2]])
+        kramerskronig (bool): With do_ac, True to rebuild the real part of sigma_xy from its imaginary part by a Kramers-Kronig transform
 
     Returns:
         None
@@ -1219,7 +1273,7 @@ mo    '''
     if 'fermi_dw' not in attr: attr['fermi_dw'] = fermi_dw
 
     try:
-      do_anomalous_Hall(self.data_controller, do_ac)
+      do_anomalous_Hall(self.data_controller, do_ac, kramerskronig)
     except Exception as e:
       self.report_exception('anomalous_Hall')
       if attr['abort_on_exception']:
@@ -1262,7 +1316,7 @@ mo    '''
 
 
 
-  def doping ( self, tmin=300, tmax=300, nt=1, delta=0.01, emin=-1., emax=1., ne=1000, doping_conc=0., core_electrons=0., fname='doping_' ):
+  def doping ( self, tmin=300, tmax=300, nt=1, delta=0.01, emin=-1., emax=1., ne=1000, doping_conc=0., core_electrons=0., fname='doping_', tetrahedron=None ):
     '''
     Calculate the chemical potential that corresponds to specified doping for different temperatures
 
@@ -1276,13 +1330,17 @@ mo    '''
         doping_conc(float): The amount of doping in 1/cm^3. Positive value for p type and negative value for n type
         core_electrons(float): The number of core electrons in a system. Adding this to integrated dos allows for integration over a narrower energy window
         fname (str): Prefix for the filename containg Doping vs Temperature
+        tetrahedron (str): (optional) Integrate the DoS with the tetrahedron method ('linear' or 'blochl')
 
     Returns:
         None
     '''
     from .defs.do_doping import do_doping
-    from .defs.do_dos import do_dos,do_dos_adaptive
-    
+    from .defs.do_dos import do_dos,do_dos_adaptive,do_dos_tetrahedron
+    from .defs.tetrahedron import check_tetrahedron
+
+    check_tetrahedron(tetrahedron)
+
     arrays,attr = self.data_controller.data_dicts()
 
     if 'delta' not in attr: attr['delta'] = delta
@@ -1291,17 +1349,19 @@ mo    '''
 
     ene = np.linspace(emin, emax, ne)
     temps = np.linspace(tmin, tmax, nt)
-    if attr['smearing'] == None:
+    if tetrahedron is not None:
+      do_dos_tetrahedron(self.data_controller, emin, emax, ne)
+    elif attr['smearing'] == None:
       do_dos(self.data_controller, emin, emax, ne, delta)
     else:
-      do_dos_adaptive(self.data_controller, emin, emax, ne, delta)
-    do_doping(self.data_controller, temps, ene, fname)
+      do_dos_adaptive(self.data_controller, emin, emax, ne)
+    do_doping(self.data_controller, temps, ene, fname, tetrahedron)
 
     self.report_module_time('Doping')
 
 
 
-  def transport ( self, tmin=300., tmax=300., nt=1, emin=-2., emax=2., ne=500, scattering_channels=[], scattering_weights=[], tau_dict={}, do_hall=False, write_to_file=True, save_tensors=False ):
+  def transport ( self, tmin=300., tmax=300., nt=1, emin=-2., emax=2., ne=500, scattering_channels=[], scattering_weights=[], tau_dict={}, do_hall=False, write_to_file=True, save_tensors=False, write_binary=False ):
     '''
     Calculate the Transport Properties
 
@@ -1319,11 +1379,13 @@ mo    '''
         do_hall (bool): Set True to calculate hall coefficient
         write_to_file (bool): Set True to write tensors to file
         save_tensors (bool): Set True to save the tensors into the data controller
+        write_binary (bool): Set True to also write the tensors for all temperatures to 'transport_<spin>.npz'
 
     Returns:
         None
     '''
     from .defs.do_transport import do_transport
+    from .defs.do_Boltz_tensors import clear_tau_cache
 
     arrays,attr = self.data_controller.data_dicts()
     if 'tau_dict' not in attr: attr['tau_dict'] = tau_dict
@@ -1338,12 +1400,14 @@ mo    '''
       for n in range(bnd):
         velkp[:,:,n,:] = np.real(arrays['pksp'][:,:,n,n,:])
 
-      do_transport(self.data_controller, temps, ene, velkp, sc, sw, do_hall, write_to_file, save_tensors)
+      do_transport(self.data_controller, temps, ene, velkp, sc, sw, do_hall, write_to_file, save_tensors, write_binary)
 
     except Exception as e:
       self.report_exception('transport')
       if attr['abort_on_exception']:
         raise e
+    finally:
+      clear_tau_cache()
 
     self.report_module_time('Transport')
 
@@ -1445,7 +1509,7 @@ mo    '''
 
     self.report_module_time('Inverse Participation Ratio (IPR)')
 
-  def berry_phase (self, kspace_method='path', berry_path=None, high_sym_points=None, kpath_funct=None, nk1=100, nk2=100, closed=True, method='berry', sub=None, occupied=True, kradius=None, kcenter=[0.,0.,0.],kxlim=(-0.5,0.5),kylim=(-0.5,0.5),eigvals=False,fname='berry_phase',contin=False):
+  def berry_phase (self, kspace_method='path', berry_path=None, high_sym_points=None, kpath_funct=None, nk1=100, nk2=100, closed=True, method='berry', sub=None, occupied=True, kradius=None, kcenter=[0.,0.,0.],kxlim=(-0.5,0.5),kylim=(-0.5,0.5),eigvals=False,fname='berry_phase',contin=False,nthreads=1):
     '''
     Compute the Berry phase using the discretized formula.
     See R. Resta, Rev. Mod. Phys. 66, 899 (1994) and R. Resta, J. Phys.: Condens. Matter 22, 123201 (2010)
@@ -1471,6 +1535,7 @@ mo    '''
         save_prd (bool, optional): save overlap matrix
         fname (str, optional): filename to save the berry phase results
         contin (bool, optional): make berry phase continuous by fixing 2pi shifts
+        nthreads (int, optional): number of threads per MPI rank diagonalizing the k-points of the loops, used when kspace_method='track'
 
     Returns:
         Berry/Zak phase
@@ -1520,6 +1585,7 @@ mo    '''
     attr['berry_closed'] = closed
     attr['berry_contin'] = contin
     attr['berry_fname'] = fname
+    attr['berry_nthreads'] = nthreads
 
     try:
 
@@ -25,16 +25,28 @@ class TauModel:
   An additional argument, params (a dictionary), is required. Further parameters can be passed into    the routine by including them in this dictionary.
   '''
 
-  def __init__ ( self, function=None, params=None, weight=1. ):
+  def __init__ ( self, function=None, params=None, weight=1., vectorized=False ):
     '''
     Arguments:
       function (func): A function requiring 3 arguments, (temp,eig,params)
       params (dict): A dictionary with any additional constants of variables the function may require
       weight (float): A weight, w_i, incorporated in the harmonic sum of tau. 1/Tau = Sum(w_i/Tau_i)
+      vectorized (bool): True if function broadcasts an array of temperatures against the eigenvalues
     '''
     self.function = function
     self.params = params
     self.weight = weight
+    self.vectorized = vectorized
 
   def evaluate ( self, temp, eigs ):
     return self.function(temp, eigs, self.params)
+
+  def evaluate_temps ( self, temps, eigs ):
+    # Evaluate for several temperatures, returning an array with shape (ntemps,)+eigs.shape
+    import numpy as np
+
+    temps = np.asarray(temps, dtype=float)
+    if self.vectorized:
+      tb = temps.reshape((-1,)+(1,)*eigs.ndim)
+      return np.broadcast_to(self.function(tb, eigs, self.params), temps.shape+eigs.shape)
+    return np.array([self.evaluate(t, eigs) for t in temps])
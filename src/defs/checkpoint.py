@@ -0,0 +1,218 @@
+#
+# PAOFLOW
+#
+# Copyright 2016-2022 - Marco BUONGIORNO NARDELLI (mbn@unt.edu)
+#
+# Reference:
+#
+# F.T. Cerasoli, A.R. Supka, A. Jayaraj, I. Siloi, M. Costa, J. Slawinska, S. Curtarolo, M. Fornari, D. Ceresoli, and M. Buongiorno Nardelli,
+# Advanced modeling of materials with PAOFLOW 2.0: New features and software design, Comp. Mat. Sci. 200, 110828 (2021).
+#
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+
+import numpy as np
+from mpi4py import MPI
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+# Arrays distributed over the k points with scatter_full, and the axis holding the k index
+kdistributed = { 'Hksp':0, 'E_k':0, 'v_k':0, 'dHksp':0, 'pksp':0, 'deltakp':0, 'deltakp2':0, 'd2Ed2k':1 }
+
+# Arrays distributed in contiguous blocks of k points (load_balancing), and the k axis
+kblocks = { 'U':2 }
+
+# Entries recomputed on load rather than saved, as they depend on the distribution
+rebuilt = ( 'degen', )
+
+header_file = 'header.json'
+objects_file = 'objects.pkl'
+
+
+def layout_indices ( kind, n, npool, r, nproc ):
+  # Global indices along the distributed axis held by rank r of nproc
+  from .communication import load_balancing, scatter_indices
+
+  if kind == 'scatter':
+    return scatter_indices(n, npool, r, nproc)
+  start,stop = load_balancing(nproc, r, n)
+  return np.arange(start, stop, dtype=int)
+
+
+def array_digest ( arr ):
+  # Hash of the contents of an array, to tell replicated arrays from per-rank data
+  from hashlib import blake2b
+  return blake2b(np.ascontiguousarray(arr).view(np.uint8).data, digest_size=16).hexdigest()
+
+
+def write_checkpoint ( data_controller, path ):
+  '''
+  Save the DataController to the directory 'path'. Each array is written to its own
+  .npy file (a raw binary block with a shape and dtype header). Arrays distributed
+  over k points are written by every process to its own file, with the layout recorded
+  in the header so that they can be redistributed on load. Arrays identical on every
+  process are written once by rank 0, while any other array which differs between
+  processes is written per process and can only be reloaded with the same number of
+  processes. The remaining entries and attributes are pickled.
+
+  Arguments:
+      data_controller (DataController): The DataController to save
+      path (str): Checkpoint directory
+
+  Returns:
+      None
+  '''
+  import json
+  from os import makedirs
+  from os.path import join
+  from pickle import dump,HIGHEST_PROTOCOL
+
+  arry,attr = data_controller.data_dicts()
+  npool = attr['npool']
+
+  if rank == 0:
+    makedirs(path, exist_ok=True)
+  comm.Barrier()
+
+  names = None
+  if rank == 0:
+    names = sorted(k for k,v in arry.items() if isinstance(v,np.ndarray) and not v.dtype.hasobject)
+  names = comm.bcast(names)
+
+  header = {'mpisize':size, 'npool':npool, 'arrays':{}}
+  for name in names:
+    arr = arry[name] if name in arry and isinstance(arry[name],np.ndarray) else None
+    kind,axis = None,None
+    if name in kdistributed:
+      kind,axis = 'scatter',kdistributed[name]
+    elif name in kblocks:
+      kind,axis = 'block',kblocks[name]
+
+    if kind is not None:
+      # Check that every process holds its share of the k points
+      nloc = arr.shape[axis] if arr is not None and arr.ndim > axis else 0
+      nk = comm.allreduce(nloc)
+      valid = arr is not None and nloc == layout_indices(kind,nk,npool,rank,size).size
+      if not comm.allreduce(valid, op=MPI.LAND):
+        kind = None
+
+    if kind is None:
+      # Replicated only if the shape, type and contents agree on every process
+      desc = None if arr is None else (arr.shape, arr.dtype.str, (array_digest(arr) if size > 1 else None))
+      kind = None if all(d == desc for d in comm.allgather(desc)) else 'rank'
+
+    if kind is None:
+      if rank == 0:
+        np.save(join(path,name+'.npy'), arr)
+        header['arrays'][name] = {'kind':None, 'file':name+'.npy', 'shape':list(arr.shape), 'dtype':arr.dtype.str}
+      continue
+
+    # One file per process
+    fname = '%s_%d.npy'%(name,rank)
+    if arr is not None:
+      np.save(join(path,fname), arr)
+    files = comm.gather((fname if arr is not None else None))
+
+    if rank == 0:
+      h = {'kind':kind, 'files':files}
+      if kind == 'rank':
+        h['dtype'] = (arr.dtype.str if arr is not None else None)
+      else:
+        gshape = list(arr.shape)
+        gshape[axis] = nk
+        h.update({'axis':axis, 'shape':gshape, 'dtype':arr.dtype.str})
+      header['arrays'][name] = h
+
+  if rank == 0:
+    objects = {k:v for k,v in arry.items() if k not in names and k not in rebuilt}
+    with open(join(path,objects_file), 'wb') as f:
+      dump([attr,objects], f, HIGHEST_PROTOCOL)
+    with open(join(path,header_file), 'w') as f:
+      json.dump(header, f, indent=1)
+
+  comm.Barrier()
+
+
+def read_distributed ( path, h, npool, nproc ):
+  # This process's part of an array written per process with layout h['kind'],
+  # redistributed from the nproc processes which wrote it
+  from os.path import join
+
+  axis,n = h['axis'],h['shape'][h['axis']]
+  mine = layout_indices(h['kind'], n, npool, rank, size)
+
+  if nproc == size and np.array_equal(mine, layout_indices(h['kind'],n,npool,rank,nproc)):
+    return np.load(join(path,h['files'][rank]), mmap_mode='c')
+
+  # Writer and local position of every global index
+  owner = np.empty(n, dtype=int)
+  pos = np.empty(n, dtype=int)
+  for r in range(nproc):
+    inds = layout_indices(h['kind'], n, npool, r, nproc)
+    owner[inds] = r
+    pos[inds] = np.arange(inds.size)
+
+  shape = list(h['shape'])
+  shape[axis] = mine.size
+  arr = np.empty(shape, dtype=np.dtype(h['dtype']))
+  for r in np.unique(owner[mine]):
+    sel = np.where(owner[mine] == r)[0]
+    mm = np.load(join(path,h['files'][r]), mmap_mode='r')
+    np.moveaxis(arr,axis,0)[sel] = np.moveaxis(mm,axis,0)[pos[mine[sel]]]
+    mm = None
+  return arr
+
+
+def read_checkpoint ( data_controller, path ):
+  '''
+  Load a checkpoint written by write_checkpoint, possibly with a different number of
+  processes. Replicated arrays, and distributed arrays whose layout is unchanged, are
+  memory mapped copy-on-write, so they are only read from disk when accessed. Otherwise
+  each process reads its own k points of the distributed arrays from the files holding them.
+
+  Arguments:
+      data_controller (DataController): The DataController to populate
+      path (str): Checkpoint directory
+
+  Returns:
+      None
+  '''
+  import json
+  from os.path import join
+  from pickle import load
+  from .do_eigh import get_degeneracies
+
+  with open(join(path,header_file), 'r') as f:
+    header = json.load(f)
+  with open(join(path,objects_file), 'rb') as f:
+    attr,arry = load(f)
+
+  nproc = header['mpisize']
+  npool = header['npool']
+
+  for name,h in header['arrays'].items():
+    if h['kind'] is None:
+      arry[name] = np.load(join(path,h['file']), mmap_mode='c')
+    elif h['kind'] == 'rank':
+      if nproc != size:
+        raise ValueError('Array \'%s\' differs between processes and can only be restored with %d processes'%(name,nproc))
+      if h['files'][rank] is not None:
+        arry[name] = np.load(join(path,h['files'][rank]), mmap_mode='c')
+    else:
+      arry[name] = read_distributed(path, h, npool, nproc)
+
+  attr['mpisize'] = size
+
+  if 'E_k' in arry and 'bnd' in attr:
+    arry['degen'] = get_degeneracies(arry['E_k'], attr['bnd'])
+
+  data_controller.data_arrays = arry
+  data_controller.data_attributes = attr
@@ -201,43 +201,75 @@ def gather_full(arr,npool,sroot=0):
         return temp
 
 
-def gather_scatter(arr,scatter_axis,npool):
-    #scatter indices for scatter_axis to each proc
-    axis_ind = np.array(list(range(arr.shape[scatter_axis])),dtype=int)
-    axis_ind = scatter_full(axis_ind,npool)
-
-    #broadcast indices that for scattered array to proc with rank 'r'
-    size_r = np.zeros((size),dtype=int,order='C')
-    scatter_ind = np.zeros((arr.shape[scatter_axis]),dtype=int,order='C')
-    
-    if rank==0:
-        gather_array(size_r,np.array(axis_ind.size,dtype=int))
-        gather_array(scatter_ind,np.array(axis_ind,dtype=int))
-    else:
-        gather_array(None,np.array(axis_ind.size,dtype=int))
-        gather_array(None,np.array(axis_ind,dtype=int))
-
-    axis_ind = None
+# Largest count accepted by a single MPI call
+int_max = 2147483647
+
+def scatter_indices ( n, npool, r=rank, nproc=size ):
+    # Global indices of the items held by rank 'r' when an array
+    # of length n is distributed with scatter_full over nproc ranks
+    nchunks = n//nproc
+    inds = []
+    for pool in range(npool):
+        chunk_s,chunk_e = load_balancing(npool,pool,nchunks)
+        nc = chunk_e-chunk_s
+        inds.append(chunk_s*nproc + r*nc + np.arange(nc, dtype=int))
+    ts,te = load_balancing(nproc,r,n%nproc)
+    inds.append(nchunks*nproc + np.arange(ts, te, dtype=int))
+    return np.concatenate(inds)
 
-    comm.Bcast(size_r)
-    comm.Bcast(scatter_ind)
 
-    #start and end points of indices of scatter axis for each proc
-    end   = np.cumsum(size_r)
-    start = end - size_r
-    size_r = None
-    
-    for r in range(size):
-        comm.Barrier()
-        #gather array from each proc with indices for each proc on scatter_axis
-        if r == rank:
-            temp = gather_full(np.take(arr,scatter_ind[start[r]:end[r]],axis=scatter_axis),npool,sroot=r)
-        else:
-            gather_full(np.take(arr,scatter_ind[start[r]:end[r]],axis=scatter_axis),npool,sroot=r)
-
-    start = end = scatter_ind = None
-
-    return temp
+def gather_scatter(arr,scatter_axis,npool):
+    # Redistribute an array whose first axis is distributed (as by scatter_full)
+    # so that the first axis is complete and scatter_axis is distributed instead.
+    # All blocks are exchanged with one Alltoallv, split into several rounds
+    # only if a buffer would exceed the MPI count limit.
+
+    nrows = np.array(comm.allgather(arr.shape[0]), dtype=int)
+    ncols = arr.shape[scatter_axis]
+    rows = [scatter_indices(nrows.sum(),npool,r) for r in range(size)]
+    cols = [scatter_indices(ncols,npool,r) for r in range(size)]
+    mycols = cols[rank].size
+
+    # Scatter axis second, remaining axes flattened
+    aux = np.moveaxis(arr,scatter_axis,1)
+    rshape = aux.shape[2:]
+    inner = int(np.prod(rshape))
+    aux = aux.reshape((arr.shape[0],ncols,inner))
+
+    temp = np.empty((nrows.sum(),mycols)+rshape, dtype=arr.dtype)
+    tview = temp.reshape((nrows.sum(),mycols,inner))
+
+    # Number of rounds needed to keep every count and displacement below int_max
+    nsend = arr.shape[0]*ncols*inner
+    nrecv = nrows.sum()*mycols*inner
+    nround = np.array([1+max(nsend,nrecv)//int_max], dtype=int)
+    comm.Allreduce(MPI.IN_PLACE, nround, op=MPI.MAX)
+    nround = int(nround[0])
+
+    mpidtype = MPI._typedict[np.dtype(arr.dtype).char]
+    cparts = [np.array_split(np.arange(cols[r].size),nround) for r in range(size)]
+
+    for c in range(nround):
+        scols = [cols[r][cparts[r][c]] for r in range(size)]
+        rcols = cparts[rank][c]
+
+        scounts = np.array([arr.shape[0]*sc.size*inner for sc in scols], dtype=int)
+        rcounts = nrows*rcols.size*inner
+        sdispls = np.concatenate(([0],np.cumsum(scounts)[:-1]))
+        rdispls = np.concatenate(([0],np.cumsum(rcounts)[:-1]))
+
+        sendbuf = np.concatenate([aux[:,sc].ravel() for sc in scols])
+        recvbuf = np.empty(rcounts.sum(), dtype=arr.dtype)
+
+        comm.Alltoallv([sendbuf,(scounts,sdispls),mpidtype], [recvbuf,(rcounts,rdispls),mpidtype])
+        sendbuf = None
+
+        for r in range(size):
+            block = recvbuf[rdispls[r]:rdispls[r]+rcounts[r]]
+            tview[rows[r][:,None],rcols[None,:]] = block.reshape((nrows[r],rcols.size,inner))
+        recvbuf = None
+
+    return np.moveaxis(temp,1,scatter_axis) if scatter_axis != 1 else temp
 
 
 def gen_window(array,root=0):
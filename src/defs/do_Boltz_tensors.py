@@ -20,71 +20,90 @@
 import numpy as np
 from scipy import signal
 from mpi4py import MPI
+from collections import OrderedDict
 
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
-def do_Boltz_tensors ( data_controller, smearing, temp, ene, velkp, ispin, channels, weights):
-  # Compute the L_alpha tensors for Boltzmann transport
+# Maximum number of (state, energy) kernel values held in memory at once
+max_boltz_elems = 2**22
 
-  arrays,attributes = data_controller.data_dicts()
+# Independent components of the symmetric transport tensors
+t_components = np.array([[0,0],[1,1],[2,2],[0,1],[0,2],[1,2]], dtype=int)
 
-  esize = ene.size
-  arrays['scattering_tau'] = get_tau(data_controller, temp, channels, weights)
 
-#### Forced t_tensor to have all components
-  t_tensor = np.array([[0,0],[1,1],[2,2],[0,1],[0,2],[1,2]], dtype=int)
+def do_Boltz_tensors ( data_controller, smearing, temp, ene, velkp, ispin, channels, weights):
+  # Compute the L_alpha tensors for Boltzmann transport at a single temperature
 
-  # Quick call function for L_loop (None is smearing type)
-  fLloop = lambda spol : L_loop(data_controller, temp, smearing, ene, velkp, t_tensor, spol, ispin)
+  L = do_Boltz_tensors_temps(data_controller, smearing, [temp], ene, velkp, ispin, channels, weights)
 
-  # Quick call function for Zeros on rank Zero
-  zoz = lambda r: (np.zeros((3,3,esize), dtype=float) if r==0 else None)
+  return (L[0,0], L[0,1], L[0,2]) if rank==0 else (None, None, None)
 
-  L0 = zoz(rank)
-  L0aux = fLloop(0)
-  comm.Reduce(L0aux, L0, op=MPI.SUM)
-  L0aux = None
 
-  if rank == 0:
-    # Assign lower triangular to upper triangular
-    sym = lambda L : (L[0,1], L[0,2], L[1,2])
-    L0[1,0],L0[2,0],L0[2,1] = sym(L0)
+def do_Boltz_tensors_temps ( data_controller, smearing, temps, ene, velkp, ispin, channels, weights, nmoments=3 ):
+  '''
+  Compute the L_alpha tensors for Boltzmann transport at several temperatures,
+  with a single pass over the k points for all temperatures and moments.
+
+  Arguments:
+      data_controller (DataController): Data controller holding E_k (and deltakp for adaptive smearing)
+      smearing (str): None for the Fermi window, or 'gauss'/'m-p' for adaptive smearing
+      temps (list): Temperatures in energy units
+      ene (ndarray): Chemical potentials
+      velkp (ndarray): Band velocities with shape (snktot,3,bnd,nspin)
+      ispin (int): Spin channel
+      channels (list): Scattering channels passed to get_taus
+      weights (list): Weights of the scattering channels
+      nmoments (int): Number of moments L_0 ... L_(nmoments-1) to compute
+
+  Returns:
+      L (ndarray): On rank 0, array with shape (ntemps,nmoments,3,3,esize), None elsewhere
+  '''
+  arrays,attributes = data_controller.data_dicts()
+
+  esize = ene.size
+  snktot = arrays['E_k'].shape[0]
+  bnd = attributes['bnd']
+  ntemp = len(temps)
+
+  # Relaxation times are evaluated for as many temperatures at once as fit in the scratch size
+  tblock = max(1, max_boltz_elems//max(1,snktot*bnd))
 
-  L1 = zoz(rank)
-  L1aux = fLloop(1)
-  comm.Reduce(L1aux, L1, op=MPI.SUM)
-  L1aux = None
+  Laux = np.zeros((ntemp,nmoments,t_components.shape[0],esize), dtype=float)
+  for ts in range(0, ntemp, tblock):
+    te = min(ntemp, ts+tblock)
+    taus = get_taus(data_controller, temps[ts:te], channels, weights, ispin)
+    Laux[ts:te] = L_moments(data_controller, temps[ts:te], smearing, ene, velkp, taus, ispin, nmoments)
+  taus = None
 
-  L2 = zoz(rank)
-  L2aux = fLloop(2)
-  comm.Reduce(L2aux, L2, op=MPI.SUM)
-  L2aux = None
+  L = (np.zeros_like(Laux) if rank==0 else None)
+  comm.Reduce(Laux, L, op=MPI.SUM)
+  Laux = None
 
   if rank == 0:
-    L1[1,0],L1[2,0],L1[2,1] = sym(L1)
-    L2[1,0],L2[2,0],L2[2,1] = sym(L2)
+    # Expand the independent components to the symmetric tensors
+    Lfull = np.empty((ntemp,nmoments,3,3,esize), dtype=float)
+    Lfull[:,:,t_components[:,0],t_components[:,1]] = L
+    Lfull[:,:,t_components[:,1],t_components[:,0]] = L
+    return Lfull
 
-  return (L0, L1, L2) if rank==0 else (None, None, None)
+  return None
 
 
-def do_Boltz_tensors_hall ( data_controller, smearing, temp, ene, velkp, ispin, channels, weights):
+def do_Boltz_tensors_hall ( data_controller, smearing, temp, ene, velkp, ispin, channels, weights, max_elems=None ):
+  # Compute the L0 Hall tensor for Boltzmann transport.
+  # 'max_elems' caps the number of (state, energy) kernel values held at once (default max_boltz_elems)
 
   arrays,attributes = data_controller.data_dicts()
 
   esize = ene.size
-  arrays['scattering_tau'] = get_tau(data_controller, temp, channels, weights)
-
-#### Forced t_tensor to have all components
-  t_tensor = np.array([[0,0],[1,1],[2,2],[0,1],[0,2],[1,2]], dtype=int)
-
-  # Quick call function for L_loop (None is smearing type)
+  tau = get_taus(data_controller, [temp], channels, weights, ispin)[0]
 
   # Quick call function for Zeros on rank Zero
   zoz = lambda r: (np.zeros((3,3,3,esize), dtype=float) if r==0 else None)
 
   L0_hall = zoz(rank)
-  L0_hall_aux = L_loop_hall(data_controller, temp, smearing, ene, velkp, t_tensor, 0, ispin)
+  L0_hall_aux = L_loop_hall(data_controller, temp, smearing, ene, velkp, tau, ispin, max_elems)
   comm.Reduce(L0_hall_aux, L0_hall, op=MPI.SUM)
   L0_hall_aux = None
   
@@ -92,162 +111,228 @@ def do_Boltz_tensors_hall ( data_controller, smearing, temp, ene, velkp, ispin,
 
 
 def get_tau ( data_controller, temp, channels, weights ):
-  import numpy as np
-  import scipy.constants as cp
-  from .TauModel import TauModel
-  from .do_tau_models import builtin_tau_model
+  # Relaxation times at a single temperature, with shape (snktot,bnd,nspin)
 
-  arry,attr = data_controller.data_dicts()
-  snktot = arry['E_k'].shape[0]
+  arry,_ = data_controller.data_dicts()
 
-  taus = []
-  for c in channels:
-    if c == 'acoustic':
-      a_tau = np.ones((snktot), dtype=float)
-      taus.append(a_tau)
+  nspin = arry['E_k'].shape[2]
+  return np.stack([get_taus(data_controller,[temp],channels,weights,ispin)[0] for ispin in range(nspin)], axis=-1)
 
-  bnd = attr['bnd']
-  eigs = np.abs(arry['E_k'][:,:bnd,:])
-  snktot,_,nspin = eigs.shape
+
+def tau_models ( channels, weights, tau_dict ):
+  # Build the TauModel list for the scattering channels
+  from .TauModel import TauModel
+  from .do_tau_models import builtin_tau_model
 
   models = []
   if channels != None:
     if len(weights) == 0:
       weights = np.ones(len(channels))
-    elif len(weights) != len(models):
+    elif len(weights) != len(channels):
       raise Exception('Length of weights does not match the number of channels.')
     for i,c in enumerate(channels):
       if isinstance(c,str):
-        models.append(builtin_tau_model(c,attr['tau_dict'],weights[i]))
+        models.append(builtin_tau_model(c,tau_dict,weights[i]))
       elif isinstance(c,TauModel):
         c.weight = weights[i]
         models.append(c)
       else:
         print('Invalid channel type.')
 
+  return models
+
+
+# Relaxation times kept between calls, keyed on (channels, parameters, eigenvalues, temperature, spin)
+# and evicted least recently used first once they hold more than max_tau_cache_elems values.
+# The cache only serves the tensors of a single transport calculation and is cleared after it.
+tau_cache = OrderedDict()
+max_tau_cache_elems = 2**25
+
+def clear_tau_cache ():
+  tau_cache.clear()
+
+
+def content_key ( obj ):
+  # Hashable key determined by the full contents of obj: arrays are keyed on a hash
+  # of their bytes, containers recursively. Objects which cannot be keyed this way
+  # get a fresh sentinel, so they never match a cached entry.
+  from hashlib import blake2b
+  from pickle import dumps,HIGHEST_PROTOCOL
+
+  if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+    h = blake2b(np.ascontiguousarray(obj).view(np.uint8).data, digest_size=16)
+    return ('ndarray', obj.dtype.str, obj.shape, h.hexdigest())
+  if isinstance(obj, dict):
+    return ('dict',) + tuple(sorted((repr(k),content_key(v)) for k,v in obj.items()))
+  if isinstance(obj, (list,tuple)):
+    return (type(obj).__name__,) + tuple(content_key(v) for v in obj)
+  if obj is None or isinstance(obj, (bool,int,float,complex,str,np.generic)):
+    return (type(obj).__name__, repr(obj))
+  try:
+    return ('pickle', blake2b(dumps(obj,HIGHEST_PROTOCOL), digest_size=16).hexdigest())
+  except Exception:
+    return ('unkeyed', object())
+
+
+def tau_model_key ( model ):
+  # The function object itself is part of the key, so it cannot be collected
+  # (and its id reused) while a cached entry refers to it
+  return (model.function, float(model.weight), content_key(model.params))
+
+
+def get_taus ( data_controller, temps, channels, weights, ispin ):
+  '''
+  Relaxation times for several temperatures, as the harmonic sum of the scattering
+  channel contributions (tau = 1 in the constant relaxation time approximation).
+  Temperatures missing from the cache are evaluated together, with a single call
+  per channel for the builtin models.
+
+  Arguments:
+      data_controller (DataController): Data controller holding E_k and tau_dict
+      temps (list): Temperatures in energy units
+      channels (list): Builtin model names and/or TauModel objects
+      weights (list): Weights of the channels in the harmonic sum (all 1 if empty)
+      ispin (int): Spin channel
+
+  Returns:
+      taus (ndarray): Array with shape (ntemps,snktot,bnd)
+  '''
+  arry,attr = data_controller.data_dicts()
+
+  bnd = attr['bnd']
+  eigs = np.abs(arry['E_k'][:,:bnd,ispin])
+  models = tau_models(channels, weights, attr['tau_dict'])
+
   if len(models) == 0:
     # Constant relaxation time approximation with tau = 1
-    tau = np.ones((snktot,bnd,nspin), dtype=float)
+    return np.ones((len(temps),)+eigs.shape, dtype=float)
+
+  ekey = content_key(eigs)
+  mkey = tuple(tau_model_key(m) for m in models)
+  keys = [(mkey,ekey,float(t),ispin) for t in temps]
+
+  taus = {k:tau_cache[k] for k in keys if k in tau_cache}
+  missing = sorted(set(keys)-set(taus), key=keys.index)
+  if len(missing) > 0:
+    mtemps = np.array([k[2] for k in missing], dtype=float)
 
-  else:
     # Compute tau as a harmonic sum of scattering channel contributions.
-    tau = np.zeros((snktot,bnd,nspin), dtype=float)
+    rate = np.zeros((mtemps.size,)+eigs.shape, dtype=float)
     for m in models:
       try:
-        tau += m.weight/m.evaluate(temp, eigs)
+        rate += m.weight/m.evaluate_temps(mtemps, eigs)
       except KeyError as e:
         from .report_exception import report_exception
         print('Ensure that all required parameters are specified in the provided dictionary.')
         report_exception()
         raise e
-    tau = 1/tau
+    taus.update(zip(missing, 1/rate))
+    rate = None
 
-  return tau
+  for k in keys:
+    tau_cache[k] = taus[k]
+    tau_cache.move_to_end(k)
+  while len(tau_cache) > 1 and sum(t.size for t in tau_cache.values()) > max_tau_cache_elems:
+    tau_cache.popitem(last=False)
 
+  return np.array([taus[k] for k in keys])
 
 
-def L_loop ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha, ispin ):
+
+def L_moments ( data_controller, temps, smearing, ene, velkp, taus, ispin, nmoments ):
   from .smearing import gaussian,metpax
-  # We assume tau=1 in the constant relaxation time approximation
+  # Local contribution to the moments
+  #   L_alpha[ij](mu) = sum_kn w_k tau_kn v_i v_j (E_kn-mu)^alpha K(E_kn-mu)
+  # for the independent components ij in t_components. The kernel K is evaluated
+  # once per k-chunk and temperature, and the moments are accumulated as matrix
+  # products with the velocity weights. Returns shape (ntemps,nmoments,6,esize).
 
   arrays,attributes = data_controller.data_dicts()
 
   esize = ene.size
-
   snktot = arrays['E_k'].shape[0]
-
   bnd = attributes['bnd']
   kq_wght = 1./attributes['nkpnts']
   if smearing is not None and smearing != 'gauss' and smearing != 'm-p':
     print('%s Smearing Not Implemented.'%smearing)
     comm.Abort()
 
-  L = np.zeros((3,3,esize), dtype=float)
+  ntemp = len(temps)
+  ncomp = t_components.shape[0]
+  L = np.zeros((ntemp,nmoments,ncomp,esize), dtype=float)
+
+  kchunk = max(1, max_boltz_elems//(bnd*esize))
+  for ks in range(0, snktot, kchunk):
+    ke = min(snktot, ks+kchunk)
+
+    E = arrays['E_k'][ks:ke,:bnd,ispin].reshape(-1,1)
+    dE = E - ene[None,:]
+
+    vel = velkp[ks:ke,:,:bnd,ispin]
+    vv = kq_wght*vel[:,t_components[:,0]]*vel[:,t_components[:,1]]
+    vv = np.moveaxis(vv, 1, 2).reshape(-1, ncomp)
+
+    if smearing is not None:
+      delk = arrays['deltakp'][ks:ke,:bnd,ispin].reshape(-1,1)
+      smearA = (gaussian if smearing=='gauss' else metpax)(E, ene[None,:], delk)
+
+    for iT,temp in enumerate(temps):
+      if smearing is None:
+        with np.errstate(over='ignore'):
+          smearA = 1/(4*temp*(np.cosh(dE/(2*temp))**2))
+
+      W = (vv*taus[iT,ks:ke].reshape(-1,1)).T
+      KA = smearA
+      for alpha in range(nmoments):
+        if alpha > 0:
+          KA = KA*dE
+        L[iT,alpha] += W @ KA
 
-  for n in range(bnd):
-    Eaux = np.reshape(np.repeat(arrays['E_k'][:,n,ispin],esize), (snktot,esize))
-    delk = (np.reshape(np.repeat(arrays['deltakp'][:,n,ispin],esize), (snktot,esize)) if smearing!=None else None)
-    EtoAlpha = np.power(Eaux[:,:]-ene, alpha)
-    if smearing is None:
-      Eaux -= ene
-      smearA = 1/(4*temp*(np.cosh(Eaux/(2*temp))**2))
-    else:
-      if smearing == 'gauss':
-        smearA = gaussian(Eaux, ene, delk)
-      elif smearing == 'm-p':
-        smearA = metpax(Eaux, ene, delk)
-    for l in range(t_tensor.shape[0]):
-      i = t_tensor[l][0]
-      j = t_tensor[l][1]
-      L[i,j,:] += np.sum(kq_wght*arrays['scattering_tau'][:,n,ispin]*velkp[:,i,n,ispin]*velkp[:,j,n,ispin]*(smearA*EtoAlpha).T, axis=1)
-  '''
-  # noise reduction using a running average (correlation function)
-  # Only possible for sigma vs chemical potential
-  win = int(esize*0.025)
-  N = esize
-  for l in range(t_tensor.shape[0]):
-    i = t_tensor[l][0]
-    j = t_tensor[l][1]
-    L[i,j,:] = signal.correlate(L[i,j,:] , np.ones(win), mode='same', method='fft')/win
-  '''
   return L
 
-def L_loop_hall ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha, ispin ):
-  from scipy.constants import hbar
-  from sympy import Eijk
+def L_loop_hall ( data_controller, temp, smearing, ene, velkp, tau, ispin, max_elems=None ):
   from .smearing import gaussian,metpax
-  from os.path import join
+  # Local contribution to the Hall tensor
+  #   L_hall[ijp](mu) = sum_kn w_k tau_kn^2 v_i (M_j x v)_p K(E_kn-mu)
+  # where M_j is row j of the inverse effective mass tensor, i.e. the Levi-Civita
+  # contraction sum_qr eps_pqr M_jq v_r is taken as a cross product. States are
+  # streamed in k-chunks of at most 'max_elems' kernel values.
 
   arrays,attributes = data_controller.data_dicts()
 
   esize = ene.size
-
   snktot = arrays['E_k'].shape[0]
-  bohr2m = 5.29177e-11
-  ev2J = 1.60218e-19
   bnd = attributes['bnd']
-  nspin = attributes['nspin']
   kq_wght = 1./attributes['nkpnts']
   if smearing is not None and smearing != 'gauss' and smearing != 'm-p':
     print('%s Smearing Not Implemented.'%smearing)
     comm.Abort()
+  if max_elems is None:
+    max_elems = max_boltz_elems
+
+  L_hall = np.zeros((27,esize), dtype=float)
+
+  # Components of the symmetric inverse effective mass tensor in d2Ed2k (xx,yy,zz,xy,xz,yz)
+  mind = np.array([[0,3,4],[3,1,5],[4,5,2]], dtype=int)
+
+  kchunk = max(1, max_elems//(bnd*max(esize,27)))
+  for ks in range(0, snktot, kchunk):
+    ke = min(snktot, ks+kchunk)
 
-  L_hall = np.zeros((3,3,3,esize), dtype=float)
-  sig_hall = np.zeros((3,3,3,snktot,bnd,nspin))
-
-  M_inv = np.zeros((3,3,snktot,bnd,nspin))
-  eff_mass_inv = arrays['d2Ed2k']
-  for l in range(t_tensor.shape[0]):
-    i = t_tensor[l][0]
-    j = t_tensor[l][1]
-    if i==j:
-      M_inv[i,j]=eff_mass_inv[i]
-    elif i==0 and j==1:
-      M_inv[i,j]=eff_mass_inv[3]
-      M_inv[j,i]=eff_mass_inv[3]
-    elif i==0 and j==2:
-      M_inv[i,j]=eff_mass_inv[4]
-      M_inv[j,i]=eff_mass_inv[4]
-    elif i==1 and j==2:
-      M_inv[i,j]=eff_mass_inv[5]
-      M_inv[j,i]=eff_mass_inv[5]
-
-  for n in range(bnd):
-    Eaux = np.reshape(np.repeat(arrays['E_k'][:,n,ispin],esize), (snktot,esize))
-    delk = (np.reshape(np.repeat(arrays['deltakp'][:,n,ispin],esize), (snktot,esize)) if smearing!=None else None)
+    E = arrays['E_k'][ks:ke,:bnd,ispin].reshape(-1,1)
     if smearing is None:
-      Eaux -= ene
-      smearA = 1/(4*temp*(np.cosh(Eaux/(2*temp))**2))
+      with np.errstate(over='ignore'):
+        smearA = 1/(4*temp*(np.cosh((E-ene[None,:])/(2*temp))**2))
     else:
-      if smearing == 'gauss':
-        smearA = gaussian(Eaux, ene, delk)
-      elif smearing == 'm-p':
-        smearA = metpax(Eaux, ene, delk)
-    for i in range(3):
-      for j in range(3):
-        for p in range(3):
-          for q in range(3):
-            for r  in range(3):
-              sig_hall[i,j,p,:,n,ispin] += (int(Eijk(p,q,r))*velkp[:,i,n,ispin]*velkp[:,r,n,ispin]*M_inv[j,q,:,n,ispin])
-          L_hall[i,j,p,:] += np.sum(kq_wght*arrays['scattering_tau'][:,n,ispin]**2*sig_hall[i,j,p,:,n,ispin]*(smearA).T, axis=1)
-  return L_hall
+      delk = arrays['deltakp'][ks:ke,:bnd,ispin].reshape(-1,1)
+      smearA = (gaussian if smearing=='gauss' else metpax)(E, ene[None,:], delk)
+
+    # Velocities (m,3) and inverse mass tensors (m,3,3) of the states in this chunk
+    vel = np.moveaxis(velkp[ks:ke,:,:bnd,ispin], 1, 2).reshape(-1,3)
+    M_inv = np.moveaxis(arrays['d2Ed2k'][:,ks:ke,:bnd,ispin], 0, 2).reshape(-1,6)[:,mind]
+
+    sig_hall = vel[:,:,None,None]*np.cross(M_inv, vel[:,None,:])[:,None,:,:]
+    W = kq_wght*tau[ks:ke].reshape(-1,1)**2
+    L_hall += (W*sig_hall.reshape(-1,27)).T @ smearA
+
+  return L_hall.reshape((3,3,3,esize))
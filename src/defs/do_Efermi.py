@@ -24,8 +24,12 @@ from .smearing import intmetpax
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
-def E_Fermi ( Hksp, data_controller, parallel=False ):
+def E_Fermi ( Hksp, data_controller, parallel=False, tetrahedron=None ):
   # Calculate the Fermi energy using a braketing algorithm
+  # With 'tetrahedron' set, the number of states is integrated with the tetrahedron method
+  from .tetrahedron import check_tetrahedron
+
+  check_tetrahedron(tetrahedron)
 
   arry,attr = data_controller.data_dicts()
 
@@ -49,6 +53,18 @@ def E_Fermi ( Hksp, data_controller, parallel=False ):
     else:
       return Efr
 
+  elif tetrahedron is not None:
+    from .tetrahedron import tetrahedra,gather_eigenvalues,tetra_fermi_energy
+
+    # Eigenvalues of the full grid, with shape (nktot,nawf,nspin)
+    eig = np.ascontiguousarray(np.moveaxis(eig, 0, 1))
+    if parallel:
+      eig = gather_eigenvalues(eig, attr['npool'])
+
+    fac = 1 if dftSO else 2
+    tets = tetrahedra(attr['nk1'], attr['nk2'], attr['nk3'], arry['b_vectors'])
+    return tetra_fermi_energy(eig, tets, nelec, fac, parallel)
+
   else:
     Elw = 1.0e+8
     Eup = -1.0e+8
@@ -61,6 +77,10 @@ def E_Fermi ( Hksp, data_controller, parallel=False ):
         Elw = min(Elw,eig[0,kp,ispin])
         Eup = max(Elw,eig[nmbnd,kp,ispin])
 
+    if parallel:
+      Elw = comm.allreduce(Elw, op=MPI.MIN)
+      Eup = comm.allreduce(Eup, op=MPI.MAX)
+
     Eup = Eup + 2 * degauss
     Elw = Elw - 2 * degauss
 
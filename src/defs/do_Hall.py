@@ -24,8 +24,8 @@ from mpi4py import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
-def do_spin_Hall ( data_controller, twoD, do_ac ):
-  from .perturb_split import perturb_split
+def do_spin_Hall ( data_controller, twoD, do_ac, kramerskronig=False ):
+  from .perturb_split import perturb_split_batch
   from .constants import ELECTRONVOLT_SI,ANGSTROM_AU,H_OVER_TPI,LL
 
   arry,attr = data_controller.data_dicts()
@@ -53,12 +53,12 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
     #----------------------------------------------
     jdHksp = do_spin_current(data_controller, spol, ipol)
 
-    jksp_is = np.empty_like(jdHksp)
-    pksp_j = np.empty_like(jdHksp)
+    nbnd = arry['v_k'].shape[2]
+    jksp_is = np.empty((jdHksp.shape[0],nbnd,nbnd,jdHksp.shape[3]), dtype=complex)
+    pksp_j = np.empty_like(jksp_is)
 
-    for ik in range(jdHksp.shape[0]):
-      for ispin in range(jdHksp.shape[3]):
-        jksp_is[ik,:,:,ispin],pksp_j[ik,:,:,ispin] = perturb_split(jdHksp[ik,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+    for ispin in range(jdHksp.shape[3]):
+      jksp_is[:,:,:,ispin],pksp_j[:,:,:,ispin] = perturb_split_batch(jdHksp[:,:,:,ispin], arry['dHksp'][:,jpol,:,:,ispin], arry['v_k'][:,:,:,ispin], arry['degen'][ispin])
     jdHksp = None
 
     #---------------------------------
@@ -94,15 +94,14 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
 
       jdHksp = do_spin_current(data_controller, spol, ipol)
 
-      jksp_js = np.empty_like(jdHksp)
-      pksp_i = np.empty_like(jdHksp)
+      jksp_js = np.empty((jdHksp.shape[0],nbnd,nbnd,jdHksp.shape[3]), dtype=complex)
+      pksp_i = np.empty_like(jksp_js)
 
-      for ik in range(jdHksp.shape[0]):
-        for ispin in range(jdHksp.shape[3]):
-          jksp_js[ik,:,:,ispin],pksp_i[ik,:,:,ispin] = perturb_split(jdHksp[ik,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+      for ispin in range(jdHksp.shape[3]):
+        jksp_js[:,:,:,ispin],pksp_i[:,:,:,ispin] = perturb_split_batch(jdHksp[:,:,:,ispin], arry['dHksp'][:,jpol,:,:,ispin], arry['v_k'][:,:,:,ispin], arry['degen'][ispin])
       jdHksp = None
 
-      ene,sigxy = do_ac_conductivity(data_controller, jksp_js, pksp_i, ipol, jpol)
+      ene,sigxy = do_ac_conductivity(data_controller, jksp_js, pksp_i, ipol, jpol, kramerskronig)
       if rank == 0:
         sigxy *= cgs_conv
 
@@ -117,8 +116,8 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
       data_controller.write_file_row_col(fsigR, ene, sigxyr)
 
 
-def do_anomalous_Hall ( data_controller, do_ac ):
-  from .perturb_split import perturb_split
+def do_anomalous_Hall ( data_controller, do_ac, kramerskronig=False ):
+  from .perturb_split import perturb_split_batch
   from .constants import ELECTRONVOLT_SI,ANGSTROM_AU,H_OVER_TPI,LL
 
   arry,attr = data_controller.data_dicts()
@@ -142,13 +141,13 @@ def do_anomalous_Hall ( data_controller, do_ac ):
     jpol = a_tensor[n][1]
 
     dks = arry['dHksp'].shape
+    nbnd = arry['v_k'].shape[2]
 
-    pksp_i = np.zeros((dks[0],dks[2],dks[3],dks[4]),order="C",dtype=complex)
+    pksp_i = np.zeros((dks[0],nbnd,nbnd,dks[4]),order="C",dtype=complex)
     pksp_j = np.zeros_like(pksp_i)
 
-    for ik in range(dks[0]):
-      for ispin in range(dks[4]):
-        pksp_i[ik,:,:,ispin],pksp_j[ik,:,:,ispin] = perturb_split(arry['dHksp'][ik,ipol,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+    for ispin in range(dks[4]):
+      pksp_i[:,:,:,ispin],pksp_j[:,:,:,ispin] = perturb_split_batch(arry['dHksp'][:,ipol,:,:,ispin], arry['dHksp'][:,jpol,:,:,ispin], arry['v_k'][:,:,:,ispin], arry['degen'][ispin])
 
     ene,ahc,Om_k = do_Berry_curvature(data_controller, pksp_i, pksp_j)
 
@@ -174,7 +173,7 @@ def do_anomalous_Hall ( data_controller, do_ac ):
     ene = ahc = None
 
     if do_ac:
-      ene,sigxy = do_ac_conductivity(data_controller, pksp_i, pksp_j, ipol, jpol)
+      ene,sigxy = do_ac_conductivity(data_controller, pksp_i, pksp_j, ipol, jpol, kramerskronig)
       if rank == 0:
         sigxy *= cgs_conv
 
@@ -246,7 +245,7 @@ def do_Berry_curvature ( data_controller, jksp, pksp ):
 
   return(ene, shc, Om_zk)
 
-def do_ac_conductivity ( data_controller, jksp, pksp, ipol, jpol ):
+def do_ac_conductivity ( data_controller, jksp, pksp, ipol, jpol, kramerskronig=False ):
   from .communication import gather_full
   from .smearing import intgaussian, intmetpax
 
@@ -278,6 +277,10 @@ def do_ac_conductivity ( data_controller, jksp, pksp, ipol, jpol ):
 
   if rank == 0:
     sigxy = (sigxyR+1j*sigxyI)/float(attr['nkpnts'])
+    if kramerskronig:
+      from .kramers_kronig import kk_real
+      # Dispersive part from the absorptive part, consistent with causality
+      sigxy = kk_real(ene, sigxyI/float(attr['nkpnts'])) + 1j*np.imag(sigxy)
     return(ene, sigxy)
   else:
     return(None, None)
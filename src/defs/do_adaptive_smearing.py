@@ -29,10 +29,9 @@ def do_adaptive_smearing ( data_controller, smearing ):
 
   a_vectors = arrays['a_vectors']
 
-  nawf = attributes['nawf']
   nspin = attributes['nspin']
   nkpnts = attributes['nkpnts']
-  npks = arrays['pksp'].shape[0]
+  npks,_,nawf,_,_ = arrays['pksp'].shape
 
   diag = np.diag_indices(nawf)
 
@@ -46,16 +46,20 @@ def read_pswfc_from_upf(data_controller, atom):
     
   raise RuntimeError('atom not found')
   
+# Maximum number of Bessel function values held in memory at once
+max_radial_elems = 2**22
+
 def radialfft_simpson(r, f, l, qmesh, volume):
   fq = np.zeros_like(qmesh)
   fact = 4.0*np.pi / np.sqrt(volume)
   
   f[r > 10.0] = 0.0
-  for iq in range(len(qmesh)):
-    q = qmesh[iq]
-    bess = scipy.special.spherical_jn(l, r*q)
-    aux = f * bess * r
-    fq[iq] = scipy.integrate.simps(aux, r)*fact
+  aux = f * r
+  # Bessel transform for blocks of q points at once
+  nq = max(1, max_radial_elems//len(r))
+  for iq in range(0, len(qmesh), nq):
+    bess = scipy.special.spherical_jn(l, np.outer(qmesh[iq:iq+nq], r))
+    fq[iq:iq+nq] = scipy.integrate.simpson(bess*aux, x=r, axis=1)*fact
   return fq
 
 
@@ -103,10 +107,14 @@ def build_pswfc_basis_all(data_controller):
   # loop over atoms
   basis,shells = [],{}
   arry['jchia'] = {}
+  # pseudopotentials and radial form factors, per species and shell
+  upfs,form_factors = {},{}
   for na in range(len(arry['atoms'])):
     atom = arry['atoms'][na]
     tau = arry['tau'][na]
-    r, pswfc, pseudo = read_pswfc_from_upf(data_controller, atom)
+    if atom not in upfs:
+      upfs[atom] = read_pswfc_from_upf(data_controller, atom)
+    r, pswfc, pseudo = upfs[atom]
     if verbose and rank == 0:
       print('atom: {0:2s}  pseudo: {1:30s}  tau: {2}'.format(atom, pseudo, tau))
       
@@ -115,7 +123,7 @@ def build_pswfc_basis_all(data_controller):
     jchia = []
 
     s = 0.5
-    for pao in pswfc:
+    for ipao,pao in enumerate(pswfc):
       l = 'SPDF'.find(pao['label'][1].upper())
       assert l != -1
 
@@ -127,7 +135,9 @@ def build_pswfc_basis_all(data_controller):
          jchia.append(l-s)
          s = -s
 
-      wfc_g = radialfft_simpson(r, pao['wfc'], l, qmesh, volume)
+      if (atom,ipao) not in form_factors:
+        form_factors[(atom,ipao)] = radialfft_simpson(r, pao['wfc'], l, qmesh, volume)
+      wfc_g = form_factors[(atom,ipao)]
       
       for m in range(1, 2*l+2):
         basis.append({'atom': atom, 'tau': tau, 'l': l, 'm': m, 'label': pao['label'],
@@ -180,6 +190,8 @@ def build_aewfc_basis(data_controller):
   # loop over atoms
   basis,shells = [],{}
   arry['jchia'] = {}
+  # radial form factors, per species and shell
+  form_factors = {}
   for na in range(len(arry['atoms'])):
     atom = arry['atoms'][na]
     tau = arry['tau'][na]
@@ -206,7 +218,9 @@ def build_aewfc_basis(data_controller):
              jchia.append(l-0.5)
              jchia.append(l+0.5)
 
-      wfc_g = radialfft_simpson(aewfc[n]['r'], aewfc[n][list(aewfc[n].items())[0][0]], l, qmesh, volume)
+      if (atom,n) not in form_factors:
+        form_factors[(atom,n)] = radialfft_simpson(aewfc[n]['r'], aewfc[n][list(aewfc[n].items())[0][0]], l, qmesh, volume)
+      wfc_g = form_factors[(atom,n)]
 
       twice = 1
       if attr['dftSO']: twice = 2
@@ -328,36 +342,27 @@ def read_QE_wfc(data_controller, ik, ispin):
     mill = f.read_ints(np.int32).reshape(3,igwx,order='F')
     #print('mill.shape = ', mill.shape)
     
-    wfc = []
-    for i in range(nbnd):
-      wfc.append(f.read_reals(np.complex128))
+    wfc = np.array([f.read_reals(np.complex128) for i in range(nbnd)])
   
   # compute overlap
-  ovp = np.zeros((nbnd,nbnd),dtype=complex)
-  for n in range(nbnd):
-    for m in range(nbnd):
-      ovp[n,m] = np.sum(np.conj(wfc[n]).dot(wfc[m]))
-  eigs, eigv = np.linalg.eigh(ovp)
+  ovp = np.conj(wfc) @ wfc.T
+  eigs = np.linalg.eigvalsh(ovp)
   assert (np.all(eigs>=0))
 
   X = scipy.linalg.sqrtm(ovp)
   owfc = np.linalg.solve(X.T, wfc) 
   
-  wfc = np.array(wfc) * scalef
+  wfc = wfc * scalef
   gkspace = { 'xk': xk, 'igwx': igwx, 'mill': mill, 'bg': bg, 'gamma_only': gamma_only }
   return gkspace, { 'wfc': owfc, 'npol': npol, 'nbnd': nbnd, 'ispin': ispin }
 
 
 def calc_ylmg(k_plus_G, q):
     # cubic harmonics: build the angular part, no spin orbit
-    kGx = np.zeros_like(q)
-    kGy = np.zeros_like(q)
-    kGz = np.zeros_like(q)
-    for ig in range(len(q)):
-      if abs(q[ig]) > 1e-6:
-        kGx[ig] = k_plus_G[ig,0] / q[ig]
-        kGy[ig] = k_plus_G[ig,1] / q[ig]
-        kGz[ig] = k_plus_G[ig,2] / q[ig]
+    kG = np.zeros_like(k_plus_G)
+    nz = np.abs(q) > 1e-6
+    kG[nz] = k_plus_G[nz] / q[nz,None]
+    kGx,kGy,kGz = kG.T
     
     lmax = 3
     ylmg = np.zeros((len(q), (lmax+1)*(lmax+1)))
@@ -397,7 +402,7 @@ def calc_ylmg(k_plus_G, q):
 
 def calc_ylmg_complex_0(ylmg):
     # complex spherical harmonics
-    ylmgc = np.zeros_like(ylmg, np.complex)
+    ylmgc = np.zeros_like(ylmg, complex)
 
     sqrt2 = np.sqrt(2.0)
 
@@ -440,7 +445,7 @@ def calc_ylmg_so(ylmgc):
     # spinor spherical harmonics
     npw = ylmgc.shape[0]
     nylm = ylmgc.shape[1]
-    ylmgso = np.zeros((2*npw,2*nylm), np.complex)
+    ylmgso = np.zeros((2*npw,2*nylm), complex)
     sqrt = np.sqrt
 
     # generated automatically by cb.py
@@ -546,17 +551,15 @@ def calc_ylmg_so(ylmgc):
 
 def calc_atwfc_k(basis, gkspace, dftSO=False):
   # construct atomic wfc at k
-  atwfc_k = []
   natwfc = len(basis)
   
   xk, igwx, mill, bg, gamma_only = [gkspace[s] for s in ('xk', 'igwx', 'mill', 'bg', 'gamma_only')]
-  #print('xk=', xk)
   
-  # build k+G vectors
-  hkl = mill.T
-  k_plus_G = np.dot(hkl, bg.T)
-  for ig in range(igwx):
-      k_plus_G[ig,:] += xk
+  # build k+G vectors (unless already provided by calc_gkspace)
+  if 'k_plus_G' in gkspace:
+    k_plus_G = gkspace['k_plus_G']
+  else:
+    k_plus_G = np.dot(mill.T, bg.T) + xk
 
   # pre-calculate spherical harmonics
   q = np.linalg.norm(k_plus_G, axis=1)
@@ -564,66 +567,51 @@ def calc_atwfc_k(basis, gkspace, dftSO=False):
   if dftSO:
       ylmgc = calc_ylmg_complex_0(ylmg)
       ylmgso = calc_ylmg_so(ylmgc)
- 
-  # loop over atoms 
-  for i in range(natwfc):
-    # 1. build the structure factor
-    strf = np.zeros((igwx,), dtype=complex)
-    tau = basis[i]['tau']
-    k_plus_G_dot_tau = np.dot(k_plus_G, tau)
-    strf = np.exp(-1j*k_plus_G_dot_tau)
-    
-    # 2. build the form factor
-    qmesh, wfc_g = basis[i]['qmesh'], basis[i]['wfc_g']
-    #fact = InterpolatedUnivariateSpline(qmesh, wfc_g)(q)
-    fact = scipy.interpolate.interp1d(qmesh, wfc_g, kind='linear')(q)
-    
-    # 3. build the angular part
-    l, m = basis[i]['l'], basis[i]['m']
-    if l > 3: raise NotImplementedError('l>3 not implemented yet')
-    lm = l*l + (m-1)
-    if dftSO:
-        jm = basis[i]['jm']
-
-    # 4. final
-    if not dftSO:
-        atwfc = strf * fact * ylmg[:,lm] * (1.0j)**l
-    else:
-        atwfc = np.hstack((strf,strf)) * np.hstack((fact,fact)) * ylmgso[:,jm] * (1.0j)**l
- 
-    atwfc_k.append(atwfc)
+
+  l = np.array([b['l'] for b in basis])
+  if np.any(l > 3): raise NotImplementedError('l>3 not implemented yet')
+
+  # 1. build the structure factors, once per atomic position
+  taus,iatom = np.unique(np.array([b['tau'] for b in basis]), axis=0, return_inverse=True)
+  strf = np.exp(-1j*np.dot(k_plus_G, taus.T)).T
+
+  # 2. build the form factors, once per radial function
+  ishell,radial = np.empty(natwfc, dtype=int),{}
+  for i,b in enumerate(basis):
+    ishell[i] = radial.setdefault(id(b['wfc_g']), len(radial))
+  fact = np.empty((len(radial),igwx))
+  for i,b in enumerate(basis):
+    fact[ishell[i]] = np.interp(q, b['qmesh'], b['wfc_g'])
+
+  radial_k = strf[iatom.ravel()] * fact[ishell] * ((1.0j)**l)[:,None]
+
+  # 3. build the angular part and 4. final
+  if not dftSO:
+    lm = l*l + (np.array([b['m'] for b in basis])-1)
+    atwfc_k = radial_k * ylmg.T[lm]
+  else:
+    jm = np.array([b['jm'] for b in basis])
+    atwfc_k = np.hstack((radial_k,radial_k)) * ylmgso.T[jm]
     
-  return np.array(atwfc_k)
+  return atwfc_k
 
 
 
 def ortho_atwfc_k(atwfc_k):
   # orthonormalize atwfcs
   natwfc = atwfc_k.shape[0]
-  ovp = np.zeros((natwfc, natwfc), dtype=np.complex)
+  ovp = np.dot(np.conj(atwfc_k), atwfc_k.T)
   
-  for i in range(natwfc):
-    for j in range(natwfc):
-      ovp[i,j] = np.dot(np.conj(atwfc_k[i]), atwfc_k[j])
-      
-      # check that eigenvalues are positive
-  eigs, eigv = np.linalg.eigh(ovp)
+  # check that eigenvalues are positive
+  eigs = np.linalg.eigvalsh(ovp)
   assert (np.all(eigs>=0))
   
   # orthogonalize
-  if True:
-    X = scipy.linalg.sqrtm(ovp)
-    oatwfc_k = np.linalg.solve(X.T, atwfc_k)
-  else:
-    eigs = 1.0/np.sqrt(eigs)
-    X = np.dot(np.conj(eigv), np.dot(np.diag(eigs), eigv.T))
-    oatwfc_k = np.dot(X, atwfc_k)
+  X = scipy.linalg.sqrtm(ovp)
+  oatwfc_k = np.linalg.solve(X.T, atwfc_k)
     
-    # check ortonormalization
-  oovp = np.zeros((natwfc, natwfc), dtype=np.complex)
-  for i in range(natwfc):
-    for j in range(natwfc):
-      oovp[i,j] = np.dot(np.conj(oatwfc_k[i]), oatwfc_k[j])
+  # check ortonormalization
+  oovp = np.dot(np.conj(oatwfc_k), oatwfc_k.T)
       
   diff = np.linalg.norm(oovp - np.eye(natwfc))
   if np.abs(diff) > 1e-4:
@@ -635,48 +623,83 @@ def ortho_atwfc_k(atwfc_k):
 def calc_proj_k(data_controller, basis, ik, ispin):
   arry, attr = data_controller.data_dicts()
   gkspace, wfc = read_QE_wfc(data_controller, ik, ispin)
-  atwfc_k = calc_atwfc_k(basis, gkspace, attr['dftSO'])
+  return proj_k_from_wfc(basis, gkspace, wfc, attr['dftSO'])
+
+
+def proj_k_from_wfc(basis, gkspace, wfc, dftSO=False):
+  atwfc_k = calc_atwfc_k(basis, gkspace, dftSO)
   oatwfc_k = ortho_atwfc_k(atwfc_k)
   proj_k = np.dot(np.conj(oatwfc_k), wfc['wfc'].T)
   return (proj_k.T)
 
 
-def calc_gkspace(data_controller,ik,gamma_only=False):
+def iter_proj_k(data_controller, basis, iks, ispin):
+  # Yield (ik, projections) for the k points in iks. The wavefunction file of
+  # the next k point is read in a background thread while the current one is projected.
+  from concurrent.futures import ThreadPoolExecutor
+
   arry, attr = data_controller.data_dicts()
-  # calculate sphere of Miller indeces for k + G
+  iks = list(iks)
+  if len(iks) == 0:
+    return
+
+  with ThreadPoolExecutor(max_workers=1) as pool:
+    nxt = pool.submit(read_QE_wfc, data_controller, iks[0], ispin)
+    for i,ik in enumerate(iks):
+      gkspace, wfc = nxt.result()
+      if i+1 < len(iks):
+        nxt = pool.submit(read_QE_wfc, data_controller, iks[i+1], ispin)
+      yield ik, proj_k_from_wfc(basis, gkspace, wfc, attr['dftSO'])
+
+
+def calc_gsphere(data_controller):
+  # Miller indices (3,ng) of the G vectors within the ecutrho sphere.
+  # The sphere is built once per run and kept in arry['mill_g'].
+  arry, attr = data_controller.data_dicts()
+  if 'mill_g' in arry:
+    return arry['mill_g']
+
   gcutm = attr['ecutrho'] / (2*np.pi/attr['alat'])**2
   at = arry['a_vectors']
+  bv = arry['b_vectors']
   nx = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,0]**2 + at[1,0]**2 + at[2,0]**2)) + 1
   ny = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,1]**2 + at[1,1]**2 + at[2,1]**2)) + 1
   nz = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,2]**2 + at[1,2]**2 + at[2,2]**2)) + 1
   nx = int((nx+1)/2)
   ny = int((ny+1)/2)
   nz = int((nz+1)/2)
-  # sphere of Miller indeces 
+
+  # sphere of Miller indeces, one plane of constant i at a time
+  j,k = np.meshgrid(np.arange(-ny,ny+1), np.arange(-nz,nz+1), indexing='ij')
+  jk = np.column_stack((j.ravel(),k.ravel()))
+  G_jk = jk @ bv[1:]
   mill_g = []
   for i in range(-nx, nx+1):
-    for j in range(-ny, ny+1):
-      for k in range(-nz, nz+1):
-        k_plus_G = np.array([i,j,k]) @ arry['b_vectors']
-        if np.linalg.norm(k_plus_G)**2 <= attr['ecutrho']/(2*np.pi/attr['alat'])**2:
-          mill_g.append(np.array([i,j,k]))
-  mill_g = np.swapaxes(np.array(mill_g),1,0)
-  igwx_g = mill_g.shape[1]
-  
-  mill = []
-  for ig in range(igwx_g):
-    k_plus_G = mill_g[:,ig]@arry['b_vectors'] + arry['kgrid'][:,ik]
-    if np.linalg.norm(k_plus_G)**2 <= attr['ecutwfc']/(2*np.pi/attr['alat'])**2:
-      mill.append(mill_g[:,ig])
-  mill = np.swapaxes(np.array(mill),1,0)
+    G = G_jk + i*bv[0]
+    inside = np.sum(G*G, axis=1) <= gcutm
+    mill_g.append(np.column_stack((np.full(np.count_nonzero(inside),i), jk[inside])))
+  arry['mill_g'] = np.ascontiguousarray(np.concatenate(mill_g).T)
+
+  return arry['mill_g']
+
+
+def calc_gkspace(data_controller,ik,gamma_only=False):
+  arry, attr = data_controller.data_dicts()
+  # calculate sphere of Miller indeces for k + G
+  mill_g = calc_gsphere(data_controller)
+
+  # G vectors of the sphere within the ecutwfc cutoff around k
+  k_plus_G = mill_g.T @ arry['b_vectors'] + arry['kgrid'][:,ik]
+  inside = np.sum(k_plus_G*k_plus_G, axis=1) <= attr['ecutwfc']/(2*np.pi/attr['alat'])**2
+  mill = mill_g[:,inside]
   igwx = mill.shape[1]
   
   xk = arry['kgrid'][:,ik] * 2*np.pi/attr['alat']
   
   bg = arry['b_vectors'].T*2*np.pi/attr['alat']
   
-  names = ['xk','igwx','mill','bg','gamma_only']
-  arrays = [xk,igwx,mill,bg,gamma_only]
+  names = ['xk','igwx','mill','bg','gamma_only','k_plus_G']
+  arrays = [xk,igwx,mill,bg,gamma_only,k_plus_G[inside]*2*np.pi/attr['alat']]
   gkspace = dict(zip(names,arrays))
   arry['gkspace'] = gkspace
   
@@ -22,26 +22,21 @@ import scipy.linalg as la
 from numpy import linalg as npl
 from .constants import ANGSTROM_AU
 
+# Maximum number of complex elements of H(k) or exp(ik.R) held at once on each rank
+max_berry_elems = 2**24
+
 def do_berry_phase (self):
 
   import os
 
   arry,attr = self.data_controller.data_dicts()
 
-  occupied = attr['berry_occupied']
-  sub = arry['berry_sub']
   contin = attr['berry_contin']
   fname = attr['berry_fname']
 
   kxlim = arry['berry_kxlim']
   kylim = arry['berry_kylim']
 
-  if occupied:
-    ovr_ndim = int(attr['nelec'])
-  elif sub != None:
-    ovr_ndim = len(sub)
-  else: ovr_ndim = arry['HRs'].shape[0]
-
   if attr['berry_kspace_method'] == 'path':
     # Calculate the bands
     do_berry_bands(self.data_controller)
@@ -59,36 +54,35 @@ def do_berry_phase (self):
     else: self.data_controller.write_bands(fname, phase)
 
   elif attr['berry_kspace_method'] == 'track':
+    from mpi4py import MPI
+
+    rank = MPI.COMM_WORLD.Get_rank()
 
     nk1,nk2 = attr['berry_nk1'],attr['berry_nk2']
-    kpath_funct = attr['berry_kpath_funct']
     kpts = np.linspace(0.0,1.0,nk2)
 
-    if not attr['berry_eigvals']:
-      phase = np.zeros(kpts.shape[0])
-    else:
-      phase = np.zeros((kpts.shape[0],ovr_ndim))
-
-    for ik,k in enumerate(kpts):
-      attr['berry_path'],arry['berry_high_sym_points'] = kpath_funct(k)
-
-      do_berry_bands(self.data_controller)
-      phase[ik] = do_phase(self.data_controller)
+    phase = berry_track(self.data_controller, kpts, attr['berry_nthreads'])
 
     if not attr['berry_eigvals']:
 
       if contin: phase = berry_phase_cont(phase,phase[0])
       phase -= phase[0]
 
-      with open(os.path.join(attr['opath'],fname+'.dat'), 'w') as f:
-        f.write('# k\tphi\n')
-        for ik,k in enumerate(kpts):
-          f.write(f'{k: 2.6f}\t{phase[ik]: 2.6f}\n')
+      if rank == 0:
+        with open(os.path.join(attr['opath'],fname+'.dat'), 'w') as f:
+          f.write('# k\tphi\n')
+          for ik,k in enumerate(kpts):
+            f.write(f'{k: 2.6f}\t{phase[ik]: 2.6f}\n')
     else:
 
       if contin: phase = berry_eigvals_cont(phase,phase[0,:])
 
-      self.data_controller.write_berry_bands(fname,phase)
+      # Wilson loop eigenphases (hybrid Wannier centers) of each loop
+      if rank == 0:
+        with open(os.path.join(attr['opath'],fname+'.dat'), 'w') as f:
+          f.write('# k\tphi_1 ... phi_n\n')
+          for ik,k in enumerate(kpts):
+            f.write('\t'.join([f'{k: 2.6f}']+[f'{p: 2.6f}' for p in phase[ik]])+'\n')
 
     arry['berry_phase'] = phase
 
@@ -127,6 +121,9 @@ def do_berry_phase (self):
       f.write(f'Berry phase: {phase: 2.6f} \n')
 
   elif attr['berry_kspace_method'] == 'square':
+    from mpi4py import MPI
+
+    rank = MPI.COMM_WORLD.Get_rank()
 
     nk1 = attr['berry_nk1']
     nk2 = attr['berry_nk2']
@@ -138,27 +135,17 @@ def do_berry_phase (self):
     ky_points = np.linspace(kylim[0],kylim[1],nk2)
 
     kpts = np.zeros((nk1,nk2,3))
-    kgrid_centers = np.zeros((nk1-1,nk2-1,3))
-    phases = np.zeros((nk1-1,nk2-1))
-
-    for jk in range(nk2):
-      for ik in range(nk1):
-        kpts[ik,jk] = [kx_points[ik],ky_points[jk],0]
-
-    for jk in range(nk2-1):
-      for ik in range(nk1-1):
+    kpts[:,:,0] = kx_points[:,None]
+    kpts[:,:,1] = ky_points[None,:]
 
-        k00 = kpts[ik,jk]
-        k10 = kpts[ik+1,jk]
-        k11 = kpts[ik+1,jk+1]
-        k01 = kpts[ik,jk+1]
+    # mean of the closed loop k00,k10,k11,k01,k00 around each plaquette
+    kgrid_centers = (2*kpts[:-1,:-1]+kpts[1:,:-1]+kpts[1:,1:]+kpts[:-1,1:])/5
 
-        arry['berry_kq'] = np.array([k00,k10,k11,k01,k00]).T
-        arry['berry_contour'] = np.copy(arry['berry_kq'])
-        kgrid_centers[ik,jk] = np.array([k00,k10,k11,k01,k00]).mean(axis=0)
+    zak = None
+    if attr['berry_method'] == 'zak':
+      zak = zak_phase(self.data_controller, kpts[1,0]-kpts[0,0])
 
-        do_berry_bands(self.data_controller)
-        phases[ik,jk] = do_phase(self.data_controller)
+    phases = berry_flux_square(self.data_controller, kpts, berry_subspace(self.data_controller), zak)
 
     arry['berry_kgrid'] = kpts
     arry['berry_kgrid_centers'] = kgrid_centers
@@ -171,20 +158,119 @@ def do_berry_phase (self):
     arry['berry_phase'] = phases
     attr['berry_flux'] = arry['berry_phase'].sum()
 
-    with open(os.path.join(attr['opath'],fname+'.dat'), 'w') as f:
-      f.write(f'# xlim: ({kpts[0,0,0]},{kpts[-1,0,0]}); ylim: ({kpts[0,0,1]},{kpts[0,-1,1]})\n')
-      f.write(f'# phases with shape: ({nk1-1},{nk2-1})\n')
-      f.write(f'# kx,ky are mesh centers\n')
-      f.write( '# kx\tky\tphi\n')
-      for jk in range(nk2-1):
-        for ik in range(nk1-1):
-          f.write(f'{kgrid_centers[ik,jk][0]: 2.12f}\t{kgrid_centers[ik,jk][1]: 2.12f}\t{phases[ik,jk]: 2.12f}\n')
+    if rank == 0:
+      with open(os.path.join(attr['opath'],fname+'.dat'), 'w') as f:
+        f.write(f'# xlim: ({kpts[0,0,0]},{kpts[-1,0,0]}); ylim: ({kpts[0,0,1]},{kpts[0,-1,1]})\n')
+        f.write(f'# phases with shape: ({nk1-1},{nk2-1})\n')
+        f.write(f'# kx,ky are mesh centers\n')
+        f.write( '# kx\tky\tphi\n')
+        for jk in range(nk2-1):
+          for ik in range(nk1-1):
+            f.write(f'{kgrid_centers[ik,jk][0]: 2.12f}\t{kgrid_centers[ik,jk][1]: 2.12f}\t{phases[ik,jk]: 2.12f}\n')
+
+      with open(os.path.join(attr['opath'],fname+'_kgrid_corners.dat'), 'w') as f:
+        f.write( '# kx\tky\n')
+        for jk in range(nk2):
+          for ik in range(nk1):
+            f.write(f'{kpts[ik,jk][0]: 2.12f}\t{kpts[ik,jk][1]: 2.12f}\n')
+
+
+def berry_subspace ( data_controller ):
+  # Indices of the bands spanning the subspace of the Berry phase
+  arry,attr = data_controller.data_dicts()
+
+  if attr['berry_occupied']:
+    return np.arange(0,attr['nelec'],1,dtype=int)
+  elif not arry['berry_sub'] is None:
+    return np.array(arry['berry_sub'],dtype=int)
+  return np.arange(0,arry['HRs'].shape[0],1,dtype=int)
+
+
+def zak_phase ( data_controller, axis ):
+  # Bloch phase exp(-iG.r) of each orbital for the reciprocal lattice vector along 'axis' (crystal coordinates)
+  arry,attr = data_controller.data_dicts()
+
+  alat = attr['alat'] / ANGSTROM_AU
+  b_vectors = arry['b_vectors'] * (1/alat)
+
+  axis = axis/np.dot(axis.T,axis) ** 0.5
+  G = np.dot(axis,b_vectors) * 2 * np.pi
+
+  orb_sites = np.repeat(arry['tau'],arry['naw'],axis=0)
+
+  return np.dot(orb_sites, G)
+
+
+def link_phase ( A, B ):
+  # U(1) link variables det(A^+ B)/|det(A^+ B)| between stacks of subspaces A and B
+  return np.linalg.slogdet(np.conj(np.swapaxes(A,-1,-2)) @ B)[0]
+
+
+def berry_flux_square ( data_controller, kpts, occ_idx, zak=None ):
+  '''
+  Berry phase of every plaquette of a 2D grid of k points, from the link variables
+  of the selected subspace (T. Fukui, Y. Hatsugai and H. Suzuki, J. Phys. Soc. Jpn. 74, 1674 (2005)).
+  The corners are distributed over the ranks and diagonalized once, the eigenvectors
+  of the subspace are gathered on every rank and the links are computed in batches.
+  Only the first spin channel is used, as in do_phase.
+
+  Arguments:
+      kpts (ndarray): Corners of the grid in crystal coordinates, with shape (nk1,nk2,3)
+      occ_idx (ndarray): Indices of the bands spanning the subspace
+      zak (ndarray): (optional) Bloch phase of each orbital (zak_phase), closing each plaquette as in do_phase with method 'zak'
+
+  Returns:
+      phases (ndarray): Berry phase of each plaquette with shape (nk1-1,nk2-1), on every rank
+  '''
+  from mpi4py import MPI
+  from .communication import load_balancing,load_sizes
+  from .get_R_grid_fft import get_R_grid_fft
+
+  comm = MPI.COMM_WORLD
+  rank,size = comm.Get_rank(),comm.Get_size()
+
+  arry,attr = data_controller.data_dicts()
+
+  nawf,_,nr1,nr2,nr3,nspin = arry['HRs'].shape
+  nk1,nk2 = kpts.shape[:2]
+  nkt = nk1*nk2
+  dim = occ_idx.shape[0]
+
+  get_R_grid_fft(data_controller, nr1, nr2, nr3)
+
+  # Eigenvectors of the subspace at this rank's corners
+  kq = np.reshape(kpts, (nkt,3)) @ arry['b_vectors']
+  ini,end = load_balancing(size, rank, nkt)
+  kchunk = max(1, max_berry_elems//max(nr1*nr2*nr3,nawf*nawf*nspin))
+
+  V = np.empty((end-ini,nawf,dim), dtype=complex)
+  for ks in range(ini, end, kchunk):
+    ke = min(end, ks+kchunk)
+    Hk = np.moveaxis(band_loop_H(data_controller, kq[ks:ke].T)[:,:,:,0], 2, 0)
+    V[ks-ini:ke-ini] = np.linalg.eigh(Hk, UPLO='U')[1][:,:,occ_idx]
+  Hk = None
 
-    with open(os.path.join(attr['opath'],fname+'_kgrid_corners.dat'), 'w') as f:
-      f.write( '# kx\tky\n')
-      for jk in range(nk2):
-        for ik in range(nk1):
-          f.write(f'{kpts[ik,jk][0]: 2.12f}\t{kpts[ik,jk][1]: 2.12f}\n')
+  sizes = load_sizes(size, nkt, nawf*dim)
+  Vall = np.empty((nkt,nawf,dim), dtype=complex)
+  comm.Allgatherv(V, [Vall,sizes[:,0],sizes[:,1],MPI.DOUBLE_COMPLEX])
+  Vall = np.reshape(Vall, (nk1,nk2,nawf,dim))
+  V = None
+
+  # Plaquettes k00,k10,k11,k01 of this rank's rows
+  ini,end = load_balancing(size, rank, nk1-1)
+  Ux = link_phase(Vall[ini:end], Vall[ini+1:end+1])
+  Uy = link_phase(Vall[ini:end+1,:-1], Vall[ini:end+1,1:])
+  flux = Ux[:,:-1] * Uy[1:] * np.conj(Ux[:,1:]) * np.conj(Uy[:-1])
+
+  if zak is not None:
+    V00 = Vall[ini:end,:-1]
+    flux *= link_phase(V00*np.exp(-1j*zak)[:,None], V00)
+
+  sizes = load_sizes(size, nk1-1, nk2-1)
+  phases = np.empty((nk1-1,nk2-1), dtype=float)
+  comm.Allgatherv(np.ascontiguousarray(-np.angle(flux)), [phases,sizes[:,0],sizes[:,1],MPI.DOUBLE])
+
+  return phases
 
 
 def do_phase (data_controller):
@@ -192,23 +278,11 @@ def do_phase (data_controller):
   arry,attr = data_controller.data_dicts()
     
   v_kp = arry['berry_v_k']
-  E_kp = arry['berry_E_k']
-
-  nkpts = v_kp.shape[0]
 
   berry_eigvals = attr['berry_eigvals']
 
   closed = attr['berry_closed']
   method = attr['berry_method']
-  sub = arry['berry_sub']
-  occupied = attr['berry_occupied']
-
-  alat = attr['alat'] / ANGSTROM_AU
-  a_vectors = arry['a_vectors'] * alat
-  b_vectors = arry['b_vectors'] * (1/alat)
-
-  tau = arry['tau']
-  naw = arry['naw']
 
   contour = arry['berry_contour']
   
@@ -222,109 +296,146 @@ def do_phase (data_controller):
     closed = True   
 
   # assumes that occupancy does not change throughout the choosen path
+  occ_idx = berry_subspace(data_controller)
 
-  if occupied:
-    sub = None
-    occ_idx = np.arange(0,attr['nelec'],1,dtype=int)
-    num_occupied = len(occ_idx)
-    dim = num_occupied
-  elif not sub is None:
-    occ_idx = np.copy(sub)
-    num_occupied = len(sub)
-    dim = len(sub)
-  else:
-    occ_idx = np.arange(0,arry['HRs'].shape[0],1,dtype=int)
-    num_occupied = len(occ_idx)
-    dim = num_occupied
-    
-  prd = np.eye(dim,dtype=complex)
-  ovr = np.zeros([dim,dim],dtype=complex)
+  zak = None
+  if closed and method == 'zak':
+    zak = zak_phase(data_controller, contour[:,1] - contour[:,0])
 
-  for ik in range(nkpts-1):
+  Vl,Vr = loop_links(v_kp[:,:,occ_idx,0], closed, zak)
+  prd = ordered_product(link_unitaries(Vl,Vr))
 
-    jk = ik+1
-    
-    left_eig,left_states = E_kp[ik,:,0], v_kp[ik,:,:,0]
-    right_eig,right_states = E_kp[jk,:,0], v_kp[jk,:,:,0]
+  return loop_phase(prd, berry_eigvals)
 
-    if occupied or not sub is None:
 
-      left_states_idx = occ_idx
-      right_states_idx = occ_idx
+def loop_links ( V, closed, zak=None ):
+  # Left and right subspaces of the links i -> i+1 along a path of eigenvectors V (nk,nawf,dim).
+  # The closing link of a closed loop starts from the last point, or from the first
+  # point with the Bloch phase 'zak' applied (Zak phase).
+  Vl,Vr = V[:-1],V[1:]
+  if closed:
+    left = V[-1] if zak is None else V[0]*np.exp(-1j*zak)[:,None]
+    Vl = np.concatenate((Vl,left[None]))
+    Vr = np.concatenate((Vr,V[:1]))
+  return Vl,Vr
 
-      left_occ = np.zeros((left_states.shape[0],len(left_states_idx)),dtype=complex)
-      right_occ = np.zeros((right_states.shape[0],len(right_states_idx)),dtype=complex)
 
-      for idx,occ in enumerate(left_states_idx):
-        left_occ[:,idx] = left_states[:,occ]
-      for idx,occ in enumerate(right_states_idx):
-        right_occ[:,idx] = right_states[:,occ]
-      left_states = left_occ
-      right_states = right_occ
+def link_unitaries ( Vl, Vr ):
+  # Unitary part Z W^+ of each overlap <Vl|Vr> = Z S W^+, from a stacked SVD
+  Z,_,Wh = npl.svd(np.conj(np.swapaxes(Vl,-1,-2)) @ Vr)
+  return Z @ Wh
 
-    else: pass
 
-    ovr = np.dot(left_states.conj().T,right_states)
-    Z_ovr, sig_ovr, W_dag_ovr = la.svd(ovr)
-    ovr = np.matmul(Z_ovr,W_dag_ovr)
+def ordered_product ( U ):
+  # U[0] @ U[1] @ ... @ U[-1], multiplying neighbouring pairs in batches
+  if U.shape[0] == 0:
+    return np.eye(U.shape[1], dtype=complex)
+  while U.shape[0] > 1:
+    if U.shape[0] % 2:
+      U = np.concatenate((U,np.eye(U.shape[1],dtype=complex)[None]))
+    U = U[0::2] @ U[1::2]
+  return U[0]
 
-    prd = np.dot(prd,ovr)
-    
-  if closed:
-    ik = nkpts-1
-    jk = 0
-    
-    left_eig,left_states = E_kp[ik,:,0], v_kp[ik,:,:,0]
-    right_eig,right_states = E_kp[jk,:,0], v_kp[jk,:,:,0]
-    
-    if method == "zak":
-      axis = contour[:,1] - contour[:,0]
-      axis /= np.dot(axis.T,axis) ** 0.5
 
-      G = np.dot(axis,b_vectors) * 2 * np.pi
+def loop_phase ( prd, eigvals ):
+  # Berry phase of a Wilson loop matrix, or its sorted eigenphases
+  if not eigvals:
+    return -1.0 * np.angle(la.det(prd))
+  return np.sort(-1.0 * np.angle(la.eigvals(prd)))
 
-      orb_sites = np.repeat(tau,naw,axis=0)
 
-      phase = np.dot(orb_sites, G).reshape(-1,1)
-      
-      left_states = right_states * np.exp(-1j * phase)
+def berry_track ( data_controller, kpts, nthreads=1 ):
+  '''
+  Berry phase (or Wilson loop eigenphases with 'berry_eigvals') of the loop returned by
+  'berry_kpath_funct' for each value in kpts. Whole loops are distributed over the ranks,
+  the points of the loops on each rank are diagonalized in stacks (eigh_stack with 'nthreads'),
+  and the links of all loops are computed with a stacked SVD.
 
-    if occupied or not sub is None:
+  Arguments:
+      kpts (ndarray): Values passed to 'berry_kpath_funct'
+      nthreads (int): Number of threads per rank diagonalizing chunks of k points
 
-      left_states_idx = occ_idx
-      right_states_idx = occ_idx
+  Returns:
+      phase (ndarray): Array with shape (nk,), or (nk,dim) with 'berry_eigvals', on every rank
+  '''
+  from mpi4py import MPI
+  from .do_eigh import eigh_stack
+  from .get_R_grid_fft import get_R_grid_fft
+  from .communication import load_balancing,load_sizes
 
-      left_occ = np.zeros((left_states.shape[0],len(left_states_idx)),dtype=complex)
-      right_occ = np.zeros((right_states.shape[0],len(right_states_idx)),dtype=complex)
+  comm = MPI.COMM_WORLD
+  rank,size = comm.Get_rank(),comm.Get_size()
 
-      for idx,occ in enumerate(left_states_idx):
-        left_occ[:,idx] = left_states[:,occ]
-      for idx,occ in enumerate(right_states_idx):
-        right_occ[:,idx] = right_states[:,occ]
-      left_states = left_occ
-      right_states = right_occ
+  arry,attr = data_controller.data_dicts()
 
-    else: pass
-    
-    ovr = np.dot(left_states.conj().T,right_states)
+  kpath_funct = attr['berry_kpath_funct']
+  eigvals = attr['berry_eigvals']
+  method = attr['berry_method'].lower()
 
-    Z_ovr, sig_ovr, W_dag_ovr = la.svd(ovr)
-    ovr = np.matmul(Z_ovr,W_dag_ovr)
+  nawf,_,nr1,nr2,nr3,nspin = arry['HRs'].shape
+  occ_idx = berry_subspace(data_controller)
+  nbnd = np.amax(occ_idx)+1
+  width = occ_idx.shape[0] if eigvals else 1
 
-    prd = np.dot(prd,ovr)
+  # Bohr to Angstrom
+  attr['alat'] /= ANGSTROM_AU
 
-  if not berry_eigvals:
-    det = la.det(prd)
-    ret = -1.0 * np.angle(det)
+  get_R_grid_fft(data_controller, nr1, nr2, nr3)
 
-    return ret
+  # Paths of this rank's loops
+  ini,end = load_balancing(size, rank, kpts.shape[0])
+  loops = [berry_path_points(data_controller, *kpath_funct(k))[0] for k in kpts[ini:end]]
 
-  else:
-    evals,evecs = la.eig(prd)
-    ret = -1.0 * np.angle(evals)
-    ret = np.sort(ret)
+  # The last path is written, and left in 'berry_path', as by do_berry_bands
+  attr['berry_path'],arry['berry_high_sym_points'] = kpath_funct(kpts[-1])
+  points,path_file = berry_path_points(data_controller, attr['berry_path'], arry['berry_high_sym_points'])
+  data_controller.write_kpnts_path('berry_phase_kpath_points.txt', path_file, points, arry['b_vectors'])
+
+  # Angstrom to Bohr
+  attr['alat'] *= ANGSTROM_AU
+
+  phase = np.empty((end-ini,width), dtype=float)
+
+  # Loops are solved in groups holding at most max_berry_elems matrix elements
+  il = 0
+  while il < len(loops):
+    jl = il+1
+    npts = loops[il].shape[1]
+    while jl < len(loops) and (npts+loops[jl].shape[1])*max(nawf*nawf*nspin,nr1*nr2*nr3) <= max_berry_elems:
+      npts += loops[jl].shape[1]
+      jl += 1
+
+    kq = np.concatenate([l.T for l in loops[il:jl]]) @ arry['b_vectors']
+    Hk = np.moveaxis(band_loop_H(data_controller, kq.T)[:,:,:,0], 2, 0)
+    V = eigh_stack(Hk, nthreads=nthreads, nbnd=nbnd)[1][:,:,occ_idx]
+    Hk = None
+
+    links = []
+    ip = 0
+    for l in loops[il:jl]:
+      n = l.shape[1]
+      closed = attr['berry_closed'] and not np.allclose(l[:,0], l[:,-1])
+      zak = None
+      if method == 'zak':
+        closed = True
+        zak = zak_phase(data_controller, l[:,1] - l[:,0])
+      links.append(loop_links(V[ip:ip+n], closed, zak))
+      ip += n
+
+    U = link_unitaries(np.concatenate([lk[0] for lk in links]), np.concatenate([lk[1] for lk in links]))
+    iu = 0
+    for i,lk in enumerate(links):
+      nlk = lk[0].shape[0]
+      phase[il+i] = loop_phase(ordered_product(U[iu:iu+nlk]), eigvals)
+      iu += nlk
+    il = jl
+
+  sizes = load_sizes(size, kpts.shape[0], width)
+  phase_all = np.empty((kpts.shape[0],width), dtype=float)
+  comm.Allgatherv(phase, [phase_all,sizes[:,0],sizes[:,1],MPI.DOUBLE])
+
+  return phase_all if eigvals else phase_all[:,0]
 
-    return ret
 
 def bands_calc ( data_controller ):
   from .communication import scatter_full, gather_full
@@ -418,6 +529,17 @@ def berry_kpnts_interpolation_mesh ( data_controller ):
       numK    : Total no. of k-points
   '''
 
+  arry,attr = data_controller.data_dicts()
+
+  points,path_file = berry_path_points(data_controller, attr['berry_path'], arry['berry_high_sym_points'])
+
+  data_controller.write_kpnts_path('berry_phase_kpath_points.txt', path_file, points, arry['b_vectors'])
+
+  arry['berry_kq'] = points
+  arry['berry_contour'] = np.copy(arry['berry_kq'])
+
+def berry_path_points ( data_controller, band_path, high_sym_points ):
+  # Path with about 'berry_nk' points through the high symmetry points, returns (points, path_file)
   from .kpnts_interpolation_mesh import get_path
 
   arry,attr = data_controller.data_dicts()
@@ -425,7 +547,6 @@ def berry_kpnts_interpolation_mesh ( data_controller ):
   dk = 0.00001
   nk,alat,ibrav = attr['berry_nk'],attr['alat'],attr['ibrav']
   a_vectors,b_vectors = arry['a_vectors'],arry['b_vectors']
-  band_path,high_sym_points = attr['berry_path'],arry['berry_high_sym_points']
 
   bp,hsp = (band_path,high_sym_points) if len(high_sym_points)!=0 else (None,None)
 
@@ -433,12 +554,7 @@ def berry_kpnts_interpolation_mesh ( data_controller ):
 
   scaled_dk = dk*(points.shape[1]/nk)
 
-  points,path_file = get_path(ibrav,alat,a_vectors,scaled_dk,b_vectors,bp,hsp)
-
-  data_controller.write_kpnts_path('berry_phase_kpath_points.txt', path_file, points, b_vectors)
-
-  arry['berry_kq'] = points
-  arry['berry_contour'] = np.copy(arry['berry_kq'])
+  return get_path(ibrav,alat,a_vectors,scaled_dk,b_vectors,bp,hsp)
 
 def no_2pi(x,ref):
   "Make x as close to clos by adding or removing 2pi"
@@ -23,11 +23,14 @@ from mpi4py import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
-### Reformat
-def build_Hks ( data_controller ):
-  from scipy import linalg as spl
+# Maximum number of Hamiltonian matrix elements built at once on each rank
+max_hks_elems = 2**24
 
-  minimal = False
+def build_Hks ( data_controller ):
+  # Build the projected Hamiltonian at every k point of the DFT grid. The k points
+  # are distributed over the ranks and built in stacks with batched products,
+  # then the full Hks (nawf,nawf,nkpnts,nspin) is assembled on every rank.
+  from .communication import load_balancing,gather_array
 
   arrays,attributes = data_controller.data_dicts()
 
@@ -38,83 +41,69 @@ def build_Hks ( data_controller ):
   nkpnts = attributes['nkpnts']
   shift_type = attributes['shift_type']
 
+  if shift_type not in [0,1,2]:
+    if rank == 0:
+      print('\'shift_type\' Not Recognized')
+    comm.Abort()
+
   U = arrays['U'] 
   my_eigsmat = arrays['my_eigsmat']
 
-  Hksaux = np.zeros((nawf,nawf,nkpnts,nspin), dtype=complex)
-  if minimal:
-    Hks = np.zeros((bnd,bnd,nkpnts,nspin), dtype=complex)
-  else:
-    Hks = np.zeros((nawf,nawf,nkpnts,nspin), dtype=complex)
-
-  for ik in range(nkpnts):
-    for ispin in range(nspin):
-      my_eigs = my_eigsmat[:,ik,ispin]
-
-      #Building the Hamiltonian matrix
-      E = np.diag(my_eigs)
-      UU = np.transpose(U[:,:,ik,ispin]) #transpose of U. Now the columns of UU are the eigenvector of length nawf
-      norms = 1./np.sqrt(np.real(np.sum(np.conj(UU)*UU,axis=0)))
-      UU[:,:nawf] = UU[:,:nawf]*norms[:nawf]
-
-      # Choose only the eigenvalues that are below the energy shift
-      bnd_ik = 0
-      for n in range(bnd):
-        if my_eigs[n] <= eta:
-          bnd_ik += 1
-      if bnd_ik == 0:
-        if rank == 0:
-          print('No Eigenvalues in the selected energy range')
-        comm.Abort()
-      ac = UU[:,:bnd_ik]  # filtering: bnd is defined by the projectabilities
-      ee1 = E[:bnd_ik,:bnd_ik]
+  ini_ik,end_ik = load_balancing(comm.Get_size(), rank, nkpnts)
+  nkl = end_ik-ini_ik
+
+  # U holds either all k points or only this rank's block (read_atomic_proj_QE with distribute=True)
+  uoff = ini_ik if U.shape[2]==nkpnts else 0
+
+  # Choose only the eigenvalues that are below the energy shift
+  bnd_k = np.sum(my_eigsmat[:bnd,ini_ik:end_ik,:]<=eta, axis=0)
+  if comm.allreduce(np.count_nonzero(bnd_k==0)) > 0:
+    if rank == 0:
+      print('No Eigenvalues in the selected energy range')
+    comm.Abort()
+
+  nn = min(nawf,bnd)
+  ident = np.identity(nawf)
+  kchunk = max(1, max_hks_elems//(nawf*nawf))
+
+  Hksaux = np.empty((nkl,nspin,nawf,nawf), dtype=complex)
+  for ispin in range(nspin):
+    for ks in range(0, nkl, kchunk):
+      ke = min(nkl, ks+kchunk)
+
+      # Normalized eigenvectors as columns, (nk,nawf,bnd)
+      ac = np.transpose(U[:bnd,:,uoff+ks:uoff+ke,ispin], (2,1,0)).copy()
+      ac[:,:,:nn] /= np.sqrt(np.sum(np.abs(ac[:,:,:nn])**2, axis=1))[:,None,:]
+
+      # Filtering: bnd is defined by the projectabilities. Bands above the shift are zeroed.
+      keep = np.arange(bnd)[None,:] < bnd_k[ks:ke,ispin,None]
+      ac *= keep[:,None,:]
+      ee1 = np.where(keep, my_eigsmat[:bnd,ini_ik+ks:ini_ik+ke,ispin].T, 0.)
+      acH = np.conj(np.swapaxes(ac,1,2))
+
+      Hk = (ac*ee1[:,None,:]) @ acH
       if shift_type == 0:
         #option 1 (PRB 2013)
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T) + eta*(np.identity(nawf)-ac.dot(np.conj(ac).T))
+        Hk += eta*(ident - ac@acH)
 
       elif shift_type == 1:
         #option 2 (PRB 2016)
-        aux_p=spl.inv(np.dot(np.conj(ac).T,ac))
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T) + eta*(np.identity(nawf)-ac.dot(aux_p).dot(np.conj(ac).T))
+        # Overlap of the kept bands, with the identity in place of the zeroed bands
+        ovp = acH @ ac
+        ik,ib = np.nonzero(~keep)
+        ovp[ik,ib,ib] = 1.
+        Hk += eta*(ident - ac@np.linalg.solve(ovp,acH))
 
-      elif shift_type == 2:
-        # no shift
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T)
+      # Enforce Hermiticity (just in case...)
+      Hksaux[ks:ke,ispin] = 0.5*(Hk + np.conj(np.swapaxes(Hk,1,2)))
+  Hk = ac = acH = None
 
-      else:
-        if rank == 0:
-          print('\'shift_type\' Not Recognized')
-        comm.Abort()
+  Hks = np.empty((nkpnts,nspin,nawf,nawf), dtype=complex)
+  gather_array(Hks, Hksaux)
+  Hksaux = None
+  comm.Bcast(Hks, root=0)
 
-      # Enforce Hermiticity (just in case...)
-      Hksaux[:,:,ik,ispin] = 0.5*(Hksaux[:,:,ik,ispin] + np.conj(Hksaux[:,:,ik,ispin].T))
-
-      if minimal:
-        import numpy.random as rd
-        from numpy import linalg as npl
-        Sbd = np.zeros((nawf,nawf),dtype=complex)
-        Sbdi = np.zeros((nawf,nawf),dtype=complex)
-        S = sv = np.zeros((nawf,nawf),dtype=complex)
-        e = se = np.zeros(nawf,dtype=float)
-
-        e,S = npl.eigh(Hksaux[:,:,ik,ispin])
-        S11 = S[:bnd,:bnd] + 1.0*rd.random(bnd)/10000.
-        S21 = S[:bnd,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
-        S12 = S21.T
-        S22 = S[bnd:,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
-        S22 = S22 + S21.T.dot(np.dot(spl.inv(S11),S12.T))
-        Sbd[:bnd,:bnd] = 0.5*(S11+np.conj(S11.T))
-        Sbd[bnd:,bnd:] = 0.5*(S22+np.conj(S22.T))
-        Sbdi = spl.inv(np.dot(Sbd,np.conj(Sbd.T)))
-        se,sv = npl.eigh(Sbdi)
-        se = np.sqrt(se+0.0j)*np.identity(nawf,dtype=complex)
-        Sbdi = sv.dot(se).dot(np.conj(sv).T)
-        T = S.dot(np.conj(Sbd.T)).dot(Sbdi)
-        Hbd = np.conj(T.T).dot(np.dot(Hksaux[:,:,ik,ispin],T))
-        Hks[:,:,ik,ispin] = 0.5*(Hbd[:bnd,:bnd]+np.conj(Hbd[:bnd,:bnd].T))
-      else:
-        Hks = Hksaux
-  return Hks
+  return np.ascontiguousarray(np.transpose(Hks, (2,3,0,1)))
 
 
 def do_build_pao_hamiltonian ( data_controller ):
@@ -128,6 +117,7 @@ def do_build_pao_hamiltonian ( data_controller ):
   arry['Hks'] = build_Hks(data_controller)
 
   if attr['expand_wedge']:
+    # Hks is left distributed, each rank holds a block of k points of the full grid
     from .pao_sym import open_grid_wrapper
     open_grid_wrapper(data_controller)
 
@@ -139,18 +129,21 @@ def do_build_pao_hamiltonian ( data_controller ):
   # acbn0 flag == 0 - makes H non orthogonal (original basis of the atomic pseudo-orbitals)
   # acbn0 flag == 1 - makes H orthogonal (rotated basis) 
 
-  if rank == 0 and attr['expand_wedge']:
+  if attr['expand_wedge']:
     from .do_Efermi import E_Fermi
-    arry['Hks'] = np.reshape(arry['Hks'], ashape)
 
     # Shift the Fermi energy to zero
-    tshape = (ashape[0],ashape[1],nkpnts,ashape[5])
-    Ef = E_Fermi(arry['Hks'].reshape(tshape), data_controller)
+    Ef = E_Fermi(arry['Hks'], data_controller, parallel=True, tetrahedron=attr['tetrahedron'])
     dinds = np.diag_indices(attr['nawf'])
     arry['Hks'][dinds[0],dinds[1]] -= Ef
 
   if attr['acbn0']:
     import sys
+    if attr['expand_wedge']:
+      from .communication import gather_full
+      Hks = gather_full(np.ascontiguousarray(np.moveaxis(arry['Hks'],2,0)), attr['npool'])
+      arry['Hks'] = np.moveaxis(Hks, 0, 2) if rank == 0 else None
+      Hks = None
     if rank == 0:
       from .do_non_ortho import do_non_ortho
 
@@ -176,7 +169,25 @@ def do_Hks_to_HRs ( data_controller ):
   # Define the Hamiltonian and overlap matrix in real space:
   #   HRs and SRs (noinv and nosym = True in pw.x)
   #----------------------------------------------------------
-  if rank == 0:
+  if attr['expand_wedge']:
+    # Hks holds this rank's block of k points (open_grid_wrapper). Every rank
+    # transforms a set of matrix elements over the full grid, then HRs is
+    # assembled on rank 0. The distributed Hks is kept as Hksp for pao_eigh.
+    from .communication import gather_scatter,gather_full
+
+    nk1,nk2,nk3 = attr['nk1'],attr['nk2'],attr['nk3']
+    nawf,_,snktot,nspin = arry['Hks'].shape
+    arry['Hksp'] = np.ascontiguousarray(np.moveaxis(arry['Hks'],2,0))
+    del arry['Hks']
+
+    HRs = gather_scatter(np.reshape(arry['Hksp'],(snktot,nawf*nawf,nspin)), 1, attr['npool'])
+    snawf = HRs.shape[1]
+    HRs = FFT.ifftn(np.reshape(HRs,(nk1,nk2,nk3,snawf,nspin)), axes=[0,1,2])
+    HRs = gather_full(np.ascontiguousarray(np.moveaxis(HRs,3,0)), attr['npool'])
+    if rank == 0:
+      arry['HRs'] = np.reshape(HRs, (nawf,nawf,nk1,nk2,nk3,nspin))
+
+  elif rank == 0:
     # Original k grid to R grid
     arry['HRs'] = np.zeros_like(arry['Hks'])
     arry['HRs'] = FFT.ifftn(arry['Hks'], axes=[2,3,4])
@@ -28,6 +28,7 @@ from .get_R_grid_fft import *
 from .communication import *
 from .constants import *
 from .perturb_split import *
+from .do_eigh import degenerate_sets
 # initialize parallel execution
 comm=MPI.COMM_WORLD
 rank = comm.Get_rank()
@@ -113,7 +114,7 @@ def do_d2Hd2k_ij(Hksp,Rfft,alat,npool,v_kp,bnd,degen):
                 tksp[:,:,ik,ispin],_,dvec = perturb_split(d2Hksp[:,:,ik,ispin],
                                                           d2Hksp[:,:,ik,ispin],
                                                           v_kp[ik,:,:,ispin],
-                                                          degen[ispin][ik],return_v_k=True)
+                                                          degenerate_sets(degen[ispin],ik),return_v_k=True)
 
                 isp_tmp.append(dvec)
             dir_tmp.append(isp_tmp)
@@ -125,12 +125,14 @@ def solve_for_mu(data_controller,ene,dos,N0,temp,refine=False,try_center=False,d
            mu = result.x
     return mu
 
-def do_doping( data_controller, temps, ene, fname ):
+def do_doping( data_controller, temps, ene, fname, tetrahedron=None ):
 
   arry,attr = data_controller.data_dicts()
   temp_conv,omega_conv = 11604.52500617,1.481847093e-25
 
-  if attr['smearing'] is None:
+  if tetrahedron is not None:
+    dos = arry['dostetra']
+  elif attr['smearing'] is None:
     dos = arry['dos']
   else:
     dos = arry['dosdk']
@@ -24,6 +24,7 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
 def do_dos ( data_controller, emin, emax, ne, delta ):
+  from .dos_kernels import smeared_dos
 
   arry,attr = data_controller.data_dicts()
   bnd = attr['bnd']
@@ -38,12 +39,9 @@ def do_dos ( data_controller, emin, emax, ne, delta ):
 
   for ispin in range(attr['nspin']):
 
-    dosaux = np.zeros((ne), order="C")
-
     E_k = arry['E_k'][:,:bnd,ispin]
 
-    for n in range(ne):
-      dosaux[n] = np.sum(np.exp(-((ene[n]-E_k)/delta)**2))
+    dosaux = smeared_dos(E_k, ene, delta)
 
     dos = np.zeros((ne), dtype=float) if rank == 0 else None
 
@@ -51,7 +49,7 @@ def do_dos ( data_controller, emin, emax, ne, delta ):
     dosaux = None
 
     if rank == 0:
-      dos *= float(bnd)/(float(netot)*np.sqrt(np.pi)*delta)
+      dos *= float(bnd)/float(netot)
       arry['dos'] = dos
     fdos = 'dos_%s.dat'%str(ispin)
     data_controller.write_file_row_col(fdos, ene, dos)
@@ -59,7 +57,7 @@ def do_dos ( data_controller, emin, emax, ne, delta ):
     #return dos if rank==0 else None
 
 def do_dos_adaptive ( data_controller, emin, emax, ne ):
-  from .smearing import gaussian, metpax
+  from .dos_kernels import smeared_dos
 
   comm = MPI.COMM_WORLD
   rank = comm.Get_rank()
@@ -78,19 +76,11 @@ def do_dos_adaptive ( data_controller, emin, emax, ne ):
 
   for ispin in range(attr['nspin']):
 
-    E_k = arry['E_k'][:,:bnd,ispin].reshape(arry['E_k'].shape[0]*bnd)
-    delta = np.ravel(arry['deltakp'][:,:bnd,ispin], order='C')
-
-    dosaux = np.zeros((ne), dtype=float)
-
-    for n in range(ne):
-      if attr['smearing'] == 'gauss':
-        # adaptive Gaussian smearing
-        dosaux[n] = np.sum(gaussian(ene[n],E_k,delta))
+    E_k = arry['E_k'][:,:bnd,ispin]
+    delta = arry['deltakp'][:,:bnd,ispin]
 
-      elif attr['smearing'] == 'm-p':
-        # adaptive Methfessel and Paxton smearing
-        dosaux[n] = np.sum(metpax(ene[n],E_k,delta))
+    # adaptive Gaussian or Methfessel and Paxton smearing
+    dosaux = smeared_dos(E_k, ene, delta, attr['smearing'])
 
     dos = np.zeros((ne), dtype=float) if rank==0 else None
     comm.Reduce(dosaux, dos, op=MPI.SUM)
@@ -103,3 +93,32 @@ def do_dos_adaptive ( data_controller, emin, emax, ne ):
     data_controller.write_file_row_col(fdosdk, ene,dos)
     data_controller.broadcast_single_array('dosdk', dtype=float)
 
+
+def do_dos_tetrahedron ( data_controller, emin, emax, ne ):
+  from .tetrahedron import tetrahedra,gather_eigenvalues,tetra_dos_total
+
+  arry,attr = data_controller.data_dicts()
+
+  # DOS calculation with the linear tetrahedron method
+  bnd = attr['bnd']
+  emax = np.amin(np.array([attr['shift'], emax]))
+  ene = np.linspace(emin, emax, ne)
+  arry['dostetra'] = np.empty((ne,), dtype=float)
+
+  tets = tetrahedra(attr['nk1'], attr['nk2'], attr['nk3'], arry['b_vectors'])
+
+  if rank == 0 and attr['verbose']:
+    print('Writing Tetrahedron DoS Files')
+
+  for ispin in range(attr['nspin']):
+
+    E_k = gather_eigenvalues(arry['E_k'][:,:bnd,ispin], attr['npool'])
+
+    dos = tetra_dos_total(E_k, tets, ene)
+    E_k = None
+
+    if rank == 0:
+      arry['dostetra'] = dos
+    fdos = 'dostetra_%s.dat'%str(ispin)
+    data_controller.write_file_row_col(fdos, ene, dos)
+    data_controller.broadcast_single_array('dostetra', dtype=float)
@@ -20,20 +20,17 @@
 # Fourier interpolation on extended grid (zero padding)
 def do_double_grid ( data_controller ):
   import numpy as np
-  from mpi4py import MPI
   from .zero_pad import zero_pad
   from scipy import fftpack as FFT
-  from .communication import scatter_full
-
-  rank = MPI.COMM_WORLD.Get_rank()
+  from .communication import scatter_indices
 
   arrays,attr = data_controller.data_dicts()
 
-  HRs = None
-  if rank == 0:
-    nawf,nk1,nk2,nk3 = attr['nawf'],attr['nk1'],attr['nk2'],attr['nk3']
-    HRs = np.reshape(arrays['HRs'], (nawf**2,nk1,nk2,nk3,attr['nspin']))
-  HRs = scatter_full(HRs, attr['npool'])
+  # HRs is held by every process, so each one takes its own
+  # orbital pairs in the order scatter_full would distribute them
+  nawf,nk1,nk2,nk3 = attr['nawf'],attr['nk1'],attr['nk2'],attr['nk3']
+  HRs = np.reshape(arrays['HRs'], (nawf**2,nk1,nk2,nk3,attr['nspin']))
+  HRs = HRs[scatter_indices(nawf**2, attr['npool'])]
 
   snawf,nk1,nk2,nk3,nspin = HRs.shape
   nk1p = attr['nfft1']
@@ -22,56 +22,278 @@ from scipy import linalg as spl
 from numpy import linalg as npl
 
 
-def get_degeneracies ( E_k, bnd ):
+def get_degeneracies ( E_k, bnd, tol=1.e-5 ):
+  '''
+  Find the sets of degenerate bands at each k point. Neighbouring eigenvalues closer
+  than 'tol' (after rounding to 5 decimals) belong to the same set, and only sets
+  lying entirely below 'bnd' are kept.
+
+  Arguments:
+      E_k (ndarray): Sorted eigenvalues with shape (nk,nbnd,nspin)
+      bnd (int): Number of bands considered
+      tol (float): Tolerance for two eigenvalues to be degenerate
+
+  Returns:
+      degen (list): For each spin, a tuple (offsets, ranges) in compressed row format.
+        The degenerate sets of k point ik are ranges[offsets[ik]:offsets[ik+1]], each
+        row holding the first band and one past the last band of the set.
+  '''
+  nk,nbnd,nspin = E_k.shape
 
   all_degen = []
 
   E_k_round = np.around(E_k, decimals=5)
-  
-  for ispin in range(E_k_round.shape[2]):
 
-    by_spin = []
-    for ik in range(E_k_round.shape[0]):
-      by_kp = []
-      eV = np.unique(E_k_round[ik,:,ispin][:-1][np.isclose(E_k_round[ik,:,ispin][1:],
-                                                           E_k_round[ik,:,ispin][:-1],
-                                                           atol=1.e-5)])
+  for ispin in range(nspin):
+
+    # close[:,j] is True when bands j and j+1 are degenerate, padded with False on both ends
+    close = np.zeros((nk,nbnd+1), dtype=bool)
+    close[:,1:nbnd] = np.isclose(E_k_round[:,1:,ispin], E_k_round[:,:-1,ispin], atol=tol)
 
-      for i in range(len(eV)):
-        inds = np.where(np.isclose(E_k_round[ik,:,ispin],eV[i],atol=1.e-5))[0]
+    ik,start = np.nonzero(close[:,1:] & ~close[:,:-1])
+    _,stop = np.nonzero(close[:,:-1] & ~close[:,1:])
+    stop += 1
 
-        if len(inds) > 1 and np.all(inds < bnd):                    
-          by_kp.append(inds)
+    keep = stop <= bnd
+    ik,ranges = ik[keep],np.column_stack((start[keep],stop[keep]))
 
-      by_spin.append(by_kp)
+    offsets = np.zeros(nk+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(ik, minlength=nk))
 
-    all_degen.append(by_spin)
+    all_degen.append((offsets,ranges))
 
   return all_degen
 
 
-def do_pao_eigh ( data_controller ):
-  from .communication import gather_scatter
-  from numpy.linalg import eigh
+def degenerate_sets ( degen, ik ):
+  # Band ranges of the degenerate sets at k point ik, from one spin of get_degeneracies
+  offsets,ranges = degen
+  return ranges[offsets[ik]:offsets[ik+1]]
+
+
+def blas_thread_limit ( nthreads ):
+  '''
+  Context manager limiting the number of BLAS/LAPACK threads. Requires threadpoolctl,
+  otherwise the limit is silently ignored.
+
+  Arguments:
+      nthreads (int): Maximum number of BLAS threads (None leaves the limit unchanged)
+
+  Returns:
+      Context manager
+  '''
+  from contextlib import contextmanager
+
+  @contextmanager
+  def no_limit ():
+    yield
+
+  if nthreads is None:
+    return no_limit()
+  try:
+    from threadpoolctl import threadpool_limits
+    return threadpool_limits(limits=nthreads, user_api='blas')
+  except ImportError:
+    return no_limit()
+
+
+# Environment variables in which common launchers (Open MPI, MPICH/Hydra, Intel MPI, Slurm)
+# report the number of ranks sharing this node
+local_size_vars = ('OMPI_COMM_WORLD_LOCAL_SIZE', 'MPI_LOCALNRANKS', 'MPI_LOCAL_NRANKS', 'SLURM_NTASKS_PER_NODE')
+
+
+def ranks_per_node ():
+  # Ranks sharing the cores of this node, read from the launcher's environment (1 if unknown).
+  # No communication is involved, so it is safe to call from any rank at any time.
+  from os import environ
+
+  for var in local_size_vars:
+    try:
+      # Slurm may report a list such as '4(x2),3'; the first entry is used
+      return max(1, int(environ[var].split(',')[0].split('(')[0]))
+    except (KeyError, ValueError):
+      pass
+  return 1
+
+
+def blas_threads_per_worker ( nthreads ):
+  '''
+  Number of BLAS threads each eigensolver worker may use without oversubscribing
+  the cores shared by all MPI ranks on this node. When the launcher binds this rank
+  to a subset of the cores, those cores are its own and are not shared further.
+  '''
+  import os
+
+  ncpu = os.cpu_count() or 1
+  try:
+    ncore = len(os.sched_getaffinity(0))
+  except AttributeError:
+    ncore = ncpu
+
+  nshare = ranks_per_node() if ncore >= ncpu else 1
+
+  return max(1, ncore//(nshare*nthreads))
+
+
+def eigh_numpy ( Hk, Sk=None, nbnd=None ):
+  # Batched LAPACK heevd over the leading axis. The generalized problem
+  # is reduced to standard form with a batched Cholesky factorization.
+  # The full spectrum is always computed; only the lowest 'nbnd' pairs are kept.
+  if Sk is None:
+    E,v = npl.eigh(Hk, UPLO='U')
+  else:
+    Linv = npl.inv(npl.cholesky(Sk))
+    LinvH = np.conj(np.swapaxes(Linv, 1, 2))
+    Hk = np.triu(Hk) + np.conj(np.swapaxes(np.triu(Hk,1), 1, 2))
+    E,v = npl.eigh(Linv @ Hk @ LinvH)
+    v = LinvH @ v
+  return E[:,:nbnd], v[:,:,:nbnd]
+
+
+def eigh_scipy ( Hk, Sk=None, nbnd=None ):
+  # One LAPACK call per matrix (heevr/hegvx), solving only for the lowest 'nbnd' pairs
+  nk,nawf,_ = Hk.shape
+  nbnd = nawf if nbnd is None else nbnd
+  subset = None if nbnd == nawf else [0,nbnd-1]
+  E = np.empty((nk,nbnd), dtype=float)
+  v = np.empty((nk,nawf,nbnd), dtype=complex)
+  for ik in range(nk):
+    E[ik],v[ik] = spl.eigh(Hk[ik], (None if Sk is None else Sk[ik]), lower=False, subset_by_index=subset, check_finite=False)
+  return E, v
+
+
+eigh_backends = { 'numpy' : eigh_numpy,
+                  'scipy' : eigh_scipy }
+
+
+def eigh_stack ( Hk, Sk=None, backend='numpy', nthreads=1, kchunk=64, blas_threads=None, nbnd=None ):
+  '''
+  Diagonalize a stack of Hermitian matrices, in chunks of k-points distributed over a thread pool
+
+  Arguments:
+      Hk (ndarray): Stack of Hamiltonians with shape (nk,nawf,nawf). Only the upper triangle is referenced.
+      Sk (ndarray): (optional) Stack of overlap matrices with shape (nk,nawf,nawf) for the generalized problem
+      backend (str): Eigensolver backend, a key of 'eigh_backends'
+      nthreads (int): Number of threads diagonalizing chunks concurrently
+      kchunk (int): Number of k-points diagonalized in each batched call
+      blas_threads (int): BLAS threads per worker (None selects a value avoiding oversubscription when nthreads > 1)
+      nbnd (int): Number of lowest eigenpairs to return (None for the full spectrum). Only the 'scipy'
+        backend solves for the subset; 'numpy' computes the full spectrum and truncates it.
+
+  Returns:
+      (E, v): Eigenvalues with shape (nk,nbnd) and eigenvectors with shape (nk,nawf,nbnd)
+  '''
+  from concurrent.futures import ThreadPoolExecutor
+
+  if backend not in eigh_backends:
+    raise ValueError('Eigensolver backend \'%s\' not supported. Available backends are: %s'%(backend,', '.join(eigh_backends)))
+  solver = eigh_backends[backend]
+
+  nk,nawf,_ = Hk.shape
+  nbnd = nawf if nbnd is None else min(nbnd, nawf)
+  E = np.empty((nk,nbnd), dtype=float)
+  v = np.empty((nk,nawf,nbnd), dtype=complex)
+
+  kchunk = max(1, kchunk)
+  chunks = [(ks,min(ks+kchunk,nk)) for ks in range(0,nk,kchunk)]
+
+  def solve_chunk ( bounds ):
+    ks,ke = bounds
+    E[ks:ke],v[ks:ke] = solver(Hk[ks:ke], (None if Sk is None else Sk[ks:ke]), nbnd)
+
+  if nthreads > 1 and len(chunks) > 1:
+    if blas_threads is None:
+      blas_threads = blas_threads_per_worker(nthreads)
+    with blas_thread_limit(blas_threads):
+      with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        list(pool.map(solve_chunk, chunks))
+  else:
+    with blas_thread_limit(blas_threads):
+      for c in chunks:
+        solve_chunk(c)
+
+  return E, v
+
+
+def count_bands_below ( Hksp, emax ):
+  '''
+  Number of bands required so that every eigenvalue below 'emax', on every k-point
+  of every rank, is included. Only the eigenvalues below 'emax' are computed (LAPACK
+  heevr by value, without eigenvectors).
+
+  Arguments:
+      Hksp (ndarray): Local k-space Hamiltonian with shape (snktot,nawf,nawf,nspin)
+      emax (float): Upper limit of the energy window
+
+  Returns:
+      nbnd (int): Number of lowest bands covering the window
+  '''
+  from mpi4py import MPI
+
+  snktot,_,_,nspin = Hksp.shape
+  nbnd = 0
+  for ispin in range(nspin):
+    for ik in range(snktot):
+      E = spl.eigh(Hksp[ik,:,:,ispin], lower=False, eigvals_only=True, subset_by_value=(-np.inf,emax), driver='evr', check_finite=False)
+      nbnd = max(nbnd, E.shape[0])
+
+  return MPI.COMM_WORLD.allreduce(nbnd, op=MPI.MAX)
+
+
+def do_pao_eigh ( data_controller, backend='numpy', nthreads=1, kchunk=64, nbnd=None, emax=None ):
   from mpi4py import MPI
 
-  rank = MPI.COMM_WORLD.Get_rank()
+  comm = MPI.COMM_WORLD
+  rank = comm.Get_rank()
 
   arrays,attributes = data_controller.data_dicts()
 
   snktot,nawf,_,nspin = arrays['Hksp'].shape
 
-  arrays['E_k'] = np.zeros((snktot,nawf,nspin), dtype=float)
-  arrays['v_k'] = np.zeros((snktot,nawf,nawf,nspin), dtype=complex)
+  # With HubbardU the eigenvalues are shifted to the top of band 'bval', which must be stored
+  nmin = 1
+  if 'HubbardU' in arrays and arrays['HubbardU'].any() != 0.0:
+    nmin = attributes['bval'] + 1
+    if nmin > nawf:
+      raise ValueError('bval (%d) must be lower than the number of orbitals (%d)'%(attributes['bval'],nawf))
+
+  # Restrict the solve to the lowest bands required by 'nbnd' and/or 'emax'. The 'scipy'
+  # backend counts the bands below 'emax' first and solves only for them; the 'numpy'
+  # backend computes the full spectrum anyway, so they are counted from its eigenvalues.
+  if emax is not None and backend != 'numpy':
+    nbelow = count_bands_below(arrays['Hksp'], emax)
+    nbnd = nbelow if nbnd is None else max(nbnd, nbelow)
+    emax = None
+  nsolve = nawf if (nbnd is None or emax is not None) else max(nmin, min(nbnd, nawf))
+
+  E_k = np.zeros((snktot,nsolve,nspin), dtype=float)
+  v_k = np.zeros((snktot,nawf,nsolve,nspin), dtype=complex)
 
   for ispin in range(nspin):
-    for n in range(snktot):
-      arrays['E_k'][n,:,ispin],arrays['v_k'][n,:,:,ispin] = eigh(arrays['Hksp'][n,:,:,ispin], UPLO='U')
+    E_k[:,:,ispin],v_k[:,:,:,ispin] = eigh_stack(arrays['Hksp'][:,:,:,ispin], backend=backend, nthreads=nthreads, kchunk=kchunk, nbnd=nsolve)
+
+  if emax is not None:
+    nbelow = comm.allreduce(int(np.sum(E_k<emax, axis=1).max(initial=0)), op=MPI.MAX)
+    nbnd = nbelow if nbnd is None else max(nbnd, nbelow)
+  nbnd = nawf if nbnd is None else max(nmin, min(nbnd, nawf))
+
+  if nbnd < nsolve:
+    E_k = np.ascontiguousarray(E_k[:,:nbnd])
+    v_k = np.ascontiguousarray(v_k[:,:,:nbnd])
+  arrays['E_k'],arrays['v_k'] = E_k,v_k
+
+  if nbnd < nawf and backend == 'numpy' and rank == 0 and attributes['verbose']:
+    print('NOTE: The \'numpy\' backend computes the full spectrum, so a partial spectrum only reduces storage. Use backend=\'scipy\' to reduce the work.')
+
+  if nbnd < attributes['bnd']:
+    if rank == 0:
+      print('WARNING: Only %d bands are computed in pao_eigh. Setting bnd to %d'%(nbnd,nbnd))
+    attributes['bnd'] = nbnd
 
   arrays['degen'] = get_degeneracies(arrays['E_k'], attributes['bnd'])
 
 
-def do_eigh_calc ( HRaux, SRaux, kq, R, read_S ):
+def do_eigh_calc ( HRaux, SRaux, kq, R, read_S, backend='numpy', nthreads=1 ):
 
   # Compute bands on a selected mesh in the BZ
 
@@ -81,18 +303,15 @@ def do_eigh_calc ( HRaux, SRaux, kq, R, read_S ):
 
   Hks_int = band_loop_H(HRaux, kq, R)
 
+  Sks_int = None
   if read_S:
-    Sks_int = band_loop_S(SRaux, kq, R)
+    Sks_int = np.moveaxis(band_loop_S(SRaux, kq, R), 2, 0)
 
   E_kp = np.empty((nkpi,nawf,nspin), dtype=float)
   v_kp = np.empty((nkpi,nawf,nawf,nspin), dtype=complex)
 
   for ispin in range(nspin):
-    for ik in range(nkpi):
-      if read_S:
-        E_kp[ik,:,ispin],v_kp[ik,:,:,ispin] = spl.eigh(Hks_int[:,:,ik,ispin],Sks_int[:,:,ik])
-      else:
-        E_kp[ik,:,ispin],v_kp[ik,:,:,ispin] = npl.eigh(Hks_int[:,:,ik,ispin],UPLO='U')
+    E_kp[:,:,ispin],v_kp[:,:,:,ispin] = eigh_stack(np.moveaxis(Hks_int[...,ispin],2,0), Sks_int, backend=backend, nthreads=nthreads)
 
   return (E_kp, v_kp)
 
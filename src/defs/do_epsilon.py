@@ -23,6 +23,9 @@ from mpi4py import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
+# Maximum number of (k,band,band,energy) elements in each block of eps_loop
+max_eps_elems = 2**24
+
 def do_dielectric_tensor ( data_controller, ene ):
   from .constants import LL
 
@@ -57,6 +60,7 @@ def do_dielectric_tensor ( data_controller, ene ):
 
 def do_epsilon ( data_controller, ene, ispin, ipol, jpol ):
   from .constants import EPS0, EVTORY, RYTOEV
+  from .kramers_kronig import imaginary_axis_transform
 
   # Compute the dielectric tensor
 
@@ -71,30 +75,27 @@ def do_epsilon ( data_controller, ene, ispin, ipol, jpol ):
   #=======================
   epsi_aux,epsr_aux,jdos_aux,count_aux = eps_loop(data_controller, ene, ispin, ipol, jpol)
 
-  ### TNeeds revision. Each processor is allocating zeros here, when only rank 0 needs it. 
-  ### Can be condensed
-  epsi = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsi_aux, epsi, op=MPI.SUM)
+  # Spectra are summed and post-processed on root only
+  epsi = np.zeros(esize, dtype=float) if rank==0 else None
+  comm.Reduce(epsi_aux, epsi, op=MPI.SUM)
   epsi_aux = None
 
-  epsr = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsr_aux, epsr, op=MPI.SUM)
-  epsr_aux = None
-
-  epsr_aux = epsr_kramerskronig(data_controller, ene, epsi)
-  epsr0 = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsr_aux, epsr0, op=MPI.SUM)
+  epsr = np.zeros(esize, dtype=float) if rank==0 else None
+  comm.Reduce(epsr_aux, epsr, op=MPI.SUM)
   epsr_aux = None
 
-  jdos = np.zeros(esize, dtype=float)
-  comm.Allreduce(jdos_aux, jdos, op=MPI.SUM)
-  jods_aux = None
+  jdos = np.zeros(esize, dtype=float) if rank==0 else None
+  comm.Reduce(jdos_aux, jdos, op=MPI.SUM)
+  jdos_aux = None
 
-  count = np.zeros(1,dtype=float)
-  comm.Allreduce(count_aux, count, op=MPI.SUM)
+  count = np.zeros(1,dtype=float) if rank==0 else None
+  comm.Reduce(count_aux, count, op=MPI.SUM)
   count_aux = None
 
-  ieps = np.zeros(esize, dtype=float)
+  if rank != 0:
+    return(None, None, None, None, None)
+
+  epsr0 = epsr_kramerskronig(data_controller, ene, epsi)
 
   kq_wght = 1./attributes['nkpnts']
   epsi *= 64.0*np.pi*kq_wght/(attributes['omega'])
@@ -104,10 +105,7 @@ def do_epsilon ( data_controller, ene, ispin, ipol, jpol ):
   else:
     epsr =  1. + epsr*64.0*np.pi/(attributes['omega']*attributes['nkpnts']) 
   eels = epsi/(epsi**2+epsr**2)
-  for i in range(esize):
-    for j in range(1,esize):
-        ieps[i] += ene[j]*epsi[j]/(ene[i]**2+ene[j]**2)
-  ieps = 1.0 + (2./np.pi)*ieps*(ene[3]-ene[2])
+  ieps = 1.0 + imaginary_axis_transform(ene, epsi)
   jdos /= (4.*count[0])
 
   return(epsi, epsr, eels, jdos, ieps)
@@ -117,10 +115,6 @@ def eps_loop ( data_controller, ene, ispin, ipol, jpol):
   from .constants import EPS0, EVTORY, RYTOEV, BOHR_RADIUS_ANGS
   from .smearing import intgaussian,gaussian,intmetpax,metpax
 
-### What is this?
-  orig_over_err = np.geterr()['over']
-  np.seterr(over='raise')
-
   arrays,attributes = data_controller.data_dicts()
 
   esize = ene.size
@@ -138,91 +132,84 @@ def eps_loop ( data_controller, ene, ispin, ipol, jpol):
   epsi = np.zeros(esize, dtype=float)
   epsr = np.zeros(esize, dtype=float)
 
+  E_k = arrays['E_k'][:,:bnd,ispin]
+
   fn = None
   if smearing == None:
-    fn = 2.*1./(1.+np.exp(arrays['E_k'][:,:bnd,ispin]/temp))
+    with np.errstate(over='ignore'):
+      fn = 2.*1./(1.+np.exp(E_k/temp))
   elif smearing == 'gauss':
-    fn = 2.*intgaussian(arrays['E_k'][:,:bnd,ispin], Ef, arrays['deltakp'][:,:bnd,ispin])
+    fn = 2.*intgaussian(E_k, Ef, arrays['deltakp'][:,:bnd,ispin])
   elif smearing == 'm-p':
-    fn = 2.*intmetpax(arrays['E_k'][:,:bnd,ispin], Ef, arrays['deltakp'][:,:bnd,ispin])
+    fn = 2.*intmetpax(E_k, Ef, arrays['deltakp'][:,:bnd,ispin])
 
   # apparently there are numerical instabilities if energy levels are not completely occupied or completely empty - needs to be tested for metals
   if not attributes['metal']:
     fn = np.round(fn,0)
   count = np.zeros(1,dtype=float)
 
-  bndmax = bnd
-
-  for ik in range(fn.shape[0]):
-    for iband2 in range(bndmax):
-       for iband1 in range(bndmax):
-          if iband1 != iband2:
-             E_diff_nm = arrays['E_k'][ik,iband2,ispin] - arrays['E_k'][ik,iband1,ispin]
-             f_nm =  fn[ik,iband2]-fn[ik,iband1]
-             if np.abs(f_nm) > 2.e-3 and fn[ik,iband1] > 1.e-4 and fn[ik,iband2] < 2.0:
-                pksp2 = np.real(arrays['pksp'][ik,ipol,iband1,iband2,ispin]*arrays['pksp'][ik,jpol,iband2,iband1,ispin])
-                pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV)
-                epsi[:] +=  pksp2*delta*ene[:]*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
-                epsr[:] +=  pksp2*(E_diff_nm**2-ene[:]**2)*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
-                jdos[:] +=  delta*(fn[ik,iband1]-fn[ik,iband2])/(np.pi*((E_diff_nm-ene[:])**2+delta**2))
-                count[0] += (fn[ik,iband1]-fn[ik,iband2])
+  pfac = attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV)
+  offdiag = ~np.eye(bnd, dtype=bool)
+
+  # Interband transitions iband1 -> iband2, for blocks of k points
+  nkb = max(1, max_eps_elems//(bnd*bnd*esize))
+  for ks in range(0, snktot, nkb):
+    ke = min(snktot, ks+nkb)
+    f1 = fn[ks:ke,:,None]
+    f2 = fn[ks:ke,None,:]
+
+    # Allowed transitions, with shape (nkb,iband1,iband2)
+    allowed = (np.abs(f2-f1) > 2.e-3) & (f1 > 1.e-4) & (f2 < 2.0) & offdiag
+    ik,ib1,ib2 = np.nonzero(allowed)
+    if ik.size == 0:
+      continue
+    ik += ks
+
+    E_diff_nm = E_k[ik,ib2] - E_k[ik,ib1]
+    pksp2 = pfac*np.real(arrays['pksp'][ik,ipol,ib1,ib2,ispin]*arrays['pksp'][ik,jpol,ib2,ib1,ispin])
+    f_1 = fn[ik,ib1]
+    f_12 = f_1 - fn[ik,ib2]
+
+    # Accumulate the spectra of every transition in the block as matrix products
+    dE2 = E_diff_nm[:,None]**2 - ene[None,:]**2
+    denom = dE2**2 + delta**2*ene[None,:]**2
+    weight = pksp2*f_1/E_diff_nm
+    epsi += delta*ene*(weight @ (1./denom))
+    epsr += weight @ (dE2/denom)
+    jdos += delta*(f_12 @ (1./((E_diff_nm[:,None]-ene[None,:])**2+delta**2)))/np.pi
+    count[0] += np.sum(f_12)
 
   if attributes['metal']:
     if rank == 0: print('NOT TESTED - needs different delta for intraband transitions and degauss from QE + check on units!!!')
     degauss=0.05
     fnF = None
     if smearing is None:
-      fnF = np.empty((snktot,bnd), dtype=float)
-      for n in range(bnd):
-        for i in range(snktot):
-          try:
-            fnF[i,n] = .5/(1.+np.cosh(arrays['E_k'][i,n,ispin]/temp))
-          except:
-            fnF[i,n] = 1e8
+      with np.errstate(over='ignore'):
+        fnF = .5/(1.+np.cosh(E_k/temp))
       fnF /= temp
     elif smearing == 'gauss':
  ## Why .03* here?
-      fnF = gaussian(arrays['E_k'][:,:bnd,ispin], Ef, .03*arrays['deltakp'][:,:bnd,ispin])
+      fnF = gaussian(E_k, Ef, .03*arrays['deltakp'][:,:bnd,ispin])
     elif smearing == 'm-p':
-      fnF = metpax(arrays['E_k'][:,:bnd,ispin], Ef, arrays['deltakp'][:,:bnd,ispin])
+      fnF = metpax(E_k, Ef, arrays['deltakp'][:,:bnd,ispin])
 
-    for ik in range(fn.shape[0]):
-      for iband1 in range(bndmax):
-        pksp2 = np.real(arrays['pksp'][ik,ipol,iband1,iband1,ispin]*arrays['pksp'][ik,jpol,iband1,iband1,ispin])
-        pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV**3)
-        epsi[:] +=  pksp2*delta*ene[:]*fnF[ik,iband1]/((ene[:]**4+delta**2*ene[:]**2)*degauss)
-        epsr[:] -=  pksp2*fnF[ik,iband1]*ene[:]**2/((ene[:]**4+delta**2*ene[:]**2)*degauss)
+    # Intraband terms share the same energy dependence
+    pksp = arrays['pksp'][:,:,np.arange(bnd),np.arange(bnd),ispin]
+    pksp2 = np.sum(np.real(pksp[:,ipol]*pksp[:,jpol])*fnF)
+    pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV**3)
+    epsi +=  pksp2*delta*ene/((ene**4+delta**2*ene**2)*degauss)
+    epsr -=  pksp2*ene**2/((ene**4+delta**2*ene**2)*degauss)
 
-  np.seterr(over=orig_over_err)
   return(epsi, epsr, jdos, count)
 
 
 def epsr_kramerskronig ( data_controller, ene, epsi ):
   from .smearing import intmetpax
-  from scipy.integrate import simps
-  from .communication import load_balancing
+  from .kramers_kronig import kk_real
 
   arrays,attributes = data_controller.data_dicts()
 
-  esize = ene.size
-  de = ene[1] - ene[0]
-
-  epsr = np.zeros(esize, dtype=float)
-
-  ini_ie,end_ie = load_balancing(comm.Get_size(), rank, esize)
-
-  # Range checks for Simpson Integrals
-  if end_ie == ini_ie:
-    return
-  if ini_ie < 3:
-    ini_ie = 3
-  if end_ie == esize:
-    end_ie = esize-1
-
+  # Damp the spectrum above the energy shift before transforming
   f_ene = intmetpax(ene, attributes['shift'], 1.)
-  for ie in range(ini_ie, end_ie):
-    I1 = simps(ene[1:(ie-1)]*de*epsi[1:(ie-1)]*f_ene[1:(ie-1)]/(ene[1:(ie-1)]**2-ene[ie]**2))
-    I2 = simps(ene[(ie+1):esize]*de*epsi[(ie+1):esize]*f_ene[(ie+1):esize]/(ene[(ie+1):esize]**2-ene[ie]**2))
-    epsr[ie] = 2.*(I1+I2)/np.pi
 
-  return epsr
+  return kk_real(ene, epsi*f_ene)
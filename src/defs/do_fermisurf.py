@@ -37,18 +37,18 @@ def do_fermisurf ( data_controller ):
     if attr['verbose']:
       print('Writing bxsf file for Fermi Surface')
 
-    nawf,nktot = attr['nawf'],attr['nkpnts']
+    nktot,nbnd = attr['nkpnts'],E_kf.shape[1]
     nk1,nk2,nk3 = attr['nk1'],attr['nk2'],attr['nk3']
     fermi_up,fermi_dw = attr['fermi_up'],attr['fermi_dw']
 
-    E_ks = np.reshape(E_kf, (nk1,nk2,nk3,nawf,attr['nspin']))
+    E_ks = np.reshape(E_kf, (nk1,nk2,nk3,nbnd,attr['nspin']))
 
     for ispin in range(attr['nspin']):
 
       ind_plot = []
       eigband = []
 
-      for ib in range(nawf):
+      for ib in range(nbnd):
         E_k_min = np.amin(E_kf[:,ib,ispin])
         E_k_max = np.amax(E_kf[:,ib,ispin])
         btwUp = E_k_min < fermi_up and E_k_max > fermi_up
@@ -40,37 +40,122 @@ size = comm.Get_size()
 
 #np.set_printoptions(precision=8, threshold=100, edgeitems=50, linewidth=350, suppress=True)
 
-def band_loop_H ( ini_ik, end_ik, HRaux, kq, R ):
-  nawf,_,_,nspin = HRaux.shape
-  kdot = np.zeros((1,R.shape[0]), dtype=complex, order='C')
-  kdot = np.tensordot(R, 2.0j*np.pi*kq[:,ini_ik:end_ik], axes=([1],[0]))
-  np.exp(kdot, kdot)
+# Maximum number of Hamiltonian elements built at once when screening the search grid
+max_weyl_elems = 2**24
 
-  auxh = np.zeros((nawf,nawf,1,nspin), dtype=complex, order='C')
-  for ispin in range(nspin):
-    auxh[:,:,ini_ik:end_ik,ispin] = np.tensordot(HRaux[:,:,:,ispin], kdot, axes=([2],[0]))
-  return auxh
+# Each search box is screened on a grid of screen_nsub**3 sub-box centres
+screen_nsub = 2
 
-def gen_eigs ( HRaux, kq, R ):
-  # Load balancing
+# Largest gap accepted as a band crossing
+weyl_gap_tol = 1.e-5
+
+# Latitude circles, and points on each circle, of the spheres enclosing Weyl candidates
+chern_ntheta = 24
+chern_nphi = 24
+
+# Largest Berry phase through a single plaquette for the chirality to be trusted
+chern_max_flux = 1.0
+
+# Candidates closer than this (crystal coordinates, periodic) are the same point
+weyl_merge_tol = 1.e-4
 
-  nawf,_,_,nspin = HRaux.shape
-  E_kp = np.zeros((1,nawf,nspin), dtype=np.float64)
+# Smallest radius of the sphere around a candidate (crystal coordinates)
+chern_min_rad = 1.e-3
 
-  kq=kq[:,None]
 
-#  Hks_int  = np.zeros((nawf,nawf,1,nspin),dtype=complex,order='C') # final data arrays
-  Hks_int = band_loop_H(0,1,HRaux,kq,R)
+def weyl_hamiltonian ( HRs, ispin=0 ):
+  # Real space Hamiltonian of one spin as a contiguous (nR,nawf*nawf) matrix,
+  # so that the R->k transform of a set of k points is a single matrix product
+  nawf,_,nR,_ = HRs.shape
+  return np.ascontiguousarray(np.moveaxis(HRs[:,:,:,ispin],2,0)).reshape((nR,nawf*nawf))
 
-  for ispin in range(nspin):
-    E_kp[:,:,ispin] =  LAN.eigvalsh(Hks_int[:,:,0,ispin],UPLO='U')
 
-  return E_kp
+def band_pair_energies ( HRf, R, kq, nawf, nelec ):
+  '''
+  Energies of bands nelec-1 and nelec at a set of k points, building the
+  Hamiltonians in chunks of at most max_weyl_elems elements
 
+  Arguments:
+      HRf (ndarray): Real space Hamiltonian from weyl_hamiltonian, shape (nR,nawf*nawf)
+      R (ndarray): Lattice vectors in crystal coordinates, shape (nR,3)
+      kq (ndarray): k points in crystal coordinates, shape (nk,3)
+      nawf (int): Number of orbitals
+      nelec (int): Index of the upper band of the pair
 
-def get_gap ( HR, kq, R, nelec ):
-  E_kp = gen_eigs(HR, kq, R)
-  return E_kp[0,nelec,0] - E_kp[0,nelec-1,0]
+  Returns:
+      E (ndarray): Band energies with shape (nk,2)
+  '''
+  nk = kq.shape[0]
+  E = np.empty((nk,2), dtype=float)
+  kchunk = max(1, max_weyl_elems//max(nawf*nawf,R.shape[0]))
+  for ks in range(0, nk, kchunk):
+    ke = min(nk, ks+kchunk)
+    E[ks:ke] = LAN.eigvalsh(hamiltonian_stack(HRf,R,kq[ks:ke],nawf), UPLO='U')[:,nelec-1:nelec+1]
+  return E
+
+
+def hamiltonian_stack ( HRf, R, kq, nawf ):
+  # H(k) with shape (nk,nawf,nawf) at the crystal k points kq (nk,3)
+  return (np.exp(2.0j*np.pi*(kq@R.T))@HRf).reshape((kq.shape[0],nawf,nawf))
+
+
+def gap_and_gradient ( HRf, R, kq, nawf, nelec ):
+  '''
+  Gap between bands nelec-1 and nelec at one k point, and its gradient with respect
+  to the crystal coordinates from the Hellmann-Feynman theorem, dE_n/dk = <u_n|dH/dk|u_n>.
+  H(k) and the three components of dH/dk are built from the same R sum, and only
+  the two bands around the gap are solved for.
+
+  Returns:
+      (gap, grad): Gap (float) and its gradient with shape (3,)
+  '''
+  ph = np.exp(2.0j*np.pi*(R@kq))
+  W = np.vstack((ph,2.0j*np.pi*R.T*ph))
+  Hd = (W@HRf).reshape((4,nawf,nawf))
+
+  E,v = scipy.linalg.eigh(Hd[0], lower=False, subset_by_index=[nelec-1,nelec], check_finite=False)
+  dE = np.real(np.einsum('an,jab,bn->nj', np.conj(v), Hd[1:], v))
+
+  return E[1]-E[0], dE[1]-dE[0]
+
+
+def spectral_norm_bound ( A ):
+  # Upper bound sqrt(||A||_1 ||A||_inf) on the spectral norm of each matrix in a stack (...,n,n)
+  aA = np.abs(A)
+  return np.sqrt(np.amax(np.sum(aA,axis=-2),axis=-1)*np.amax(np.sum(aA,axis=-1),axis=-1))
+
+
+def gap_screen ( HRf, R, kq, nawf, nelec, hw ):
+  '''
+  Gap between bands nelec-1 and nelec at a set of k points, with an upper bound on how
+  much it can change within a box of half widths hw (crystal coordinates) around each point.
+  Every band moves by at most ||H(k+d)-H(k)||, which is bounded both globally by
+    sum_R ||H(R)|| min(2, 2pi |R|.hw)
+  and, from the expansion of exp(2 pi i R.d) to first order, at each point by
+    sum_j hw_j ||dH/dk_j(k)|| + 1/2 sum_R ||H(R)|| (2pi |R|.hw)**2
+  The derivatives are only built at the points which the global bound does not already exclude.
+
+  Returns:
+      (gaps, bounds): Arrays with shape (nk,)
+  '''
+  nrm = spectral_norm_bound(HRf.reshape((-1,nawf,nawf)))
+  Rhw = 2.0*np.pi*(np.abs(R)@hw)
+  glob = np.sum(nrm*np.minimum(2.0,Rhw))
+  second = 0.5*np.sum(nrm*Rhw**2)
+
+  gaps = np.diff(band_pair_energies(HRf,R,kq,nawf,nelec), axis=1)[:,0]
+  bounds = np.full(kq.shape[0], 2.0*glob)
+
+  refine = np.where(gaps <= bounds+weyl_gap_tol)[0]
+  kchunk = max(1, max_weyl_elems//(3*max(nawf*nawf,R.shape[0])))
+  for ks in range(0, refine.shape[0], kchunk):
+    ik = refine[ks:ks+kchunk]
+    ph = np.exp(2.0j*np.pi*(kq[ik]@R.T))
+    W = 2.0j*np.pi*R.T[None,:,:]*ph[:,None,:]
+    dH = (W.reshape((-1,R.shape[0]))@HRf).reshape((ik.shape[0],3,nawf,nawf))
+    bounds[ik] = 2.0*np.minimum(glob, spectral_norm_bound(dH)@hw+second)
+
+  return gaps, bounds
 
 
 def get_R_grid_fft ( nr1, nr2, nr3 ):
@@ -125,52 +210,42 @@ def find_weyl ( data_controller, test_rad, search_grid ):
 
   CAND,ene = find_min(HRs, nelec, R, b_vectors, symf, verbose, search_grid)
   
+  if rank == 0 and symf:
+    # get all equiv k
+    CAND = get_equiv_k(CAND, symops, TR_flag, mag_soc)
+  CAND = comm.bcast(CAND)
+
+  # The same node is found once in each search box sharing it
+  CAND = merge_candidates(CAND, weyl_merge_tol)
+
+  # Sphere radius: test_rad, or half the distance to the nearest other candidate,
+  # but no less than chern_min_rad. Candidates closer than that are not resolved.
+  k_rad = np.full(CAND.shape[0], float(test_rad))
+  if CAND.shape[0] > 1:
+    k_rad = np.minimum(k_rad, 0.5*np.amin(periodic_distances(CAND),axis=1))
+  resolved = k_rad >= chern_min_rad
+  k_rad = np.maximum(k_rad, chern_min_rad)
+
+  chern,max_flux = weyl_chirality(HRs, R, CAND, k_rad, nelec)
+
   WEYL = {}
   if rank == 0:
-    if symf:
-      # get all equiv k
-      CAND = get_equiv_k(CAND, symops, TR_flag, mag_soc)
 
     if verbose:
       for i in range(CAND.shape[0]):
-        tup = (i+1,) + (CAND[i][j] for j in range(3))
+        tup = (i+1,) + tuple(CAND[i][j] for j in range(3))
         print('Weyl point candidate #%d crystal coord: [ % 5.4f % 5.4f % 5.4f ]\n'%tup)
       for i in range(CAND.shape[0]):
         in_cart = b_vectors.T.dot(CAND[i])
-        tup = (i+1,) + (in_cart[j] for j in range(3))
+        tup = (i+1,) + tuple(in_cart[j] for j in range(3))
         print('Weyl point candidate #%d 2pi/alat: [ % 5.4f % 5.4f % 5.4f ]'%tup)
 
-    try:
-      import z2pack
-      import tbmodels      
-      model = tbmodels.Model.from_wannier_files(hr_file=os.path.join(attr['opath'],'z2pack_hamiltonian.dat'))
-      system = z2pack.tb.System(model,bands=nelec)
-
-      candidates=0
-
-      if not verbose:
-        import logging
-        logging.getLogger('z2pack').setLevel(logging.WARNING)
-
-      for kq in CAND:
-        # if distance between two candidates is very small
-        k_rad = np.amin(np.sqrt(np.sum((kq-CAND)**2,axis=1)))*0.5
-        if k_rad > test_rad:
-          k_rad = test_rad
-        k_rad = 0.005
-
-        surface = z2pack.shape.Sphere(center=tuple(kq), radius=k_rad)
-        result_1 = z2pack.surface.run(system=system, surface=surface)
-        invariant = z2pack.invariant.chern(result_1)
-
-        if invariant != 0:
-          candidates += 1
-          WEYL[str(kq).replace(',','')] = invariant
-
-    except:
-      print('Could not load z2pack to verify chirality of weyl points')
-      for kq in CAND:
-        WEYL[str(kq).replace(',', '')] = '?'
+    for i,kq in enumerate(CAND):
+      if max_flux[i] > chern_max_flux or (not resolved[i] and np.rint(chern[i]) == 0):
+        # The sphere is too coarse, or too close to another node, to resolve the flux
+        WEYL[str(kq).replace(',','')] = '?'
+      elif np.rint(chern[i]) != 0:
+        WEYL[str(kq).replace(',','')] = np.rint(chern[i])
 
     if verbose:
       print()
@@ -192,55 +267,159 @@ def find_weyl ( data_controller, test_rad, search_grid ):
     with open(os.path.join(attr['opath'],'weyl_points.dat'), 'w') as ofo:
       ofo.write(wcs)
 
+def periodic_distances ( kp ):
+  # Distances between points in crystal coordinates, to the nearest periodic image,
+  # with the distance of each point to itself set to infinity
+  dist = np.sqrt(np.sum((((kp[:,None]-kp[None])+0.5)%1.0-0.5)**2, axis=2))
+  np.fill_diagonal(dist, np.inf)
+  return dist
+
+
+def merge_candidates ( kp, tol ):
+  # Keep the first of every group of points closer than tol to a point already kept
+  if kp.shape[0] < 2:
+    return kp
+  close = periodic_distances(kp) < tol
+  keep = np.ones(kp.shape[0], dtype=bool)
+  for i in range(kp.shape[0]):
+    if keep[i]:
+      keep[i+1:] &= ~close[i,i+1:]
+  return kp[keep]
+
+
+def weyl_chirality ( HRs, R, CAND, k_rad, nelec ):
+  '''
+  Chirality of each Weyl candidate, from the Berry flux of the lowest nelec bands
+  through a small sphere around it. The candidates are distributed over the ranks.
+
+  Arguments:
+      HRs (ndarray): Real space Hamiltonian with shape (nawf,nawf,nR,nspin), only the first spin is used
+      R (ndarray): Lattice vectors in crystal coordinates, shape (nR,3)
+      CAND (ndarray): Candidates in crystal coordinates, shape (ncand,3)
+      k_rad (ndarray): Radius of the sphere around each candidate (crystal coordinates)
+      nelec (int): Number of occupied bands
+
+  Returns:
+      (chern, max_flux): Chern number and largest plaquette Berry phase of each sphere, on every rank
+  '''
+  from .communication import load_balancing
+
+  nawf = HRs.shape[0]
+  HRf = weyl_hamiltonian(HRs)
+
+  ini,end = load_balancing(size, rank, CAND.shape[0])
+  res = np.array([sphere_flux(HRf,R,CAND[i],k_rad[i],nawf,nelec) for i in range(ini,end)]).reshape((-1,2))
+  res = np.concatenate(comm.allgather(res))
+
+  return res[:,0], res[:,1]
+
+
+def sphere_flux ( HRf, R, centre, radius, nawf, nelec, ntheta=chern_ntheta, nphi=chern_nphi ):
+  '''
+  Chern number of the lowest nelec bands on a sphere, from the link variables on a grid
+  of latitude circles (T. Fukui, Y. Hatsugai and H. Suzuki, J. Phys. Soc. Jpn. 74, 1674 (2005)).
+  The flux through the strip between neighbouring circles is the change of their Wilson
+  loop phases, accumulated plaquette by plaquette so that no 2pi branch has to be tracked.
+  Circles are solved in stacks holding at most max_weyl_elems elements, from the north
+  pole to the south pole. Each pole is solved once, so the links around it are trivial.
+
+  Returns:
+      (chern, max_flux): Chern number (float, integer up to roundoff) and largest |Berry phase| of a plaquette
+  '''
+  from .do_eigh import eigh_stack
+  from .do_berry_phase import link_phase
+
+  def states ( kq ):
+    return eigh_stack(hamiltonian_stack(HRf,R,kq,nawf), nbnd=nelec)[1]
+
+  theta = np.pi*np.arange(ntheta+1)/ntheta
+  phi = 2.0*np.pi*np.arange(nphi)/nphi
+  nrow = max(1, max_weyl_elems//(nphi*max(nawf*nawf,R.shape[0])))
+
+  prev = np.broadcast_to(states(centre[None]+[0.,0.,radius]), (nphi,nawf,nelec))
+  total,max_flux = 0.,0.
+  for js in range(1, ntheta+1, nrow):
+    je = min(ntheta+1, js+nrow)
+    th = theta[js:min(je,ntheta),None]
+    d = np.stack(np.broadcast_arrays(np.sin(th)*np.cos(phi), np.sin(th)*np.sin(phi), np.cos(th)), axis=-1)
+    V = states(np.reshape(centre+radius*d, (-1,3))).reshape(d.shape[:2]+(nawf,nelec))
+    if je == ntheta+1:
+      pole = np.broadcast_to(states(centre[None]-[0.,0.,radius]), (1,nphi,nawf,nelec))
+      V = np.concatenate((V,pole))
+    V = np.concatenate((prev[None],V))
+
+    # Plaquettes (theta,phi),(theta+1,phi),(theta+1,phi+1),(theta,phi+1), oriented outwards
+    Ut = link_phase(V[:-1], V[1:])
+    Up = link_phase(V, np.roll(V,-1,axis=1))
+    flux = -np.angle(Ut * Up[1:] * np.conj(np.roll(Ut,-1,axis=1)) * np.conj(Up[:-1]))
+
+    total += np.sum(flux)
+    max_flux = max(max_flux, np.amax(np.abs(flux)))
+    prev = V[-1]
+
+  return total/(2.0*np.pi), max_flux
+
+
 def find_min ( HRs, nelec, R, a_vectors, symf, verbose, search_grid=[8,8,8] ):
+  from .communication import load_balancing
 
   snk = tuple(search_grid[i] for i in range(3))
-  #snk2 = search_grid[1]
-  #snk3 = search_grid[2]
-  #search_grid = do_search_grid(snk1,snk2,snk3)
   search_grid = get_search_grid(*snk)
-  
+
+  nawf = HRs.shape[0]
+  HRf = weyl_hamiltonian(HRs)
+
   #get the search grid off possible HSP
   end = np.array([.5]*3)
   start = np.array([-.5]*3)
-  #end1 = end2 = end3 = 0.5
-  #start1 = start2 = start3 = -0.5
   bounds_K  = np.zeros((search_grid.shape[0],3,2))
-  #guess_K   = np.zeros((search_grid.shape[0],3))
 
   #do the bounds for each search subsection of FBZ
   #search in boxes
   bounds_K[:,:,0] = search_grid
   bbox = np.array([(end[i]-start[i])/snk[i] for i in range(3)])
   bounds_K[:,:,1] = search_grid + bbox
-  #initial guess is in the middle of each box
-  guess_K = search_grid + 0.5*bbox
-
-  sgi = np.arange(bounds_K.shape[0], dtype=int)
-  sgi = scatter_full(sgi, 1)
-
-  candidates = np.zeros((sgi.shape[0],3))
-
-  lam_XiP = lambda K: get_gap(HRs, K, R, nelec)
-  for i in range(sgi.shape[0]):
-    solx = OP.minimize(lam_XiP, guess_K[sgi[i]], bounds=bounds_K[sgi[i]], method="L-BFGS-B", options={"ftol":1.e-14,"gtol":1.e-12})
-
-    if np.abs(solx.fun) < 1.e-5:
+  nbox = bounds_K.shape[0]
+
+  # Screen each box on the centres of its sub-boxes. A box is kept only if the gap
+  # could close inside one of them, and its minimization starts from the smallest gap.
+  nsub = screen_nsub
+  sub = (np.array(np.meshgrid(*[np.arange(nsub)]*3,indexing='ij')).reshape((3,-1)).T+0.5)*bbox/nsub
+  bs,be = load_balancing(size, rank, nbox)
+  kq = (search_grid[bs:be,None,:]+sub[None,:,:]).reshape((-1,3))
+  gaps,bound = gap_screen(HRf, R, kq, nawf, nelec, 0.5*bbox/nsub)
+  gaps = gaps.reshape((be-bs,nsub**3))
+
+  # Keep any box in which the gap could fall below the tolerance accepted as a hit
+  keep = np.where(np.any(gaps <= bound.reshape(gaps.shape)+weyl_gap_tol, axis=1))[0]
+  guess = kq.reshape((be-bs,nsub**3,3))[keep,np.argmin(gaps[keep],axis=1)]
+  sgi = np.concatenate(comm.allgather(bs+keep))
+  guess_K = np.concatenate(comm.allgather(guess))
+
+  if verbose and rank == 0:
+    print('Minimizing the gap in %d of %d search boxes'%(sgi.shape[0],nbox))
+
+  # Minimize the gap, with its analytic gradient, in the boxes left after screening
+  ms,me = load_balancing(size, rank, sgi.shape[0])
+  candidates = np.zeros((me-ms,3))
+  hits = np.zeros((me-ms,), dtype=bool)
+
+  lam_XiP = lambda K: gap_and_gradient(HRf, R, K, nawf, nelec)
+  for i in range(me-ms):
+    solx = OP.minimize(lam_XiP, guess_K[ms+i], jac=True, bounds=bounds_K[sgi[ms+i]], method="L-BFGS-B", options={"ftol":1.e-14,"gtol":1.e-12})
+
+    if np.abs(solx.fun) < weyl_gap_tol:
       candidates[i] = solx.x
-      
-  candidates = gather_full(candidates,1)
+      hits[i] = True
+
+  candidates = np.concatenate(comm.allgather(candidates[hits]))
 
   ene = None
-  if rank == 0:  
-    # filter out non hits
-    candidates = candidates[np.where(np.sum(candidates,axis=1)!=0.0)]
+  if rank == 0:
     # calculate energy at each candidate to reduce equiv ones
-    ene = np.zeros((candidates.shape[0]))
-    gaps = np.zeros((candidates.shape[0]))
-    for i in range(ene.shape[0]):
-      eigs = gen_eigs(HRs,candidates[i],R)[0,:,0]
-      ene[i] = eigs[nelec]
-      gaps[i] = eigs[nelec]-eigs[nelec-1]
+    eigs = band_pair_energies(HRf, R, candidates, nawf, nelec)
+    ene = eigs[:,1]
+    gaps = eigs[:,1]-eigs[:,0]
 
     if symf:
       # sort by gap size (should be nearly zero)
@@ -254,7 +433,7 @@ def find_min ( HRs, nelec, R, a_vectors, symf, verbose, search_grid=[8,8,8] ):
       if verbose:
        print('\nfound %s non-equivilent candidates'%candidates.shape[0])
        for i in range(ene.shape[0]):
-         tup = (candidates[i][j] for j in range(3)) + (ene[i],)
+         tup = tuple(candidates[i][j] for j in range(3)) + (ene[i],)
          print("[ % 7.4f % 7.4f % 7.4f ] % 4.4f"%tup)
        print()
 
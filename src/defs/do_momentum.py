@@ -19,18 +19,17 @@
 
 def do_momentum ( data_controller ):
   import numpy as np
-  from .perturb_split import perturb_split
+  from .perturb_split import perturb_split_batch
 
   arry,attr = data_controller.data_dicts()
 
   nktot,_,nawf,nawf,nspin = arry['dHksp'].shape
+  nbnd = arry['v_k'].shape[2]
 
-  arry['pksp'] = np.zeros_like(arry['dHksp'])
+  arry['pksp'] = np.zeros((nktot,3,nbnd,nbnd,nspin), dtype=complex)
 
   for ispin in range(nspin):
-    for ik in range(nktot):
-      for l in range(3):
-         arry['pksp'][ik,l,:,:,ispin],_ = perturb_split(arry['dHksp'][ik,l,:,:,ispin], 
-                                                        arry['dHksp'][ik,l,:,:,ispin], 
-                                                        arry['v_k'][ik,:,:,ispin],
-                                                        arry['degen'][ispin][ik])
+    arry['pksp'][:,:,:,:,ispin],_ = perturb_split_batch(arry['dHksp'][:,:,:,:,ispin],
+                                                        None,
+                                                        arry['v_k'][:,:,:,ispin],
+                                                        arry['degen'][ispin])
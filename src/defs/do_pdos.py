@@ -24,6 +24,7 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
 def do_pdos ( data_controller, emin, emax, ne, delta ):
+  from .dos_kernels import smeared_dos
 
   arrays,attributes = data_controller.data_dicts()
 
@@ -38,23 +39,22 @@ def do_pdos ( data_controller, emin, emax, ne, delta ):
 
   for ispin in range(nspin):
 
-    pdosaux = np.zeros((nawf,ne), dtype=float)
-    v_kaux = np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2)
+    # Orbital weights of each state, with shape (snktot,nbnd,nawf)
+    v_kaux = np.moveaxis(np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2), 1, 2)
 
     E_k = arrays['E_k'][:,:,ispin]
 
-    for n in range(ne):
-      taux = np.exp(-((ene[n]-E_k)/delta)**2)/np.sqrt(np.pi)
-      for m in range(nawf):
-        pdosaux[m,n] += np.sum(taux*v_kaux[:,m,:])
+    pdosaux = np.ascontiguousarray(smeared_dos(E_k, ene, delta, weights=v_kaux).T)
 
     pdos = (np.zeros((nawf,ne),dtype=float) if rank==0 else None)
 
     comm.Reduce(pdosaux, pdos, op=MPI.SUM)
     pdosaux = None
 
+    # Normalized like the DoS, so that pdos_sum equals the DoS (versions before the
+    # windowed kernels divided by sqrt(pi) twice, giving PDoS values smaller by sqrt(pi))
     if rank == 0:
-      pdos /= (float(nktot)*np.sqrt(np.pi)*delta)
+      pdos /= float(nktot)
 
     pdos_sum = (np.zeros(ne, dtype=float) if rank==0 else None)
 
@@ -69,7 +69,7 @@ def do_pdos ( data_controller, emin, emax, ne, delta ):
 
 
 def do_pdos_adaptive ( data_controller, emin, emax, ne ):
-  from .smearing import metpax, gaussian
+  from .dos_kernels import smeared_dos
 
   arrays = data_controller.data_arrays
   attributes = data_controller.data_attributes
@@ -84,20 +84,11 @@ def do_pdos_adaptive ( data_controller, emin, emax, ne ):
 
     E_k = np.real(arrays['E_k'][:,:,ispin])
 
-    pdosaux = np.zeros((nawf,ne), dtype=float)
+    v_kaux = np.moveaxis(np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2), 1, 2)
 
-    v_kaux = np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2)
-
-    taux = np.zeros((arrays['deltakp'].shape[0],nawf), dtype=float)
-
-    for n in range (ne):
-      if attributes['smearing'] == 'gauss':
-        taux = gaussian(ene[n], E_k, arrays['deltakp'][:,:,ispin]) 
-      elif attributes['smearing'] == 'm-p':
-        taux = metpax(ene[n], E_k, arrays['deltakp'][:,:,ispin])
-      for i in range(nawf):
-          # Adaptive Gaussian Smearing
-          pdosaux[i,n] += np.sum(taux*v_kaux[:,i,:])
+    # Adaptive Gaussian or Methfessel and Paxton Smearing
+    pdosaux = smeared_dos(E_k, ene, arrays['deltakp'][:,:,ispin], attributes['smearing'], weights=v_kaux)
+    pdosaux = np.ascontiguousarray(pdosaux.T)
 
     pdos = (np.zeros((nawf,ne), dtype=float) if rank==0 else None)
 
@@ -117,3 +108,46 @@ def do_pdos_adaptive ( data_controller, emin, emax, ne ):
 
     fpdos = 'pdosdk_sum_%d.dat'%ispin
     data_controller.write_file_row_col(fpdos, ene, pdos_sum)
+
+
+def do_pdos_tetrahedron ( data_controller, emin, emax, ne, blochl=False ):
+  from .tetrahedron import tetrahedra,gather_eigenvalues,local_kpoint_indices,tetra_dos_projected
+
+  arrays,attributes = data_controller.data_dicts()
+
+  nawf = attributes['nawf']
+  nspin = attributes['nspin']
+  nktot = attributes['nkpnts']
+
+  # PDoS calculation with the linear tetrahedron method
+  emax = np.amin(np.array([attributes['shift'], emax]))
+  ene = np.linspace(emin, emax, ne)
+
+  tets = tetrahedra(attributes['nk1'], attributes['nk2'], attributes['nk3'], arrays['b_vectors'])
+  kidx = local_kpoint_indices(nktot, attributes['npool'])
+
+  for ispin in range(nspin):
+
+    E_k = gather_eigenvalues(arrays['E_k'][:,:,ispin], attributes['npool'])
+
+    v_kaux = np.moveaxis(np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2), 1, 2)
+
+    pdosaux = tetra_dos_projected(E_k, kidx, tets, ene, v_kaux, blochl)
+    pdosaux = np.ascontiguousarray(pdosaux.T)
+    E_k = v_kaux = None
+
+    pdos = (np.zeros((nawf,ne), dtype=float) if rank==0 else None)
+
+    comm.Reduce(pdosaux, pdos, op=MPI.SUM)
+    pdosaux = None
+
+    pdos_sum = (np.zeros(ne, dtype=float) if rank==0 else None)
+
+    for m in range(nawf):
+      if rank == 0:
+        pdos_sum += pdos[m]
+      fpdos = '%d_pdostetra_%d.dat'%(m,ispin)
+      data_controller.write_file_row_col(fpdos, ene, (pdos[m] if rank==0 else None))
+
+    fpdos = 'pdostetra_sum_%d.dat'%ispin
+    data_controller.write_file_row_col(fpdos, ene, pdos_sum)
@@ -34,16 +34,24 @@ def do_projectability ( data_controller ):
   #----------------------
   # Building the Projectability
   #----------------------
-  rank = MPI.COMM_WORLD.Get_rank()
+  comm = MPI.COMM_WORLD
+  rank = comm.Get_rank()
 
   arry,attr = data_controller.data_dicts()
 
   pthr,shift = attr['pthr'],attr['shift']
 
+  # Projections distributed over k points (read_atomic_proj_QE with distribute=True)
+  nkl = arry['U'].shape[2]
+  if nkl != attr['nkpnts']:
+    Pn = build_Pn(attr['nawf'], attr['nbnds'], nkl, attr['nspin'], arry['U'])
+    Pn = comm.reduce(Pn*nkl/attr['nkpnts'], root=0)
+
   if rank != 0:
     attr['shift'] = None
   else:
-    Pn = build_Pn(attr['nawf'], attr['nbnds'], attr['nkpnts'], attr['nspin'], arry['U'])
+    if nkl == attr['nkpnts']:
+      Pn = build_Pn(attr['nawf'], attr['nbnds'], attr['nkpnts'], attr['nspin'], arry['U'])
 
     if attr['verbose']:
       print('Projectability vector ', Pn)
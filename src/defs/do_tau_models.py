@@ -28,7 +28,7 @@ epso = 8.854187817e-12
 
 def acoustic_model ( temp, eigs, params ):
   # Formula from fiorentini paper on Mg3Sb2
-  temp *= ev2j
+  temp = temp*ev2j
   E = eigs * ev2j # Eigenvalues in J
   v = params['v'] # Velocity in m/s
   rho = params['rho'] # Mass density kg/m^3
@@ -40,7 +40,7 @@ def acoustic_model ( temp, eigs, params ):
 
 def optical_model ( temp, eigs, params ):
   # Formula from jacoboni theory of electron transport in semiconductors
-  temp *= ev2j
+  temp = temp*ev2j
   E = eigs * ev2j
   hwlo = np.array(params['hwlo'])*ev2j # Phonon freq
   rho = params['rho'] # Mass density kg/m^3
@@ -58,7 +58,7 @@ def optical_model ( temp, eigs, params ):
 
 def polar_acoustic_model ( temp, eigs, params ):
 
-  temp *= ev2j
+  temp = temp*ev2j
   E = eigs * ev2j
   piezo = params['piezo']  # Piezoelectric constant
   nd = np.abs(params['doping_conc'])*1e6 # Doping concentration in /m^3
@@ -77,7 +77,7 @@ def polar_acoustic_model ( temp, eigs, params ):
 
 def polar_optical_model ( temp, eigs, params ):
   # Formula from fiorentini paper on Mg3Sb2
-  temp *= ev2j
+  temp = temp*ev2j
   E = eigs * ev2j
   Ef = params['Ef']*ev2j #fermi energy
   hwlo = np.array(params['hwlo'])*ev2j # Phonon freq
@@ -118,7 +118,7 @@ def polar_optical_model ( temp, eigs, params ):
 
 def impurity_model ( temp, eigs, params ):
   #formula from fiorentini paper on Mg3Sb2
-  temp *= ev2j
+  temp = temp*ev2j
   E = eigs * ev2j
   nI = np.abs(params['nI'])*1e6 # impurity conc in /m^3
   Zi = params['Zi']
@@ -135,7 +135,8 @@ def impurity_model ( temp, eigs, params ):
 def builtin_tau_model ( label, params, weight ):
   from .TauModel import TauModel
 
-  model = TauModel(params=params, weight=weight)
+  # The builtin models broadcast arrays of temperatures against the eigenvalues
+  model = TauModel(params=params, weight=weight, vectorized=True)
 
   if label == 'acoustic':
     model.function = acoustic_model
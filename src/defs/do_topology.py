@@ -21,6 +21,9 @@ import os
 import numpy as np
 from numpy import linalg as npl
 
+# Maximum number of complex elements of the k-space derivatives held at once on each rank
+max_topology_elems = 2**24
+
 # Compute Z2 invariant and topological properties on a selected path in the BZ
 def do_topology ( data_controller ):
   from mpi4py import MPI
@@ -131,99 +134,62 @@ def do_topology ( data_controller ):
 
       f.write('3D case: v0;v1,v2,v3 = %1d;%1d,%1d,%1d \n' %(v0,v1,v2,v3))
 
-  # Compute momenta and kinetic energy
+  # Momenta, and the second derivative for the effective mass, on this rank's part of the path
   kq_aux = scatter_full(arrays['kq'].T, npool)
   kq_aux = kq_aux.T
+  nkl = kq_aux.shape[1]
 
-  # Compute R*H(R)
+  # R*H(R) and R*R*H(R) weights of each derivative component
   Rfft = np.reshape(arrays['Rfft'], (nk1*nk2*nk3,3), order='C')
-  HRs = np.reshape(HRs, (nawf,nawf,nk1*nk2*nk3,nspin), order='C')
-  HRs = np.moveaxis(HRs, 2, 0)
-
-  HRs_aux = scatter_full(HRs, npool)
-  Rfft_aux = scatter_full(Rfft, npool)
-
-  HRs = np.reshape(np.moveaxis(HRs,0,2), (nawf,nawf,nk1,nk2,nk3,nspin), order='C')
-
-  if spin_Hall:
-    Sj = arrays['Sj']
-    jks = np.zeros((kq_aux.shape[1],3,bnd,bnd,nspin), dtype=complex)
-
-  pks = np.zeros((kq_aux.shape[1],3,bnd,bnd,nspin), dtype=complex)
-  for l in range(3):
-    dHRs  = np.zeros((HRs_aux.shape[0],nawf,nawf,nspin),dtype=complex)
-    for ispin in range(nspin):
-      for n in range(nawf):
-        for m in range(nawf):
-          dHRs[:,n,m,ispin] = 1.0j*alat*ANGSTROM_AU*Rfft_aux[:,l]*HRs_aux[:,n,m,ispin]
-
-    dHRs = gather_full(dHRs, npool)
-    if rank != 0:
-      dHRs = np.zeros((nk1*nk2*nk3,nawf,nawf,nspin), dtype=complex)
-    comm.Bcast(dHRs)
-    dHRs = np.moveaxis(dHRs,0,2)
-
-    # Compute dH(k)/dk on the path
-    dHks_aux = band_loop_H(dHRs, Rfft, kq_aux, nawf, nspin)
-
-    dHRs = None
-
-    # Compute momenta
-    for ik in range(dHks_aux.shape[0]):
-      for ispin in range(nspin):
-        pks[ik,l,:,:,ispin] = np.conj(arrays['v_k'][ik,:,:,ispin].T).dot(dHks_aux[ik,:,:,ispin]).dot(arrays['v_k'][ik,:,:,ispin])[:bnd,:bnd]
-
+  weights = 1.0j*alat*ANGSTROM_AU*Rfft.T
+  if eff_mass:
+    weights = np.vstack((weights, -1.0*alat**2*ANGSTROM_AU**2*Rfft[:,ipol]*Rfft[:,jpol]))
+  nc = weights.shape[0]
+
+  HRf = np.reshape(HRs, (nawf,nawf,nk1*nk2*nk3,nspin), order='C')
+  HRf = np.reshape(np.moveaxis(HRf,2,0), (nk1*nk2*nk3,nawf*nawf*nspin))
+
+  # pks[ik,ispin,l] = <n|dH/dk_l|m>, tks[ik,ispin] = <n|d2H/dk_i dk_j|n>,
+  # jks[ik] = <n|{Sj,dH/dk_i}/2|m> (first spin only)
+  pks = np.empty((nkl,nspin,3,bnd,bnd), dtype=complex)
+  tks = (np.empty((nkl,nspin,bnd), dtype=complex) if eff_mass else None)
+  jks = (np.empty((nkl,bnd,bnd), dtype=complex) if spin_Hall else None)
+
+  kchunk = max(1, max_topology_elems//(nc*max(nawf*nawf*nspin,Rfft.shape[0])))
+  for ks in range(0, nkl, kchunk):
+    ke = min(nkl, ks+kchunk)
+
+    # Compute the derivatives of H(k) on the path, shape (nk,nspin,nc,nawf,nawf)
+    dHks = derivatives_R_to_k(HRf, Rfft, kq_aux[:,ks:ke], weights)
+    dHks = np.moveaxis(np.reshape(dHks, (ke-ks,nc,nawf,nawf,nspin)), 4, 1)
+
+    V = np.moveaxis(arrays['v_k'][ks:ke,:,:bnd,:], 3, 1)
+    Vh = np.conj(np.swapaxes(V,2,3))
+
+    pks[ks:ke] = Vh[:,:,None] @ dHks[:,:,:3] @ V[:,:,None]
+    if eff_mass:
+      tks[ks:ke] = np.einsum('ksan,ksab,ksbn->ksn', np.conj(V), dHks[:,:,3], V)
     if spin_Hall:
-      for ik in range(pks.shape[0]):
-        for ispin in range(nspin):
-          jks[ik,l,:,:,ispin] = (np.conj(arrays['v_k'][ik,:,:,ispin].T).dot \
-            (0.5*(np.dot(Sj[spol],dHks_aux[ik,:,:,ispin])+np.dot(dHks_aux[ik,:,:,ispin],Sj[spol]))).dot(arrays['v_k'][ik,:,:,ispin]))[:bnd,:bnd]
+      Sj,dHi = arrays['Sj'][spol],dHks[:,0,ipol]
+      jks[ks:ke] = Vh[:,0] @ (0.5*(Sj@dHi+dHi@Sj)) @ V[:,0]
+    dHks = None
 
-  if eff_mass == True:
-    tks = np.zeros((kq_aux.shape[1],3,3,bnd,bnd,nspin), dtype=complex)
+  HRf = None
 
-    for l in range(3):
-      for lp in range(3):
-        d2HRs = np.zeros((HRs_aux.shape[0],nawf,nawf,nspin), dtype=complex)
-        for ispin in range(nspin):
-          for n in range(nawf):
-            for m in range(nawf):
-              d2HRs[:,n,m,ispin] = -1.0*alat**2*ANGSTROM_AU**2*Rfft_aux[:,l]*Rfft_aux[:,lp]*HRs_aux[:,n,m,ispin]
-
-        d2HRs = gather_full(d2HRs, npool)
-        if rank != 0:
-          d2HRs = np.zeros((nk1*nk2*nk3,nawf,nawf,nspin), dtype=complex)
-        comm.Bcast(d2HRs)
-        d2HRs = np.moveaxis(d2HRs, 0, 2)
-
-        # Compute d2H(k)/dk*dkp on the path
-        d2Hks_aux = band_loop_H(d2HRs, Rfft, kq_aux, nawf, nspin)
-
-        d2HRs = None
-
-        # Compute kinetic energy
-        for ik in range(d2Hks_aux.shape[0]):
-          for ispin in range(nspin):
-            tks[ik,l,lp,:,:,ispin] = (np.conj(arrays['v_k'][ik,:,:,ispin].T).dot(d2Hks_aux[ik,:,:,ispin]).dot(arrays['v_k'][ik,:,:,ispin]))[:bnd,:bnd]
-
-        d2Hks_aux = None
+  E_k = np.moveaxis(arrays['E_k'][:,:bnd,:], 2, 1)
+  offdiag = ~np.eye(bnd, dtype=bool)
 
+  if eff_mass == True:
     # Compute effective mass
-    mkm1 = np.zeros((tks.shape[0],bnd,3,3,nspin), dtype=complex)
-    for ik in range(tks.shape[0]):
-      for ispin in range(nspin):
-        for n in range(bnd):
-          for m in range(bnd):
-            if m != n:
-              mkm1[ik,n,ipol,jpol,ispin] += (pks[ik,ipol,n,m,ispin]*pks[ik,jpol,m,n,ispin]+pks[ik,jpol,n,m,ispin]*pks[ik,ipol,m,n,ispin]) / \
-                            (arrays['E_k'][ik,n,ispin]-arrays['E_k'][ik,m,ispin]+1.e-16)
-            else:
-              mkm1[ik,n,ipol,jpol,ispin] += tks[ik,ipol,jpol,n,n,ispin]
+    # mkm1[n] = sum_{m!=n} (p_i[n,m]p_j[m,n]+p_j[n,m]p_i[m,n])/(E_n-E_m) + t_ij[n,n]
+    pi,pj = pks[:,:,ipol],pks[:,:,jpol]
+    num = pi*np.swapaxes(pj,2,3) + pj*np.swapaxes(pi,2,3)
+    den = E_k[:,:,:,None] - E_k[:,:,None,:] + 1.e-16
+    mkm1 = np.sum(np.where(offdiag, num/den, 0.), axis=3) + tks
 
+    tks = num = den = None
 
-    tks = None
-
-    mkm1 = gather_full(mkm1, npool)
+    mkm1 = gather_full(np.ascontiguousarray(np.real(mkm1)), npool)
 
 #### Write to data_controller
     #mkm1 *= ELECTRONVOLT_SI**2/H_OVER_TPI**2*ELECTRONMASS_SI
@@ -232,44 +198,41 @@ def do_topology ( data_controller ):
         f = open(os.path.join(attributes['opath'],'effmass'+'_'+str(LL[ipol])+str(LL[jpol])+'_'+str(ispin)+'.dat'),'w')
         for ik in range(nkpi):
           s="%d\t"%ik
-          for  j in np.real(mkm1[ik,:bnd,ipol,jpol,ispin]):s += "% 3.5f\t"%j
+          for  j in mkm1[ik,ispin,:bnd]:s += "% 3.5f\t"%j
           s+="\n"
           f.write(s)
         f.close()
 
     mkm1 = None
 
-  HRs_aux = None
   HRs = None
 
   # Compute Berry curvature
   if Berry or spin_Hall:
     deltab = 0.05
     mu = -0.2 # chemical potential in eV)
-    Om_zk = np.zeros((pks.shape[0],1), dtype=float)
-    Om_znk = np.zeros((pks.shape[0],bnd), dtype=float)
-    Omj_zk = (np.zeros((pks.shape[0],1), dtype=float) if spin_Hall else None)
-    Omj_znk = (np.zeros((pks.shape[0],bnd), dtype=float) if spin_Hall else None)
-    for ik in range(pks.shape[0]):
-      for n in range(bnd):
-        for m in range(bnd):
-          if m != n:
-            if Berry:
-              Om_znk[ik,n] += -1.0*np.imag(pks[ik,jpol,n,m,0]*pks[ik,ipol,m,n,0]-pks[ik,ipol,n,m,0]*pks[ik,jpol,m,n,0])/((arrays['E_k'][ik,m,0] - arrays['E_k'][ik,n,0])**2 + deltab**2)
-            if spin_Hall:
-              Omj_znk[ik,n] += -2.0*np.imag(jks[ik,ipol,n,m,0]*pks[ik,jpol,m,n,0])/((arrays['E_k'][ik,m,0] - arrays['E_k'][ik,n,0])**2 + deltab**2)
-      Om_zk[ik] = np.sum(Om_znk[ik,:]*(0.5 * (1 - np.sign(arrays['E_k'][ik,:bnd,0]))))  # T=0.0K
-      if spin_Hall:
-        Omj_zk[ik] = np.sum(Omj_znk[ik,:]*(0.5 * (1 - np.sign(arrays['E_k'][ik,:bnd,0]-mu))))  # T=0.0K
+    E0,p0 = E_k[:,0],pks[:,0]
+    # (E_m-E_n)**2 + deltab**2 for each pair (n,m)
+    dE2 = (E0[:,None,:]-E0[:,:,None])**2 + deltab**2
+    Om_zk = np.zeros((nkl,1), dtype=float)
+    Omj_zk = (np.zeros((nkl,1), dtype=float) if spin_Hall else None)
+    if Berry:
+      pi,pj = p0[:,ipol],p0[:,jpol]
+      Om_nm = -1.0*np.imag(pj*np.swapaxes(pi,1,2)-pi*np.swapaxes(pj,1,2))/dE2
+      Om_znk = np.sum(np.where(offdiag, Om_nm, 0.), axis=2)
+      Om_zk[:,0] = np.sum(Om_znk*(0.5 * (1 - np.sign(E0))), axis=1)  # T=0.0K
+    if spin_Hall:
+      Omj_nm = -2.0*np.imag(jks*np.swapaxes(p0[:,jpol],1,2))/dE2
+      Omj_znk = np.sum(np.where(offdiag, Omj_nm, 0.), axis=2)
+      Omj_zk[:,0] = np.sum(Omj_znk*(0.5 * (1 - np.sign(E0-mu))), axis=1)  # T=0.0K
+    Om_nm = Omj_nm = dE2 = None
 
   indices = (LL[spol], LL[ipol], LL[jpol])
   lrng = (list(range(nkpi)) if rank==0 else None)
 
-  pks = gather_full(pks, npool)
-  velk = np.zeros((nkpi,3,bnd,nspin), dtype=float) if rank==0 else None
-  if rank == 0:
-    for n in range(bnd):
-      velk[:,:,n,:] = np.real(pks[:,:,n,n,:])
+  # Band velocities, the diagonal of the momenta, as (nk,3,bnd,nspin)
+  velk = np.moveaxis(np.real(np.diagonal(pks, axis1=3, axis2=4)), 1, 3)
+  velk = gather_full(np.ascontiguousarray(velk), npool)
   for l in range(3):
     fvk = 'velocity_'+str(l)
     data_controller.write_bands(fvk, (velk[:,l,:bnd,:] if rank==0 else None))
@@ -288,17 +251,23 @@ def do_topology ( data_controller ):
   Omj_zk = fOmj_zk = None
 
 
-def band_loop_H ( HRaux, R, kq, nawf, nspin ):
-
-  kdot = np.zeros((kq.shape[1],R.shape[0]),dtype=complex,order="C")
-  kdot = np.tensordot(R,2.0j*np.pi*kq,axes=([1],[0]))
-  np.exp(kdot,kdot)
-
-  Haux = np.zeros((nawf,nawf,kq.shape[1],nspin),dtype=complex,order="C")
-
-  for ispin in range(nspin):
-    Haux[:,:,:,ispin] = np.tensordot(HRaux[:,:,:,ispin], kdot, axes=([2],[0]))
-
-  kdot  = None
-  Haux = np.transpose(Haux,(2,0,1,3))
-  return Haux
+def derivatives_R_to_k ( HRf, R, kq, weights ):
+  '''
+  Transform R-weighted Hamiltonians to k space, for all components at once
+    dH_c(k) = sum_R w_c(R) H(R) exp(2 pi i k.R)
+  The weights multiply the phases rather than H(R), so a single matrix product
+  over R yields every component at every k point.
+
+  Arguments:
+      HRf (ndarray): Real space Hamiltonian with shape (nR,nawf*nawf*nspin)
+      R (ndarray): Lattice vectors with shape (nR,3)
+      kq (ndarray): k points with shape (3,nk)
+      weights (ndarray): Weight of each lattice vector for each component, shape (nc,nR)
+
+  Returns:
+      dHk (ndarray): Array with shape (nk,nc,nawf*nawf*nspin)
+  '''
+  kdot = np.exp(2.0j*np.pi*(R@kq)).T
+  nk,nc = kdot.shape[0],weights.shape[0]
+  W = np.reshape(kdot[:,None,:]*weights[None,:,:], (nk*nc,R.shape[0]))
+  return np.reshape(W@HRf, (nk,nc,HRf.shape[1]))
@@ -18,169 +18,62 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 
 
-def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hall, write_to_file, save_tensors ):
+def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hall, write_to_file, save_tensors, write_binary=False ):
   import numpy as np
   from os.path import join
-  from numpy import linalg as npl
-  from .do_Boltz_tensors import do_Boltz_tensors,do_Boltz_tensors_hall
+  from .do_Boltz_tensors import do_Boltz_tensors_temps,do_Boltz_tensors_hall
 
   comm,rank = data_controller.comm,data_controller.rank
   arrays,attr = data_controller.data_dicts()
 
-  esize = ene.size
-  snktot = arrays['E_k'].shape[0]
-  siemen_conv,temp_conv,hall_SI = 6.9884,11604.52500617,9.248931724005307e-13
-  nspin,t_tensor = attr['nspin'],arrays['t_tensor']
+  temps = np.asarray(temps, dtype=float)
+  siemen_conv,temp_conv = 6.9884,11604.52500617
+  nspin = attr['nspin']
   spin_mult = 1. if nspin==2 or attr['dftSO'] else 2.
 
-  for ispin in range(nspin):
-    # Quick function opens file in output folder with name 's'
-    if write_to_file:
-      ojf = lambda st,sp : open(join(attr['opath'],'%s_%d.dat'%(st,sp)), 'w')
-
-      fsigma = ojf('sigma', ispin)
-      fPF = ojf('PF', ispin)
-      fkappa = ojf('kappa', ispin)
-      fSeebeck = ojf('Seebeck', ispin)
-      fsigmadk = ojf('sigmadk', ispin) if attr['smearing']!=None else None
-      if do_hall:
-        fhall = ojf('hall_trace', ispin)
-
-    for iT,temp in enumerate(temps):
-
-      itemp = temp/temp_conv
+  # Transport tensors and their output format
+  tfmt = '%8.2f % .5f % 9.5e % 9.5e % 9.5e % 9.5e % 9.5e % 9.5e'
+  outputs = ['sigma', 'Seebeck', 'kappa', 'PF']
+  if attr['smearing'] is not None:
+    outputs.append('sigmadk')
 
-      # Quick function to write Transport Formatted line to file
-      wtup = lambda fn,tu : fn.write('%8.2f % .5f % 9.5e % 9.5e % 9.5e % 9.5e % 9.5e % 9.5e\n'%tu)
+  for ispin in range(nspin):
 
-      # Quick function to get tuple elements to write
-      gtup = lambda tu,i : (temp,ene[i],tu[0,0,i],tu[1,1,i],tu[2,2,i],tu[0,1,i],tu[0,2,i],tu[1,2,i])
+    # Transport tensors for all temperatures, from a single pass over the k points
+    itemps = temps/temp_conv
+    L = do_Boltz_tensors_temps(data_controller, None, itemps, ene, velkp, ispin, channels, weights)
+    Ldk = None
+    if attr['smearing'] is not None:
+      Ldk = do_Boltz_tensors_temps(data_controller, attr['smearing'], itemps, ene, velkp, ispin, channels, weights, nmoments=1)
+    Lhall = None
+    if do_hall:
+      Lhall = [do_Boltz_tensors_hall(data_controller, None, itemp, ene, velkp, ispin, channels, weights) for itemp in itemps]
+
+    if rank == 0:
+      tensors = transport_tensors(L, temps, spin_mult*siemen_conv/attr['omega'], Ldk=Ldk, Lhall=Lhall)
+      L = Ldk = Lhall = None
+
+      if write_to_file:
+        for k in outputs:
+          with open(join(attr['opath'],'%s_%d.dat'%(k,ispin)), 'w') as f:
+            write_table(f, tfmt, tensor_table(temps, ene, tensors[k]))
+        if do_hall:
+          with open(join(attr['opath'],'hall_trace_%d.dat'%ispin), 'w') as f:
+            write_table(f, '%8.2f % .5f % 9.5e ', tensor_table(temps, ene, tensors['R_hall_trace']))
 
-      if do_hall:
-        wtup_hall = lambda fn,tu : fn.write('%8.2f % .5f % 9.5e \n'%tu)
-        gtup_hall = lambda tu,i : (temp,ene[i],tu[i])
-
-      if attr['smearing'] is not None:
-        L0,_,_ = do_Boltz_tensors(data_controller, attr['smearing'], itemp, ene, velkp, ispin, channels, weights)
-        #----------------------
-        # Conductivity (in units of 1.e21/Ohm/m/s)
-        #----------------------
-        if rank == 0:
-          # convert in units of 10*21 siemens m^-1 s^-1
-          L0 *= spin_mult*siemen_conv/attr['omega']
-          # convert in units of siemens m^-1 s^-1
-          sigma = L0*1.e21
-
-          if write_to_file:   
-            for i in range(esize):
-              wtup(fsigmadk, gtup(sigma,i))
-            sigma = None
-
-        comm.Barrier()
-
-      L0,L1,L2 = do_Boltz_tensors(data_controller, None, itemp, ene, velkp, ispin, channels, weights)
-
-      if do_hall: 
-        L0_hall = do_Boltz_tensors_hall(data_controller, None, itemp, ene, velkp, ispin, channels, weights)
-
-      if rank == 0:
-        #----------------------
-        # Conductivity (in units of /Ohm/m/s)
-        # convert in units of 10*21 siemens m^-1 s^-1
-        #----------------------
-        L0_unconverted = L0*spin_mult/attr['omega']
-        L0 *= spin_mult*siemen_conv/attr['omega']
-        sigma = L0*1.e21 # convert in units of siemens m^-1 s^-1
-        if write_to_file:
-          for i in range(esize):
-            wtup(fsigma, gtup(sigma,i))
-          sigma = None
-        if save_tensors:
-          arrays['sigma'] = sigma
+      if write_binary:
+        np.savez(join(attr['opath'],'transport_%d.npz'%ispin), temps=temps, ene=ene, **tensors)
 
+      if save_tensors:
+        # Tensors at the last temperature, with shape (3,3,esize) or (esize,)
+        arrays['sigma'] = np.moveaxis(tensors['sigma'][-1], 0, -1)
+        arrays['S'] = np.moveaxis(tensors['Seebeck'][-1], 0, -1)
+        arrays['kappa'] = np.moveaxis(tensors['kappa'][-1], 0, -1)
         if do_hall:
-          L0_hall *= spin_mult/(attr['omega'])
-          R_hall = np.zeros((3,3,3,esize), dtype=float)
-          R_hall_trace = np.zeros((esize), dtype=float)
-          for n in range(esize):
-            try:
-              for r in range(3):
-                R_hall[:,:,r,n] = npl.inv(L0_unconverted[:,:,n]) @ L0_hall[:,:,r,n] @ npl.inv(L0_unconverted[:,:,n])
-                #----------------------   
-                # The equivalent to the trace of the Hall tensor is an average
-                # over the even permutations of [0, 1, 2].
-                #----------------------  
-              R_hall_trace[n] = (R_hall[0,1,2,n]+R_hall[2,0,1,n]+R_hall[1,2,0,n])*hall_SI/3
-
-            except:
-              from .report_exception import report_exception
-              print('check t_tensor components - matrix cannot be singular')
-              report_exception()
-              raise e
-          if write_to_file:
-            for i in range(esize):
-              wtup_hall(fhall, gtup_hall(R_hall_trace,i))
-          if save_tensors:
-            arrays['R_hall_trace'] = R_hall_trace
-
-        #----------------------
-        # Seebeck (in units of V/K)
-        # convert in units of 10^21 Amperes m^-1 s^-1
-        #----------------------
-        L1 *= spin_mult*siemen_conv/(temp*attr['omega'])
-
-        S = np.zeros((3,3,esize), dtype=float)
-
-        for n in range(esize):
-          try:
-            S[:,:,n] = -1.*npl.inv(L0[:,:,n]) @ L1[:,:,n]
-          except:
-            from .report_exception import report_exception
-            print('check t_tensor components - matrix cannot be singular')
-            report_exception()
-            raise e
-        if write_to_file:
-          for i in range(esize):
-            wtup(fSeebeck, gtup(S,i))
-        if save_tensors:
-          arrays['S'] = S
-
-        #----------------------
-        # Electron thermal conductivity ((in units of W/m/K/s)
-        # convert in units of kg m s^-4
-        #----------------------
-        L2 *= spin_mult*siemen_conv*1.e15/(temp*attr['omega'])
-
-        kappa = np.zeros((3,3,esize),dtype=float)
-        for n in range(esize):
-          kappa[:,:,n] = (L2[:,:,n] - temp*L1[:,:,n] @ npl.inv(L0[:,:,n]) @ L1[:,:,n])*1.e6
-        L1 = L2 = None
-        if write_to_file:
-          for i in range(esize):
-            wtup(fkappa, gtup(kappa,i))
-          kappa = None
-        if save_tensors:
-          arrays['kappa'] = kappa
-
-        PF = np.zeros((3,3,esize), dtype=float)
-        for n in range(esize):
-          PF[:,:,n] = np.dot(np.dot(S[:,:,n],L0[:,:,n]),S[:,:,n])*1.e21
-        S = L0 = None
-        if write_to_file:
-          for i in range(esize):
-            wtup(fPF, gtup(PF,i))
-          PF = None
-      comm.Barrier()
-
-    if write_to_file:
-      fsigma.close()
-      fPF.close()
-      fkappa.close()
-      fSeebeck.close()
-      if attr['smearing'] is not None:
-        fsigmadk.close()
-      if do_hall:
-        fhall.close()
+          arrays['R_hall_trace'] = tensors['R_hall_trace'][-1]
+      tensors = None
+
+    comm.Barrier()
 
     if save_tensors:
       data_controller.broadcast_single_array('sigma', dtype=float)
@@ -188,3 +81,95 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
       data_controller.broadcast_single_array('kappa', dtype=float)
       if do_hall:
         data_controller.broadcast_single_array('R_hall_trace', dtype=float)
+
+
+def transport_tensors ( L, temps, conv, Ldk=None, Lhall=None ):
+  '''
+  Compute the transport tensors from the L_alpha tensors for all temperatures and
+  chemical potentials at once. The (3,3) systems are solved as stacks over the
+  temperature and energy axes; energies where L0 is singular are reported and
+  their tensors set to NaN.
+
+  Arguments:
+      L (ndarray): L_alpha tensors with shape (ntemps,3,3,3,esize)
+      temps (ndarray): Temperatures in Kelvin
+      conv (float): Conversion of L0 to units of 10^21 siemens m^-1 s^-1 (spin multiplicity included)
+      Ldk (ndarray): (optional) L0 with adaptive smearing, shape (ntemps,1,3,3,esize)
+      Lhall (list): (optional) L0 Hall tensors with shape (3,3,3,esize) for each temperature
+
+  Returns:
+      tensors (dict): 'sigma', 'Seebeck', 'kappa', 'PF' with shape (ntemps,esize,3,3),
+                      plus 'sigmadk' and 'R_hall_trace' (shape (ntemps,esize)) when requested
+  '''
+  import numpy as np
+  from numpy import linalg as npl
+
+  siemen_conv,hall_SI = 6.9884,9.248931724005307e-13
+
+  # Move the energy axis ahead of the Cartesian axes, (ntemps,esize,3,3)
+  stack = lambda A : np.moveaxis(A, -1, 1)
+  T = np.asarray(temps, dtype=float)[:,None,None,None]
+
+  L0 = conv*stack(L[:,0])
+  L1 = conv*stack(L[:,1])/T
+  L2 = conv*1.e15*stack(L[:,2])/T
+
+  # Flag energies where L0 cannot be inverted
+  regular = npl.matrix_rank(L0) == 3
+  nsing = L0.shape[0]*L0.shape[1] - np.count_nonzero(regular)
+  if nsing > 0:
+    print('Warning: L0 is singular at %d (temperature, energy) points. Transport tensors set to NaN there.'%nsing)
+
+  def solve ( A, B ):
+    X = np.full(np.broadcast_shapes(A.shape,B.shape), np.nan)
+    X[regular] = npl.solve(A[regular], np.broadcast_to(B,X.shape)[regular])
+    return X
+
+  tensors = {}
+
+  # Conductivity (in units of siemens m^-1 s^-1)
+  tensors['sigma'] = L0*1.e21
+
+  # Seebeck (in units of V/K)
+  S = -solve(L0, L1)
+  tensors['Seebeck'] = S
+
+  # Electron thermal conductivity (in units of W/m/K/s)
+  tensors['kappa'] = (L2 + T*(L1@S))*1.e6
+
+  # Power factor
+  tensors['PF'] = (S@L0@S)*1.e21
+
+  if Ldk is not None:
+    tensors['sigmadk'] = conv*stack(Ldk[:,0])*1.e21
+
+  if Lhall is not None:
+    # R_ijr = L0^-1 L_hall[r] L0^-1 with L0 and L_hall in units of 1/(Ohm m s)
+    L0inv = solve(L0/siemen_conv, np.eye(3))
+    Lh = (conv/siemen_conv)*np.moveaxis(np.array(Lhall), -1, 1)
+    R = np.einsum('teij,tejkr,tekl->teilr', L0inv, Lh, L0inv)
+    # The equivalent to the trace of the Hall tensor is an average
+    # over the even permutations of [0, 1, 2].
+    tensors['R_hall_trace'] = (R[...,0,1,2]+R[...,2,0,1]+R[...,1,2,0])*hall_SI/3
+
+  return tensors
+
+
+def tensor_table ( temps, ene, X ):
+  # Rows of (temperature, energy, components) for each temperature and energy,
+  # with the components xx,yy,zz,xy,xz,yz of tensors with shape (ntemps,esize,3,3)
+  import numpy as np
+
+  ntemp,esize = X.shape[:2]
+  cols = [np.repeat(temps,esize), np.tile(ene,ntemp)]
+  if X.ndim == 2:
+    cols.append(X.ravel())
+  else:
+    for i,j in [[0,0],[1,1],[2,2],[0,1],[0,2],[1,2]]:
+      cols.append(X[...,i,j].ravel())
+  return np.column_stack(cols)
+
+
+def write_table ( f, fmt, table ):
+  # Write all rows of a table with a single formatted write
+  f.write(((fmt+'\n')*table.shape[0]) % tuple(table.ravel()))
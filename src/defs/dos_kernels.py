@@ -0,0 +1,172 @@
+#
+# PAOFLOW
+#
+# Copyright 2016-2022 - Marco BUONGIORNO NARDELLI (mbn@unt.edu)
+#
+# Reference:
+#
+# F.T. Cerasoli, A.R. Supka, A. Jayaraj, I. Siloi, M. Costa, J. Slawinska, S. Curtarolo, M. Fornari, D. Ceresoli, and M. Buongiorno Nardelli,
+# Advanced modeling of materials with PAOFLOW 2.0: New features and software design, Comp. Mat. Sci. 200, 110828 (2021).
+#
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+
+import numpy as np
+
+# Maximum number of kernel evaluations held in memory at once
+max_kernel_elems = 2**24
+
+# Number of widths beyond which the smearing functions are truncated
+kernel_cutoff = { 'gauss':5., 'm-p':6. }
+
+# Minimum ratio of smearing width to grid spacing for the binned convolution
+# (the relative error from linear binning is about (de/delta)**2/8)
+binning_ratio = 20.
+
+
+def smearing_kernel ( smearing ):
+  from .smearing import gaussian, metpax
+
+  if smearing == 'gauss':
+    return gaussian
+  elif smearing == 'm-p':
+    return metpax
+  raise ValueError('Smearing type %s not supported.\nSmearing types are \'gauss\' and \'m-p\''%str(smearing))
+
+
+def smeared_dos ( E_k, ene, delta, smearing='gauss', weights=None, ncut=None ):
+  '''
+  Sum smearing functions centered on each eigenvalue over a uniform energy grid,
+    dos(e) = sum_i w_i * delta_i(e - E_i)
+  Eigenvalues are first assigned to their nearest grid points, and the kernel is only
+  evaluated within 'ncut' widths of each state. With a single width much larger than
+  the grid spacing, the eigenvalues are instead linearly binned onto the grid and the
+  histogram is convolved with the sampled kernel.
+
+  Arguments:
+      E_k (ndarray): Eigenvalues, of any shape
+      ene (ndarray): Uniformly spaced energy grid
+      delta (float or ndarray): Smearing width, or an array of widths with the shape of E_k (adaptive smearing)
+      smearing (str): Smearing type ('gauss' or 'm-p')
+      weights (ndarray): (optional) Weights with shape E_k.shape+(nw,), e.g. orbital projections for the PDoS
+      ncut (float): (optional) Number of widths within which the kernel is evaluated
+
+  Returns:
+      dos (ndarray): Array with shape (ne,), or (ne,nw) if weights are provided
+  '''
+  kernel = smearing_kernel(smearing)
+  if ncut is None:
+    ncut = kernel_cutoff[smearing]
+
+  ne = ene.shape[0]
+  E = np.ravel(E_k)
+  nst = E.shape[0]
+  w = None if weights is None else np.reshape(weights, (nst,-1))
+
+  e0 = ene[0]
+  de = (ene[-1]-e0)/(ne-1) if ne > 1 else np.inf
+
+  if np.isscalar(delta) and delta >= binning_ratio*de and nst > 0:
+    return binned_convolution(E, w, ene, e0, de, delta, kernel, ncut)
+
+  dlt = np.ravel(np.broadcast_to(delta, np.shape(E_k)))
+
+  # Kernel window of each state, centered on its nearest grid point
+  hw = np.minimum(ne, np.ceil(ncut*dlt/de)).astype(int)
+  i0 = np.rint((E-e0)/de).astype(int) if ne > 1 else np.zeros(nst, dtype=int)
+  lo = np.clip(i0-hw, 0, ne)
+  hi = np.clip(i0+hw+1, 0, ne)
+
+  def smear ( ist, e ):
+    return kernel(e, E[ist,None], dlt[ist,None])
+
+  return accumulate_windows(lo, hi, ene, smear, w)
+
+
+def accumulate_windows ( lo, hi, ene, func, w=None ):
+  '''
+  Accumulate a function of energy over a window of the energy grid for each state,
+    out(e) = sum_i w_i * func_i(e)   for lo_i <= e < hi_i
+  States are visited in chunks of similar window width, holding at most
+  'max_kernel_elems' function values in memory at once.
+
+  Arguments:
+      lo (ndarray): First grid index of each state's window
+      hi (ndarray): One past the last grid index of each state's window
+      ene (ndarray): Energy grid
+      func (function): func(ist, e) evaluates the states with indices 'ist' at energies 'e' (shape (len(ist),width))
+      w (ndarray): (optional) Weights with shape (nst,nw)
+
+  Returns:
+      out (ndarray): Array with shape (ne,), or (ne,nw) if weights are provided
+  '''
+  ne = ene.shape[0]
+  nw = 1 if w is None else w.shape[1]
+  out = np.zeros((ne,nw), dtype=float)
+
+  width = hi - lo
+  order = np.argsort(width, kind='stable')
+  order = order[width[order]>0]
+  nst = order.shape[0]
+
+  ks = 0
+  while ks < nst:
+    wd = width[order[ks]]
+    ke = min(nst, ks+max(1,max_kernel_elems//wd))
+    wd = width[order[ke-1]]
+    while ke-ks > 1 and (ke-ks)*wd > max_kernel_elems:
+      ke = ks + max(1, max_kernel_elems//wd)
+      wd = width[order[ke-1]]
+
+    ist = order[ks:ke]
+    cols = lo[ist,None] + np.arange(wd)[None,:]
+    valid = cols < hi[ist,None]
+    cols = np.minimum(cols, ne-1)
+    vals = np.where(valid, func(ist, ene[cols]), 0.)
+
+    if w is None:
+      out[:,0] += np.bincount(cols.ravel(), weights=vals.ravel(), minlength=ne)
+    else:
+      from scipy.sparse import csr_matrix
+      nc = ist.shape[0]
+      K = csr_matrix((vals.ravel(),cols.ravel(),np.arange(0,nc*wd+1,wd)), shape=(nc,ne))
+      out += K.T @ w[ist]
+    ks = ke
+
+  return out[:,0] if w is None else out
+
+
+def binned_convolution ( E, w, ene, e0, de, delta, kernel, ncut ):
+  # Linearly bin the eigenvalues onto a grid padded by the kernel half width,
+  # then convolve each histogram with the kernel sampled on the grid spacing.
+  from scipy.signal import fftconvolve
+  from scipy.sparse import csr_matrix
+
+  ne = ene.shape[0]
+  npad = int(np.ceil(ncut*delta/de))
+  ngrid = ne + 2*npad
+
+  x = (E-e0)/de + npad
+  inside = np.where((x>=0) & (x<=ngrid-1))[0]
+  x = x[inside]
+  i = np.minimum(np.floor(x).astype(int), ngrid-2)
+  f = x - i
+
+  if w is None:
+    hist = np.bincount(i, weights=1.-f, minlength=ngrid) + np.bincount(i+1, weights=f, minlength=ngrid)
+    hist = hist[:,None]
+  else:
+    nin = inside.shape[0]
+    B = csr_matrix((np.column_stack((1.-f,f)).ravel(),np.column_stack((i,i+1)).ravel(),np.arange(0,2*nin+1,2)), shape=(nin,ngrid))
+    hist = B.T @ w[inside]
+
+  kern = kernel(0., de*np.arange(-npad,npad+1), delta)
+  dos = fftconvolve(hist, kern[:,None], mode='valid', axes=0)
+
+  return dos[:,0] if w is None else dos
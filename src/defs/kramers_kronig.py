@@ -0,0 +1,123 @@
+#
+# PAOFLOW
+#
+# Copyright 2016-2022 - Marco BUONGIORNO NARDELLI (mbn@unt.edu)
+#
+# Reference:
+#
+# F.T. Cerasoli, A.R. Supka, A. Jayaraj, I. Siloi, M. Costa, J. Slawinska, S. Curtarolo, M. Fornari, D. Ceresoli, and M. Buongiorno Nardelli,
+# Advanced modeling of materials with PAOFLOW 2.0: New features and software design, Comp. Mat. Sci. 200, 110828 (2021).
+#
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+
+import numpy as np
+
+# Maximum number of kernel elements held in memory by the matrix transforms
+max_kernel_elems = 2**24
+
+
+def hilbert_transform ( ene, f, odd=True ):
+  '''
+  Principal value transform of a function known on a uniform grid of positive frequencies,
+    g(w) = (1/pi) P int_-inf^inf f(w')/(w'-w) dw'
+  where f is extended to negative frequencies as an odd or even function. The sum over
+  the grid is split into a Toeplitz (w'-w) and a Hankel (w'+w) part, each evaluated
+  as a convolution with FFTs in O(ne log ne).
+
+  Arguments:
+      ene (ndarray): Uniform grid of non-negative frequencies
+      f (ndarray): Function values on the grid, with the frequency along the first axis
+      odd (bool): True if f(-w) = -f(w), False if f(-w) = f(w)
+
+  Returns:
+      g (ndarray): The transform of f on the same grid
+  '''
+  from scipy.signal import fftconvolve
+
+  ne = ene.shape[0]
+  de = (ene[-1]-ene[0])/(ne-1)
+  f = np.asarray(f)
+  shape = (-1,) + (1,)*(f.ndim-1)
+
+  # Trapezoidal weights over [ene[0],ene[-1]]
+  wt = np.full(ne, de)
+  wt[[0,-1]] *= .5
+  wt = wt.reshape(shape)
+  fw = f*wt
+
+  # Kernels, leaving out the singular (self and mirror image at w~0) terms of the principal value
+  m = np.arange(-(ne-1), ne)
+  toep = -1./np.where(m==0, np.inf, m*de)
+  ws = 2*ene[0] + np.arange(2*ne-1)*de
+  hank = 1./np.where(np.abs(ws)<.5*de, np.inf, ws)
+
+  g = fftconvolve(fw, toep.reshape(shape), axes=0)[ne-1:2*ne-1]
+  g += (1. if odd else -1.)*fftconvolve(fw[::-1], hank.reshape(shape), axes=0)[ne-1:2*ne-1]
+
+  # Limit of the regular part (f(w')-f(w))/(w'-w) at w'=w, which the sum leaves out
+  g += np.gradient(f, de, axis=0)*wt
+
+  return g/np.pi
+
+
+def kk_real ( ene, fim ):
+  '''
+  Real part of a causal response function (minus its high frequency limit) from its imaginary part,
+    Re f(w) = (2/pi) P int_0^inf w' Im f(w')/(w'^2-w^2) dw'
+
+  Arguments:
+      ene (ndarray): Uniform grid of non-negative frequencies
+      fim (ndarray): Imaginary part, odd in frequency
+
+  Returns:
+      fre (ndarray): Real part on the same grid
+  '''
+  return hilbert_transform(ene, fim, odd=True)
+
+
+def kk_imag ( ene, fre ):
+  '''
+  Imaginary part of a causal response function from its real part (minus its high frequency limit),
+    Im f(w) = -(2w/pi) P int_0^inf Re f(w')/(w'^2-w^2) dw'
+
+  Arguments:
+      ene (ndarray): Uniform grid of non-negative frequencies
+      fre (ndarray): Real part, even in frequency
+
+  Returns:
+      fim (ndarray): Imaginary part on the same grid
+  '''
+  return -hilbert_transform(ene, fre, odd=False)
+
+
+def imaginary_axis_transform ( ene, fim ):
+  '''
+  Response function at imaginary frequencies iw from the imaginary part on the real axis,
+    f(iw) = (2/pi) sum_{j>0} w_j Im f(w_j) de/(w^2+w_j^2)
+  evaluated as matrix-vector products over blocks of rows.
+
+  Arguments:
+      ene (ndarray): Uniform grid of frequencies
+      fim (ndarray): Imaginary part on the real axis
+
+  Returns:
+      fiw (ndarray): Function at the imaginary frequencies i*ene
+  '''
+  ne = ene.shape[0]
+  de = (ene[-1]-ene[0])/(ne-1)
+  wf = ene[1:]*fim[1:]
+
+  fiw = np.empty(ne, dtype=float)
+  nrow = max(1, max_kernel_elems//ne)
+  for rs in range(0, ne, nrow):
+    re = min(ne, rs+nrow)
+    fiw[rs:re] = (1./(ene[rs:re,None]**2+ene[None,1:]**2)) @ wf
+
+  return (2./np.pi)*de*fiw
@@ -23,8 +23,7 @@ import scipy.linalg as LA
 from scipy.special import factorial as fac
 from tempfile import NamedTemporaryFile
 import re
-from .communication import scatter_full, gather_full,gather_scatter
-from scipy.spatial.distance import cdist
+from .communication import scatter_full, gather_full,gather_scatter,scatter_indices
 from mpi4py import MPI
 from .zero_pad import zero_pad
 import time
@@ -32,6 +31,9 @@ import time
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 
+# Maximum number of Hamiltonian matrix elements unfolded at once on each rank
+max_unfold_elems = 2**24
+
 
 def check(Hksp_s,si_per_k,new_k_ind,orig_k_ind,phase_shifts,U,a_index,inv_flag,equiv_atom,kp,symop,fg,isl,sym_TR):
 
@@ -591,44 +593,63 @@ def mat2eul(R):
 ############################################################################################
 ############################################################################################
 
-def find_equiv_k(kp,symop,full_grid,sym_TR,check=True,include_self=False):
-    # find indices and symops that generate full grid H from wedge H
-    orig_k_ind = []
-    new_k_ind = []
-    si_per_k = []
-    counter = 0
-    kp_track = []
-    kp = correct_roundoff(kp)
+def kgrid_lookup(full_grid):
+    # integer lookup table for a regular grid of reduced coordinates:
+    # returns the grid dimensions and an array mapping integer grid
+    # coordinates (modulo the grid) to the row index in full_grid
+    nks = np.array([np.unique(np.round(full_grid[:,i],decimals=6)).shape[0] for i in range(3)])
+    if np.prod(nks) != full_grid.shape[0]:
+        raise ValueError('full_grid is not a regular grid')
 
+    ints = np.rint(full_grid*nks).astype(int)%nks
+    lut = np.full(nks,-1,dtype=int)
+    lut[ints[:,0],ints[:,1],ints[:,2]] = np.arange(full_grid.shape[0])
 
-    full_grid_mask = np.copy(full_grid)
+    return nks,lut
 
-    for isym in range(symop.shape[0]):
-        #transform k -> k' with the sym op
-        if sym_TR[isym]:
-            newk = ((((-symop[isym] @ (kp.T%1.0))%1.0)+0.5)%1.0)-0.5
-        else:
-            newk = (((( symop[isym] @ (kp.T%1.0))%1.0)+0.5)%1.0)-0.5
-        newk = correct_roundoff(newk)
-        newk[np.where(np.isclose(newk,0.5))]=-0.5
-        newk[np.where(np.isclose(newk,-1.0))]=0.0
-        newk[np.where(np.isclose(newk,1.0))]=0.0
+############################################################################################
+############################################################################################
+############################################################################################
+
+def kgrid_index(k,nks,lut,tol=1.e-6):
+    # index in the full grid of each point k (reduced coordinates), or -1
+    # if the point is further than tol from every grid point
+    f = k*nks
+    ints = np.rint(f)
+    on_grid = np.linalg.norm((f-ints)/nks,axis=-1) <= tol
+    ints = ints.astype(int)%nks
 
-        # find index in the full grid where this k -> k' with this sym op
-        nw = np.where(np.isclose(cdist(newk.T,full_grid_mask),0.0,atol=1.e-6,rtol=1.e-6,))
+    return np.where(on_grid,lut[ints[...,0],ints[...,1],ints[...,2]],-1)
 
-        if not include_self:
-            full_grid_mask[nw[1]]=np.ma.masked
+############################################################################################
+############################################################################################
+############################################################################################
+
+def equiv_k_table(kp,symop,full_grid,sym_TR):
+    # index in the full grid of k -> k' for every sym op (rows) and k (columns)
+    nks,lut = kgrid_lookup(full_grid)
+
+    sign = np.where(np.asarray(sym_TR[:symop.shape[0]],dtype=bool),-1.0,1.0)
+    newk = sign[:,None,None]*np.einsum('sij,kj->ski',symop,kp%1.0)
+
+    return kgrid_index(newk,nks,lut)
 
-        new_k_ind.extend(nw[1].tolist())
-        si_per_k.extend([isym]*nw[1].shape[0])
-        orig_k_ind.extend(nw[0].tolist())
+############################################################################################
+############################################################################################
+############################################################################################
+
+def find_equiv_k(kp,symop,full_grid,sym_TR,check=True,include_self=False):
+    # find indices and symops that generate full grid H from wedge H
+    counter = 0
+    kp = correct_roundoff(kp)
 
-    new_k_ind  = np.array(new_k_ind)
-    orig_k_ind = np.array(orig_k_ind)
-    si_per_k   = np.array(si_per_k)
+    # find index in the full grid where k -> k' with each sym op
+    ind = equiv_k_table(kp,symop,full_grid,sym_TR)
+    si_per_k,orig_k_ind = np.nonzero(ind>=0)
+    new_k_ind = ind[si_per_k,orig_k_ind]
 
     if not include_self:
+        # keep the first sym op and wedge point reaching each point of the grid
         inds = np.unique(new_k_ind,return_index=True)
 
         new_k_ind  = new_k_ind[inds[1]]
@@ -654,6 +675,21 @@ def find_equiv_k(kp,symop,full_grid,sym_TR,check=True,include_self=False):
 ############################################################################################
 ############################################################################################
 
+def find_equiv_k_points(kp,symop,full_grid,sym_TR):
+    # find_equiv_k(kp[i][None],...,check=False,include_self=True) for every point at once
+    kp = correct_roundoff(kp)
+    ind = equiv_k_table(kp,symop,full_grid,sym_TR)
+
+    nkl = []
+    for i in range(kp.shape[0]):
+        si_per_k = np.nonzero(ind[:,i]>=0)[0]
+        nkl.append((ind[si_per_k,i],np.zeros(si_per_k.shape[0],dtype=int),si_per_k))
+
+    return nkl
+
+############################################################################################
+############################################################################################
+############################################################################################
 
 def build_U_matrix(wigner,shells):
     # builds U from blocks 
@@ -757,37 +793,61 @@ def get_inv_op(shells):
 ############################################################################################
 ############################################################################################
 
-def enforce_t_rev(Hksp_s,nk1,nk2,nk3,spin_orb,U_inv,jchia):
-    # enforce time reversal symmetry on H(k)
-    nawf=Hksp_s.shape[1]
-    
-    Hksp_s= np.reshape(Hksp_s,(nk1,nk2,nk3,nawf,nawf),order="C")
+def t_rev_map(nk1,nk2,nk3,spin_orb):
+    # index of -k for every k of the full grid, and how time reversal
+    # is enforced on H(k) (same result as the sequential in place updates
+    # over i,j,k <= nk/2 of the original loop):
+    #   0: unchanged
+    #   1: from H(k) and H(-k)
+    #   2: from H(k) alone (k = -k)
+    #   3: H(k) reversed twice (spin orbit only)
+    i,j,k = np.meshgrid(np.arange(nk1),np.arange(nk2),np.arange(nk3),indexing='ij')
+    ind = np.arange(nk1*nk2*nk3)
+    partner = (((nk1-i)%nk1)*nk2*nk3+((nk2-j)%nk2)*nk3+(nk3-k)%nk3).ravel()
+    visited = ((i<=nk1//2)&(j<=nk2//2)&(k<=nk3//2)).ravel()
 
-    if spin_orb:
+    mode = np.zeros(ind.shape[0],dtype=int)
+    if not spin_orb:
+        mode[visited|visited[partner]] = 1
+    else:
+        mode[visited[partner]] = 1
+        mode[visited&visited[partner]&(ind<partner)] = 3
+    mode[partner==ind] = 2
+
+    return partner,mode
+
+############################################################################################
+############################################################################################
+############################################################################################
+
+def apply_t_rev_map(H,Hm,mode,spin_orb,U_inv,jchia):
+    # time reversal symmetric H(k) from H(k) and H(-k) for the modes
+    # of t_rev_map. Hm holds H(-k) for the points with mode 1 only
+    H_t = np.copy(H)
+    m1,m2,m3 = [np.nonzero(mode==m)[0] for m in (1,2,3)]
+
+    if not spin_orb:
+        H_t[m1] = (H[m1]+np.conj(Hm))/2.0
+        H_t[m2] = (H[m2]+3.0*np.conj(H[m2]))/4.0
+    else:
         U_TR = get_U_TR(jchia)
+        def rev(X):
+            return np.conj(U_inv*(U_TR @ X @ np.conj(U_TR.T)))
+        H_t[m1] = rev(Hm)
+        H_t[m2] = rev(H[m2])
+        H_t[m3] = rev(rev(H[m3]))
 
-    for i in range(int(nk1/2)+1):
-        for j in range(int(nk2/2)+1):
-            for k in range(int(nk3/2)+1):
-                iv= (nk1-i)%nk1
-                jv= (nk2-j)%nk2
-                kv= (nk3-k)%nk3
-                if not spin_orb:
-                    temp1 = np.conj(Hksp_s[i,j,k])
-                    temp2 = np.conj(Hksp_s[iv,jv,kv])
-                    Hksp_s[iv,jv,kv] = (Hksp_s[iv,jv,kv] + temp1)/2.0
-                    Hksp_s[i,j,k]    = (Hksp_s[i,j,k]    + temp2)/2.0
-                else:
-                    temp1=np.conj(U_inv*(U_TR @ Hksp_s[i,j,k] @ np.conj(U_TR.T)))
-#                    temp2=np.conj(U_inv*(U_TR @ Hksp_s[iv,jv,kv] @ np.conj(U_TR.T)))
-#                    Hksp_s[iv,jv,kv] = (Hksp_s[iv,jv,kv] + temp1)/2.0
-#                    Hksp_s[i,j,k]    = (Hksp_s[i,j,k]    + temp2)/2.0
-                    Hksp_s[iv,jv,kv] = temp1
+    return H_t
 
+############################################################################################
+############################################################################################
+############################################################################################
 
-    Hksp_s= np.reshape(Hksp_s,(nk1*nk2*nk3,nawf,nawf),order="C")
+def enforce_t_rev(Hksp_s,nk1,nk2,nk3,spin_orb,U_inv,jchia):
+    # enforce time reversal symmetry on H(k)
+    partner,mode = t_rev_map(nk1,nk2,nk3,spin_orb)
 
-    return Hksp_s
+    return apply_t_rev_map(Hksp_s,Hksp_s[partner[mode==1]],mode,spin_orb,U_inv,jchia)
 
 ############################################################################################
 ############################################################################################
@@ -829,8 +889,7 @@ def apply_t_rev(Hksp,kp,spin_orb,U_inv,jchia):
 
 def enforce_hermaticity(Hksp):
     # enforce H(k) to be hermitian (it should be already)
-    for k in range(Hksp.shape[0]):
-        Hksp[k] = (Hksp[k] + np.conj(Hksp[k].T))/2.0
+    Hksp[:] = (Hksp + np.conj(np.swapaxes(Hksp,1,2)))/2.0
 
     return Hksp
 
@@ -850,65 +909,86 @@ def add_U_wyc(U,U_wyc):
 ############################################################################################
 ############################################################################################
 
-def wedge_to_grid(Hksp,U,a_index,phase_shifts,kp,new_k_ind,orig_k_ind,si_per_k,inv_flag,U_inv,sym_TR,npool):
-    # generates full grid from k points in IBZ
-    nawf     = Hksp.shape[1]
+def unfold_k(Hksp,U,a_index,phase_shifts,kp,orig_k_ind,si_per_k,inv_flag,U_inv,sym_TR):
+    # H(k') = U_k H(k) U_k^+ for each wedge point orig_k_ind and symop si_per_k.
+    # Points are grouped by symop so that every group is rotated in batches.
+    nawf  = Hksp.shape[1]
+    kchunk = max(1,max_unfold_elems//(nawf*nawf))
 
+    Hksp_s = np.empty((orig_k_ind.shape[0],nawf,nawf),dtype=complex)
 
+    order = np.argsort(si_per_k,kind='stable')
+    syms,start = np.unique(si_per_k[order],return_index=True)
+    groups = np.split(order,start[1:])
 
-    fgm        = scatter_full(np.arange(si_per_k.shape[0],dtype=int),npool)
-    new_k_ind  = scatter_full(new_k_ind,npool)
-    orig_k_ind = scatter_full(orig_k_ind,npool)
-    si_per_k   = scatter_full(si_per_k,npool)
+    for isym,group in zip(syms,groups):
+        for ks in range(0,group.shape[0],kchunk):
+            tk  = group[ks:ks+kchunk]
+            oki = orig_k_ind[tk]
+            H   = Hksp[oki]
 
-    Hksp_s=np.zeros((new_k_ind.shape[0],nawf,nawf),dtype=complex)
+            # if symop is identity
+            if isym==0:
+                Hksp_s[tk]=H
+                continue
 
-    for j in range(new_k_ind.shape[0]):
-        isym = si_per_k[j]
-        oki  = orig_k_ind[j]
-        nki  = np.where(new_k_ind[j]==fgm)[0]
-        
+            # k dependent phases of U (see get_U_k)
+            ph = np.exp(2.0j*np.pi*(kp[oki] @ phase_shifts[isym][a_index].T))
 
-        # if symop is identity
-        if isym==0:
-            Hksp_s[nki]=Hksp[oki]
-            continue
+            #transformated H(k)
+            THP = U[isym] @ (ph[:,:,None]*H*np.conj(ph[:,None,:])) @ np.conj(U[isym].T)
 
-        # other cases
-        H  = Hksp[oki]
+            # apply inversion operator if needed
+            if inv_flag[isym]:
+                THP*=U_inv
 
-        # get k dependent U
-        U_k     = get_U_k(kp[oki],phase_shifts[isym],a_index,U[isym])
+            # time inversion is anti-unitary
+            if sym_TR[isym]:
+                THP*= U_inv
+                THP = np.conj(THP)
 
-        #transformated H(k)            
-        THP = U_k @ H @ np.conj(U_k.T)
+            Hksp_s[tk]=THP
 
-        # apply inversion operator if needed
-        if inv_flag[isym]:
-            THP*=U_inv
+    # make sure of hermiticity of each H(k)
+    return enforce_hermaticity(Hksp_s)
 
-        # time inversion is anti-unitary
-        if sym_TR[isym]:
-            THP*= U_inv
-            THP = np.conj(THP)
+############################################################################################
+############################################################################################
+############################################################################################
 
-        Hksp_s[nki]=THP
+def wedge_to_grid(Hksp,U,a_index,phase_shifts,kp,new_k_ind,orig_k_ind,si_per_k,inv_flag,U_inv,sym_TR,npool,nk1,nk2,nk3,spin_orb,jchia,t_rev):
+    # generates full grid from k points in IBZ. Each rank only builds its
+    # block of the full grid (as distributed by scatter_full), enforcing
+    # time reversal symmetry if t_rev is set.
+    nfull = new_k_ind.shape[0]
 
-    # make sure of hermiticity of each H(k)
-    Hksp_s = enforce_hermaticity(Hksp_s)
+    # row of the index maps for each point of the full grid
+    row = np.empty(nfull,dtype=int)
+    row[new_k_ind] = np.arange(nfull)
 
-    Hksp = None
-    Hksp_s = gather_full(Hksp_s,npool)
+    kloc = scatter_indices(nfull,npool)
+    rl = row[kloc]
+    Hksp_d = unfold_k(Hksp,U,a_index,phase_shifts,kp,orig_k_ind[rl],si_per_k[rl],
+                      inv_flag,U_inv,sym_TR)
 
-    return Hksp_s
+    if t_rev:
+        # H(-k) is unfolded from the wedge as well, where needed
+        partner,mode = t_rev_map(nk1,nk2,nk3,spin_orb)
+        mode = mode[kloc]
+        rm = row[partner[kloc[mode==1]]]
+        Hm = unfold_k(Hksp,U,a_index,phase_shifts,kp,orig_k_ind[rm],si_per_k[rm],
+                      inv_flag,U_inv,sym_TR)
+        Hksp_d = apply_t_rev_map(Hksp_d,Hm,mode,spin_orb,U_inv,jchia)
+
+    return Hksp_d
 
 ############################################################################################
 ############################################################################################
 ############################################################################################
 
-def open_grid(Hksp,full_grid,kp,symop,symop_cart,atom_pos,shells,a_index,equiv_atom,sym_info,sym_shift,nk1,nk2,nk3,spin_orb,sym_TR,jchia,mag_calc,symm_grid,thresh,max_iter,nelec,verbose):
-    # calculates full H(k) grid from wedge
-    npool=4
+def open_grid(Hksp,full_grid,kp,symop,symop_cart,atom_pos,shells,a_index,equiv_atom,sym_info,sym_shift,nk1,nk2,nk3,spin_orb,sym_TR,jchia,mag_calc,symm_grid,thresh,max_iter,nelec,verbose,npool):
+    # calculates full H(k) grid from wedge, distributed
+    # over the ranks as by scatter_full(...,npool)
 
 
     nawf = Hksp.shape[1]
@@ -953,30 +1033,26 @@ def open_grid(Hksp,full_grid,kp,symop,symop_cart,atom_pos,shells,a_index,equiv_a
     # and index of symop that transforms k to k'        
     new_k_ind,orig_k_ind,si_per_k = find_equiv_k(kp,symop,full_grid,sym_TR,check=True)
 
-    # transform H(k) -> H(k')
+    # transform H(k) -> H(k'), enforcing time reversion where appropriate.
+    # each rank holds its block of k points of the full grid
     Hksp = wedge_to_grid(Hksp,U,a_index,phase_shifts,kp,
-                         new_k_ind,orig_k_ind,si_per_k,inv_flag,U_inv,sym_TR,npool)
-
-    if rank==0:
-        # enforce time reversion where appropriate
-        if not (spin_orb and mag_calc):
-            Hksp = enforce_t_rev(Hksp,nk1,nk2,nk3,spin_orb,U_inv,jchia)        
-
-    else:
-        Hksp=np.zeros((full_grid.shape[0],nawf,nawf),dtype=complex)
-
-    comm.Bcast(Hksp)
+                         new_k_ind,orig_k_ind,si_per_k,inv_flag,U_inv,sym_TR,npool,
+                         nk1,nk2,nk3,spin_orb,jchia,not (spin_orb and mag_calc))
 
     if symm_grid:
 
+        # the symmetrization needs the full grid on every rank
+        Hksp = gather_full(Hksp,npool)
+        if rank!=0:
+            Hksp=np.zeros((full_grid.shape[0],nawf,nawf),dtype=complex)
+        comm.Bcast(Hksp)
+
         symop_inv=np.zeros_like(symop)
         for i in range(symop.shape[0]):
             symop_inv[i]=LA.inv(symop[i])
 
-        nkl=[]
         partial_grid = scatter_full(full_grid,npool)
-        for i in range(partial_grid.shape[0]):
-            nkl.append(find_equiv_k(partial_grid[i][None],symop_inv,full_grid,sym_TR,check=False,include_self=True))
+        nkl = find_equiv_k_points(partial_grid,symop_inv,full_grid,sym_TR)
         nkl_no_interp=np.array(nkl)
 
         Hksp,tmax = symmetrize_grid(Hksp,U,a_index,phase_shifts,kp,inv_flag,U_inv,sym_TR,
@@ -993,10 +1069,8 @@ def open_grid(Hksp,full_grid,kp,symop,symop_cart,atom_pos,shells,a_index,equiv_a
         nfft3=nk3+upscale3
 
         full_grid_interp = get_full_grid(nfft1,nfft2,nfft3)
-        nkl=[]
         partial_grid_interp = scatter_full(full_grid_interp,npool)
-        for i in range(partial_grid_interp.shape[0]):
-            nkl.append(find_equiv_k(partial_grid_interp[i][None],symop_inv,full_grid_interp,sym_TR,check=False,include_self=True))
+        nkl = find_equiv_k_points(partial_grid_interp,symop_inv,full_grid_interp,sym_TR)
         nkl_interp=np.array(nkl)
 
         #max difference bewtween H(k) and H(k*)
@@ -1108,6 +1182,8 @@ def open_grid(Hksp,full_grid,kp,symop,symop_cart,atom_pos,shells,a_index,equiv_a
                 if i%2 and i>=3:                   
                     break
 
+        # back to blocks of k points on each rank
+        Hksp = scatter_full(Hksp,npool)
 
     
     # for debugging purposes
@@ -1145,6 +1221,7 @@ def open_grid_wrapper(data_controller):
     thresh      = data_attr['symm_thresh']
     max_iter    = data_attr['symm_max_iter']
     verbose     = data_attr['verbose']
+    npool       = data_attr['npool']
     Hks         = data_arrays['Hks']
     atom_pos    = data_arrays['tau']/alat
     atom_lab    = data_arrays['atoms']
@@ -1207,32 +1284,23 @@ def open_grid_wrapper(data_controller):
     kp_red = correct_roundoff_kp(kp_red,full_grid)
 
     # we wont need this for now
-    if rank==0:
-        if nspin==2:
-            data_arrays['Hks'] = np.zeros((nawf,nawf,nk1*nk2*nk3,nspin),dtype=complex)
-        else:
-            data_arrays['Hks'] = None
-    else:
-        data_arrays['Hks'] = None
+    data_arrays['Hks'] = None
 
-    # expand grid from wedge
+    # expand grid from wedge. Hks is left distributed: each rank keeps
+    # its block of k points of the full grid, (nawf,nawf,snktot,nspin)
     for ispin in range(nspin):
         Hksp = np.ascontiguousarray(np.transpose(Hks,axes=(2,0,1,3))[:,:,:,ispin])
 
         Hksp = open_grid(Hksp,full_grid,kp_red,symop,symop_cart,atom_pos,
                          shells,a_index,equiv_atom,sym_info,sym_shift,
                          nk1,nk2,nk3,spin_orb,sym_TR,jchia,mag_calc,
-                         symm_grid,thresh,max_iter,nelec,verbose)
+                         symm_grid,thresh,max_iter,nelec,verbose,npool)
 
+        if ispin==0:
+            data_arrays['Hks'] = np.empty((nawf,nawf,Hksp.shape[0],nspin),dtype=complex)
+        data_arrays['Hks'][:,:,:,ispin] = np.transpose(Hksp,axes=(1,2,0))
 
-        if rank==0:
-            if nspin==2:
-                data_arrays['Hks'][:,:,:,ispin]=np.ascontiguousarray(np.transpose(Hksp,axes=(1,2,0)))
-            else:
-                data_arrays['Hks']=np.ascontiguousarray(np.transpose(Hksp,axes=(1,2,0))[...,None])
-#            np.save("kham.npy",np.ascontiguousarray(np.transpose(Hksp,axes=(1,2,0))))
-        else:
-            Hksp=None
+        Hksp=None
 
 
 ############################################################################################
@@ -1324,8 +1392,13 @@ def symmetrize_grid(Hksp,U,a_index,phase_shifts,kp,inv_flag,U_inv,sym_TR,full_gr
 
 def correct_roundoff_kp(kp,full_grid):
     kp_c =np.copy(kp)
-    nw = np.where(np.isclose(cdist(kp_c,full_grid),0.0,atol=1.e-5,rtol=1.e-5,))    
-    kp_c[nw[0]]=full_grid[nw[1]]
+    nks,lut = kgrid_lookup(full_grid)
+    ind = kgrid_index(kp_c,nks,lut,tol=1.e-5)
+
+    # only snap points that lie within tol of the grid point itself
+    nw = np.where(ind>=0)[0]
+    nw = nw[np.all(np.abs(kp_c[nw]-full_grid[ind[nw]])<=1.e-5,axis=1)]
+    kp_c[nw]=full_grid[ind[nw]]
     
     return kp_c
 
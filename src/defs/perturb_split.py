@@ -33,8 +33,7 @@ def perturb_split(rot_op1,rot_op2,v_k,degen,return_v_k=False):
     
     for i in range(len(degen)):
         # degenerate subspace indices upper and lower lim
-        ll = degen[i][0]
-        ul = degen[i][-1]+1
+        ll,ul = degen[i]
 
         # diagonalize in degenerate subspace
         vals,weight = LAN.eigh(op1[ll:ul,ll:ul])
@@ -51,3 +50,63 @@ def perturb_split(rot_op1,rot_op2,v_k,degen,return_v_k=False):
       return(op1, op2, v_k_temp)
     else:
       return(op1, op2)
+
+
+def perturb_split_batch ( rot_op1, rot_op2, v_k, degen, kchunk=64 ):
+    '''
+    Rotate operators into the eigenbasis for many k points at once (see perturb_split).
+    Within each degenerate subspace the basis is chosen to diagonalize rot_op1, and
+    rot_op2 is rotated with the same basis. Operators with extra leading dimensions
+    (e.g. the three Cartesian components of dHksp) are each split independently.
+
+    Arguments:
+        rot_op1 (ndarray): Operators with shape (nk,...,nawf,nawf)
+        rot_op2 (ndarray): Operators with the shape of rot_op1, or None
+        v_k (ndarray): Eigenvectors with shape (nk,nawf,nbnd)
+        degen (tuple): Degenerate sets (offsets, ranges) of one spin, as returned by get_degeneracies
+        kchunk (int): Number of k points rotated together
+
+    Returns:
+        (op1, op2): Rotated operators with shape (nk,...,nbnd,nbnd). op2 is None if rot_op2 is None
+    '''
+    import numpy as np
+
+    nk,nawf,nbnd = v_k.shape
+    extra = rot_op1.shape[1:-2]
+    nx = int(np.prod(extra))
+    oshape = (nk,)+extra+(nbnd,nbnd)
+
+    ops = [o for o in (rot_op1,rot_op2) if o is not None]
+    out = [np.empty((nk,nx,nbnd,nbnd), dtype=complex) for o in ops]
+
+    for ks in range(0, nk, kchunk):
+        ke = min(nk, ks+kchunk)
+        v = v_k[ks:ke,None]
+        vH = np.conj(np.swapaxes(v, 2, 3))
+        for o,op in zip(ops,out):
+            op[ks:ke] = vH @ (o[ks:ke].reshape((ke-ks,nx,nawf,nawf)) @ v)
+
+    # Degenerate subspaces, grouped by dimension
+    offsets,ranges = degen
+    kblk = np.repeat(np.arange(nk), np.diff(offsets))
+    dblk = ranges[:,1] - ranges[:,0]
+
+    ix = np.arange(nx)[None,:,None]
+    for d in np.unique(dblk):
+        ik,ll = kblk[dblk==d],ranges[dblk==d,0]
+        idx = ll[:,None] + np.arange(d)[None,:]
+        ikb = ik[:,None,None]
+        idb = idx[:,None,:]
+
+        # Basis of each subspace diagonalizing rot_op1
+        sub = out[0][ikb[...,None],ix[...,None],idb[...,None],idb[:,:,None,:]]
+        _,W = np.linalg.eigh(sub)
+        WH = np.conj(np.swapaxes(W, 2, 3))
+        WT = np.swapaxes(W, 2, 3)
+
+        for op in out:
+            op[ikb,ix,idb,:] = WH @ op[ikb,ix,idb,:]
+            op[ikb,ix,:,idb] = WT @ op[ikb,ix,:,idb]
+
+    out = [op.reshape(oshape) for op in out]
+    return (out[0], out[1] if rot_op2 is not None else None)
@@ -336,15 +336,19 @@ def parse_qe_data_file ( data_controller, fpath, fname ):
     arry[s] = v
 
 
-def parse_qe_atomic_proj ( data_controller, fname ):
+def parse_qe_atomic_proj ( data_controller, fname, distribute=False ):
   '''
   Parse the atomic_proj.xml file produced by Quantum Espresso.
   Populated the DataController object with all necessay information.
+  The file is streamed with iterparse: each projection block is decoded directly
+  into the projection array and its element is cleared once read.
 
   Arugments:
     data_controller (DataController): Data controller to populate
     fname (str): Path and name of the xml file.
+    distribute (bool): If True, each rank only keeps the projections of its block of k points (as split by load_balancing)
   '''
+  from .communication import load_balancing
 
   arry,attr = data_controller.data_dicts()
   comm = MPI.COMM_WORLD
@@ -353,88 +357,93 @@ def parse_qe_atomic_proj ( data_controller, fname ):
   verbose = attr['verbose']
   acbn0 = attr['acbn0']
 
-  tree = ET.parse(fname)
-  root = tree.getroot()
   qe_version = attr['qe_version']
 
   Ry2eV = 13.60569193
   Efermi = attr['Efermi']
 
-  elem = root.find('HEADER')
-  if qe_version > 6.5:
-    header = elem.attrib
-    nkpnts = int(header['NUMBER_OF_K-POINTS'])
-    nspin = int(header['NUMBER_OF_SPIN_COMPONENTS'])
-    nbnds = int(header['NUMBER_OF_BANDS'])
-    nawf = int(header['NUMBER_OF_ATOMIC_WFC'])
-  else:
-    nbnds = int(elem.find('NUMBER_OF_BANDS').text)
-    nkpnts = int(elem.find('NUMBER_OF_K-POINTS').text)
-    nspin = int(elem.find('NUMBER_OF_SPIN_COMPONENTS').text)
-    nawf = int(elem.find('NUMBER_OF_ATOMIC_WFC').text)
-
-  if nspin == 4:
-    nspin = 1
-
-  wavefunctions = np.empty((nbnds,nawf,nkpnts,nspin), dtype=complex)
-  overlaps = np.empty((nawf,nbnds,nkpnts), dtype=complex) if acbn0 else None
-
-  if qe_version > 6.5:
-
-    elem = root.find('EIGENSTATES')
-    ewfc = elem.findall('PROJS')
-    for ispin in range(nspin):
-      for i in range(nkpnts):
-        ik = ispin*nkpnts + i
-        for j,proj in enumerate(ewfc[ik].findall('ATOMIC_WFC')):
-          ind = int(proj.attrib['index'])-1
-          spin = int(proj.attrib['spin'])-1
-          text = [float(v) for v in proj.text.split()]
-          for k in range(len(text)//2):
-            k2 = 2*k
-            wavefunctions[k,ind,i,ispin] = complex(text[k2],text[k2+1])
-
-    if acbn0:
-      elem = root.find('OVERLAPS')
-      for i,ovp in enumerate(elem.findall('OVPS')):
-        dim = int(ovp.attrib['dim'])
-        ispin = int(ovp.attrib['spin'])-1
-        text = ovp.text.split()
-        for j in range(len(text)//2):
-          j2 = 2*j
-          i1 = j//dim
-          i2 = j%dim
-          v1,v2 = float(text[j2]),float(text[j2+1])
-          overlaps[i1,i2,i] = complex(v1,v2)
-
-  else:
-
-    def read_wf ( kpnt, i, ispin ):
-      for j,wf in enumerate(kpnt):
-        text = wf.text.replace(',', ' ').split()
-        wft = np.array(text, dtype=float).reshape((nbnds,2))
-        wavefunctions[:,j,i,ispin] = wft[:,0] + 1j*wft[:,1]
-
-    elem = root.find('PROJECTIONS')
-    for i,kpnt in enumerate(elem):
-      if nspin == 1:
-        read_wf(kpnt, i , 0)
+  # Decode a block of (real,imaginary) pairs
+  decode = lambda text : np.fromstring(text.replace(',',' '), dtype=float, sep=' ').view(complex)
+
+  wavefunctions = overlaps = None
+  ini_ik = end_ik = 0
+
+  # Position in the file: index of the current PROJS or K-POINT block, its spin,
+  # the index of the next wavefunction in the block, and the enclosing section
+  iblock,ispin,iwf = -1,0,0
+  section = None
+
+  for event,elem in ET.iterparse(fname, events=('start','end')):
+    tag = elem.tag
+
+    if event == 'start':
+      if tag in ['PROJECTIONS','OVERLAPS','EIGENSTATES']:
+        section = tag
+        iblock = -1
+      elif tag == 'PROJS' or (tag.startswith('K-POINT') and section in ['PROJECTIONS','OVERLAPS']):
+        iblock += 1
+        ispin,iwf = 0,0
+      elif tag.startswith('SPIN.') and section == 'PROJECTIONS':
+        ispin,iwf = int(tag.split('.')[1])-1,0
+      elif tag == 'OVPS':
+        iblock += 1
+      continue
+
+    if tag == 'HEADER':
+      if qe_version > 6.5:
+        header = elem.attrib
+        nkpnts = int(header['NUMBER_OF_K-POINTS'])
+        nspin = int(header['NUMBER_OF_SPIN_COMPONENTS'])
+        nbnds = int(header['NUMBER_OF_BANDS'])
+        nawf = int(header['NUMBER_OF_ATOMIC_WFC'])
       else:
-        for ispin in range(nspin):
-          nele = kpnt.find('SPIN.%d'%(ispin+1))
-          read_wf(nele, i, ispin)
-
-    if acbn0:
-      elem = root.find('OVERLAPS')
-      for i,kpnt in enumerate(elem):
-        for j,ovp in enumerate(kpnt):
-          ispin = int(ovp.tag.split('.')[1]) - 1
-          text = ovp.text.replace(',', ' ').split()
-          for k in range(len(text)//2):
-            k0,k1 = k//nbnds,k%nbnds
-            k2 = 2*k
-            v1,v2 = float(text[k2]),float(text[k2+1])
-            overlaps[k0,k1,i] = complex(v1,v2)
+        nbnds = int(elem.find('NUMBER_OF_BANDS').text)
+        nkpnts = int(elem.find('NUMBER_OF_K-POINTS').text)
+        nspin = int(elem.find('NUMBER_OF_SPIN_COMPONENTS').text)
+        nawf = int(elem.find('NUMBER_OF_ATOMIC_WFC').text)
+
+      if nspin == 4:
+        nspin = 1
+
+      ini_ik,end_ik = load_balancing(comm.Get_size(),rank,nkpnts) if distribute else (0,nkpnts)
+      wavefunctions = np.empty((nbnds,nawf,end_ik-ini_ik,nspin), dtype=complex)
+      overlaps = np.empty((nawf,nbnds,nkpnts), dtype=complex) if acbn0 else None
+      elem.clear()
+
+    elif tag in ['PROJECTIONS','OVERLAPS','EIGENSTATES']:
+      section = None
+      elem.clear()
+
+    elif tag == 'ATOMIC_WFC':
+      # PROJS blocks are ordered by spin, then k point
+      ik = iblock%nkpnts
+      if ini_ik <= ik < end_ik:
+        ind = int(elem.attrib['index'])-1
+        wavefunctions[:,ind,ik-ini_ik,iblock//nkpnts] = decode(elem.text)
+      elem.clear()
+
+    elif tag == 'OVPS':
+      if acbn0:
+        dim = int(elem.attrib['dim'])
+        ovp = decode(elem.text).reshape((-1,dim))
+        overlaps[:ovp.shape[0],:dim,iblock] = ovp
+      elem.clear()
+
+    elif section == 'PROJECTIONS' and iblock >= 0 and not tag.startswith('K-POINT') and not tag.startswith('SPIN.'):
+      # Wavefunctions are listed in order within each K-POINT (or SPIN) block
+      if ini_ik <= iblock < end_ik:
+        wavefunctions[:,iwf,iblock-ini_ik,ispin] = decode(elem.text)
+      iwf += 1
+      elem.clear()
+
+    elif section == 'OVERLAPS' and iblock >= 0 and not tag.startswith('K-POINT'):
+      if acbn0:
+        ovp = decode(elem.text).reshape((-1,nbnds))
+        overlaps[:ovp.shape[0],:,iblock] = ovp
+      elem.clear()
+
+    elif tag == 'PROJS' or tag.startswith('K-POINT') or tag.startswith('SPIN.'):
+      elem.clear()
 
   arrys = [('U',wavefunctions)]
   if acbn0:
@@ -0,0 +1,379 @@
+#
+# PAOFLOW
+#
+# Copyright 2016-2022 - Marco BUONGIORNO NARDELLI (mbn@unt.edu)
+#
+# Reference:
+#
+# F.T. Cerasoli, A.R. Supka, A. Jayaraj, I. Siloi, M. Costa, J. Slawinska, S. Curtarolo, M. Fornari, D. Ceresoli, and M. Buongiorno Nardelli,
+# Advanced modeling of materials with PAOFLOW 2.0: New features and software design, Comp. Mat. Sci. 200, 110828 (2021).
+#
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+
+import numpy as np
+from mpi4py import MPI
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+# Maximum number of (tetrahedron,band) states treated at once
+max_tetra_states = 2**20
+
+# Tetrahedron integration methods
+tetrahedron_methods = ( 'linear', 'blochl' )
+
+# Vertices of the subcell, with index ix + 2*iy + 4*iz
+cube_vertices = np.array([[0,0,0],[1,0,0],[0,1,0],[1,1,0],[0,0,1],[1,0,1],[0,1,1],[1,1,1]])
+
+# The six tetrahedra sharing the diagonal 0-7 of the subcell
+cube_tetrahedra = np.array([[0,1,3,7],[0,1,5,7],[0,2,3,7],[0,2,6,7],[0,4,5,7],[0,4,6,7]])
+
+
+def check_tetrahedron ( method ):
+  # Raise ValueError unless 'method' is None (no tetrahedron integration) or a known method
+  if method is not None and method not in tetrahedron_methods:
+    raise ValueError('Tetrahedron method \'%s\' not supported. Available methods are: %s'%(str(method),', '.join(tetrahedron_methods)))
+
+
+def tetrahedra ( nk1, nk2, nk3, b_vectors=None ):
+  '''
+  Divide the Monkhorst-Pack grid into tetrahedra, six per subcell, all sharing
+  the shortest main diagonal of the subcell (Blöchl, PRB 49, 16223 (1994))
+
+  Arguments:
+      nk1,nk2,nk3 (int): Dimensions of the k grid
+      b_vectors (ndarray): (optional) Reciprocal lattice vectors, one per row. Without them the diagonal 0-7 is used
+
+  Returns:
+      tets (ndarray): Full grid indices (k + j*nk3 + i*nk2*nk3) of the corners, with shape (6*nk1*nk2*nk3,4)
+  '''
+  nk = np.array([nk1,nk2,nk3])
+
+  # Diagonals 0-7, 1-6, 2-5 and 3-4 are obtained by relabeling the vertices v -> v^a
+  a = 0
+  if b_vectors is not None:
+    diag = ((cube_vertices[7-np.arange(4)]-cube_vertices[:4])/nk) @ b_vectors
+    a = np.argmin(np.sum(diag**2, axis=1))
+  tvert = cube_tetrahedra ^ a
+
+  ii,jj,kk = np.meshgrid(np.arange(nk1), np.arange(nk2), np.arange(nk3), indexing='ij')
+  ii,jj,kk = ii.ravel()[:,None],jj.ravel()[:,None],kk.ravel()[:,None]
+  sx,sy,sz = cube_vertices.T
+  corners = ((ii+sx)%nk1)*nk2*nk3 + ((jj+sy)%nk2)*nk3 + (kk+sz)%nk3
+
+  return corners[:,tvert].reshape((-1,4))
+
+
+def tetra_number ( e, es ):
+  '''
+  Number of states below e in each tetrahedron, in units of the tetrahedron volume
+
+  Arguments:
+      e (float or ndarray): Energy, broadcastable against es[...,0]
+      es (ndarray): Sorted corner energies with shape (...,4)
+
+  Returns:
+      n (ndarray): Occupation of each tetrahedron
+  '''
+  e1,e2,e3,e4 = np.moveaxis(es, -1, 0)
+  e,e1 = np.broadcast_arrays(e, e1)
+  es = np.broadcast_to(es, e.shape+(4,))
+  n = np.where(e >= e4, 1., 0.)
+
+  m = (e1 < e) & (e <= es[...,1])
+  if np.any(m):
+    x = e[m]-e1[m]
+    E1,E2,E3,E4 = es[m].T
+    n[m] = x**3/((E2-E1)*(E3-E1)*(E4-E1))
+
+  m = (es[...,1] < e) & (e <= es[...,2])
+  if np.any(m):
+    E1,E2,E3,E4 = es[m].T
+    b = e[m]-E2
+    e21,e31,e41,e32,e42 = E2-E1,E3-E1,E4-E1,E3-E2,E4-E2
+    n[m] = (e21**2 + 3*e21*b + 3*b**2 - (e31+e42)*b**3/(e32*e42))/(e31*e41)
+
+  m = (es[...,2] < e) & (e < e4)
+  if np.any(m):
+    E1,E2,E3,E4 = es[m].T
+    y = E4-e[m]
+    n[m] = 1. - y**3/((E4-E1)*(E4-E2)*(E4-E3))
+
+  return n
+
+
+def tetra_dos ( e, es ):
+  '''
+  Density of states of each tetrahedron at e, in units of the tetrahedron volume
+
+  Arguments:
+      e (float or ndarray): Energy, broadcastable against es[...,0]
+      es (ndarray): Sorted corner energies with shape (...,4)
+
+  Returns:
+      D (ndarray): Density of states of each tetrahedron
+  '''
+  return corner_weights(e, es, totals=True)[0]
+
+
+def corner_weights ( e, es, blochl=False, totals=False ):
+  '''
+  Integration weights of the corners of each tetrahedron at energy e (Blöchl,
+  PRB 49, 16223 (1994), Appendix B), in units of the tetrahedron volume.
+  The occupation weights w_j sum to the number of states below e, and the DOS
+  weights g_j = dw_j/de sum to the density of states at e.
+
+  Arguments:
+      e (float or ndarray): Energy, broadcastable against es[...,0]
+      es (ndarray): Sorted corner energies with shape (...,4)
+      blochl (bool): Add the Blöchl correction for the curvature of the bands
+      totals (bool): Only return the density of states of each tetrahedron, and its derivative
+
+  Returns:
+      (w, g): Occupation and DOS weights of the sorted corners with shape (...,4), or (D, dD) if totals is True
+  '''
+  e1,e4 = es[...,0],es[...,3]
+  e,e1 = np.broadcast_arrays(e, e1)
+  es = np.broadcast_to(es, e.shape+(4,))
+
+  D = np.zeros(e.shape, dtype=float)
+  dD = np.zeros(e.shape, dtype=float)
+  if not totals:
+    w = np.zeros(es.shape, dtype=float)
+    w[e >= es[...,3]] = .25
+    g = np.zeros(es.shape, dtype=float)
+
+  # e1 < e <= e2
+  m = (e1 < e) & (e <= es[...,1])
+  if np.any(m):
+    E = es[m]
+    x = e[m]-E[:,0]
+    ek1 = E[:,1:]-E[:,:1]
+    P = np.prod(ek1, axis=1)
+    D[m] = 3*x**2/P
+    dD[m] = 6*x/P
+    if not totals:
+      S = np.sum(1/ek1, axis=1)
+      wm = np.empty_like(E)
+      gm = np.empty_like(E)
+      wm[:,0] = .25*x**3*(4-x*S)/P
+      gm[:,0] = (3*x**2-x**3*S)/P
+      wm[:,1:] = .25*(x**4/P)[:,None]/ek1
+      gm[:,1:] = (x**3/P)[:,None]/ek1
+      w[m] = wm
+      g[m] = gm
+
+  # e2 < e <= e3
+  m = (es[...,1] < e) & (e <= es[...,2])
+  if np.any(m):
+    E1,E2,E3,E4 = es[m].T
+    a,b,c,d = e[m]-E1,e[m]-E2,E3-e[m],E4-e[m]
+    e31,e41,e32,e42 = E3-E1,E4-E1,E3-E2,E4-E2
+    D[m] = (3*(E2-E1) + 6*b - 3*(e31+e42)*b**2/(e32*e42))/(e31*e41)
+    dD[m] = (6 - 6*(e31+e42)*b/(e32*e42))/(e31*e41)
+    if not totals:
+      C1 = .25*a**2/(e41*e31)
+      C2 = .25*a*b*c/(e41*e32*e31)
+      C3 = .25*b**2*d/(e42*e32*e41)
+      dC1 = .5*a/(e41*e31)
+      dC2 = .25*(b*c+a*c-a*b)/(e41*e32*e31)
+      dC3 = .25*(2*b*d-b**2)/(e42*e32*e41)
+      C12,C23,C123 = C1+C2,C2+C3,C1+C2+C3
+      dC12,dC23,dC123 = dC1+dC2,dC2+dC3,dC1+dC2+dC3
+      w[m] = np.column_stack((C1 + C12*c/e31 + C123*d/e41,
+                              C123 + C23*c/e32 + C3*d/e42,
+                              C12*a/e31 + C23*b/e32,
+                              C123*a/e41 + C3*b/e42))
+      g[m] = np.column_stack((dC1 + dC12*c/e31 - C12/e31 + dC123*d/e41 - C123/e41,
+                              dC123 + dC23*c/e32 - C23/e32 + dC3*d/e42 - C3/e42,
+                              dC12*a/e31 + C12/e31 + dC23*b/e32 + C23/e32,
+                              dC123*a/e41 + C123/e41 + dC3*b/e42 + C3/e42))
+
+  # e3 < e < e4
+  m = (es[...,2] < e) & (e < e4)
+  if np.any(m):
+    E = es[m]
+    y = E[:,3]-e[m]
+    e4k = E[:,3:]-E[:,:3]
+    P = np.prod(e4k, axis=1)
+    D[m] = 3*y**2/P
+    dD[m] = -6*y/P
+    if not totals:
+      S = np.sum(1/e4k, axis=1)
+      wm = np.empty_like(E)
+      gm = np.empty_like(E)
+      wm[:,:3] = .25 - .25*(y**4/P)[:,None]/e4k
+      gm[:,:3] = (y**3/P)[:,None]/e4k
+      wm[:,3] = .25 - .25*y**3*(4-y*S)/P
+      gm[:,3] = (3*y**2-y**3*S)/P
+      w[m] = wm
+      g[m] = gm
+
+  if totals:
+    return D,dD
+
+  if blochl:
+    # Correction for the curvature of the bands, which leaves the totals unchanged
+    de = np.sum(es, axis=-1)[...,None] - 4*es
+    w += D[...,None]*de/40.
+    g += dD[...,None]*de/40.
+
+  return w,g
+
+
+def local_kpoint_indices ( nktot, npool ):
+  # Full grid indices of the k points held by this rank, as distributed by scatter_full
+  from .communication import scatter_full
+
+  return scatter_full(np.arange(nktot, dtype=int) if rank==0 else None, npool)
+
+
+def gather_eigenvalues ( E_k, npool ):
+  # Collect the eigenvalues of every k point on all ranks
+  from .communication import gather_full
+
+  E_full = gather_full(np.ascontiguousarray(E_k), npool)
+  return comm.bcast(E_full)
+
+
+def tetra_states ( E_full, tets ):
+  # Sorted corner energies of each (tetrahedron,band) state, with shape (ntet*nbnd,4)
+  return np.sort(np.moveaxis(E_full[tets], 1, 2), axis=-1).reshape((-1,4))
+
+
+def tetra_dos_total ( E_full, tets, ene, parallel=True ):
+  '''
+  Tetrahedron DOS summed over the bands of every tetrahedron, normalized per k point.
+  When parallel, the tetrahedra are divided among the ranks and the result is summed on root.
+
+  Arguments:
+      E_full (ndarray): Eigenvalues on the full k grid with shape (nktot,nbnd)
+      tets (ndarray): Corner indices of the tetrahedra with shape (ntet,4)
+      ene (ndarray): Energy grid
+
+  Returns:
+      dos (ndarray): Density of states on root (None on other ranks if parallel)
+  '''
+  from .dos_kernels import accumulate_windows
+  from .communication import load_balancing
+
+  ntet = tets.shape[0]
+  nbnd = E_full.shape[1]
+  ts,te = load_balancing(size, rank, ntet) if parallel else (0,ntet)
+
+  dosaux = np.zeros(ene.shape[0], dtype=float)
+  nblk = max(1, max_tetra_states//nbnd)
+  for bs in range(ts, te, nblk):
+    es = tetra_states(E_full, tets[bs:min(te,bs+nblk)])
+    lo = np.searchsorted(ene, es[:,0], side='right')
+    hi = np.searchsorted(ene, es[:,3], side='left')
+    dosaux += accumulate_windows(lo, hi, ene, lambda ist,e: tetra_dos(e, es[ist,None,:]))
+  dosaux /= ntet
+
+  if not parallel:
+    return dosaux
+  dos = np.zeros_like(dosaux) if rank==0 else None
+  comm.Reduce(dosaux, dos, op=MPI.SUM)
+  return dos
+
+
+def tetra_dos_projected ( E_full, kidx, tets, ene, weights, blochl=False ):
+  '''
+  Tetrahedron DOS projected with weights given at the k points held by this rank,
+    pdos(e) = sum_T sum_j g_j(e) W_j
+  Each rank sums the corners of every tetrahedron which lie on its own k points.
+  The result must be reduced over the ranks.
+
+  Arguments:
+      E_full (ndarray): Eigenvalues on the full k grid with shape (nktot,nbnd)
+      kidx (ndarray): Full grid indices of the local k points
+      tets (ndarray): Corner indices of the tetrahedra with shape (ntet,4)
+      ene (ndarray): Energy grid
+      weights (ndarray): Weights of the local states with shape (snktot,nbnd,nw)
+      blochl (bool): Use the Blöchl corrected weights
+
+  Returns:
+      pdos (ndarray): This rank's contribution with shape (ne,nw)
+  '''
+  from .dos_kernels import accumulate_windows
+
+  nktot,nbnd = E_full.shape
+  ntet = tets.shape[0]
+  nw = weights.shape[2]
+
+  loc = -np.ones(nktot, dtype=int)
+  loc[kidx] = np.arange(kidx.shape[0])
+  tl,jl = np.nonzero(loc[tets] >= 0)
+  npair = tl.shape[0]
+
+  pdos = np.zeros((ene.shape[0],nw), dtype=float)
+  nblk = max(1, max_tetra_states//nbnd)
+  for bs in range(0, npair, nblk):
+    tb,jb = tl[bs:bs+nblk],jl[bs:bs+nblk]
+    et = np.moveaxis(E_full[tets[tb]], 1, 2).reshape((-1,4))
+    order = np.argsort(et, axis=1)
+    es = np.take_along_axis(et, order, axis=1)
+    # Position of the local corner among the sorted corners of each state
+    pos = np.argmax(order == np.repeat(jb, nbnd)[:,None], axis=1)
+    w = weights[loc[tets[tb,jb]]].reshape((-1,nw))
+
+    lo = np.searchsorted(ene, es[:,0], side='right')
+    hi = np.searchsorted(ene, es[:,3], side='left')
+
+    def corner_dos ( ist, e ):
+      g = corner_weights(e, es[ist,None,:], blochl)[1]
+      return np.take_along_axis(g, pos[ist,None,None], axis=2)[...,0]
+
+    pdos += accumulate_windows(lo, hi, ene, corner_dos, w)
+
+  return pdos/ntet
+
+
+def tetra_fermi_energy ( E_full, tets, nelec, fac, parallel=True, eps=1.e-10, maxiter=200 ):
+  '''
+  Fermi energy from the tetrahedron integrated number of states, found by bisection
+
+  Arguments:
+      E_full (ndarray): Eigenvalues on the full k grid with shape (nktot,nbnd,nspin)
+      tets (ndarray): Corner indices of the tetrahedra with shape (ntet,4)
+      nelec (float): Number of electrons
+      fac (float): Occupation of each state (2 without spin-orbit)
+      parallel (bool): Divide the tetrahedra among the ranks
+
+  Returns:
+      Ef (float): Fermi energy
+  '''
+  from .communication import load_balancing
+
+  ntet = tets.shape[0]
+  nspin = E_full.shape[2]
+  ts,te = load_balancing(size, rank, ntet) if parallel else (0,ntet)
+  es = [tetra_states(E_full[:,:,ispin], tets[ts:te]) for ispin in range(nspin)]
+
+  def nstates ( Ef ):
+    naux = np.array([fac*sum(np.sum(tetra_number(Ef,e)) for e in es)/ntet])
+    if parallel:
+      comm.Allreduce(MPI.IN_PLACE, naux, op=MPI.SUM)
+    return naux[0]
+
+  Elw = np.amin(E_full) - 1.e-3
+  Eup = np.amax(E_full) + 1.e-3
+  for i in range(maxiter):
+    Ef = (Eup + Elw)/2
+    nmid = nstates(Ef)
+    if np.abs(nmid-nelec) < eps or Eup-Elw < eps:
+      break
+    elif nmid < nelec:
+      Elw = Ef
+    else:
+      Eup = Ef
+
+  return Ef